@@ -10,13 +10,13 @@ of four "tracks" together.  This allows you to compare two annotations in the
 context of their respective sequences.
 """
 import os
-from DNASkittleUtils.DDVUtils import editable_str
 
 from FluentDNA.ChainParser import ChainParser, scan_past_header, Batch
 from DNASkittleUtils.Contigs import pluck_contig
 from DNASkittleUtils.DDVUtils import first_word, ReverseComplement
 
 from FluentDNA.Annotations import create_fasta_from_annotation, GFF
+from FluentDNA.PackedSequence import SequenceBuffer
 
 
 class AnnotatedAlignment(ChainParser):
@@ -69,9 +69,10 @@ class AnnotatedAlignment(ChainParser):
         self.create_fasta_from_composite_alignment()
         names['ref_gapped'], names['query_gapped'] = self.write_gapped_fasta(names['ref'], names['query'])
 
-        self.query_seq_gapped = editable_str('')
-        self.ref_seq_gapped = editable_str('')
+        self.query_seq_gapped = SequenceBuffer()
+        self.ref_seq_gapped = SequenceBuffer()
         self.query_contigs = {}
+        self.packed_query_contigs = {}
         self.stored_rev_comps = {}
         self.annotation_phase = True
         # At this point we have created two gapped sequence fastas
@@ -1,8 +1,8 @@
 import math
-from DNASkittleUtils.Contigs import read_contigs
 from itertools import chain
 from os.path import join, basename
 
+from FluentDNA.FastaIndex import read_contigs_indexed
 from FluentDNA.Annotations import create_fasta_from_annotation, find_universal_prefix, parseGFF
 from FluentDNA.ParallelGenomeLayout import ParallelLayout
 from FluentDNA.FluentDNAUtils import filter_by_contigs, copy_to_sources
@@ -21,7 +21,7 @@ class AnnotatedTrackLayout(ParallelLayout):
     def render_genome(self, output_folder, output_file_name, extract_contigs=None):
         self.annotation_fasta = join(output_folder, 'sources', basename(self.gff_filename) +
                                      ('.fa' if extract_contigs is None else '_extracted.fa'))
-        self.contigs = read_contigs(self.fasta_file)
+        self.contigs = read_contigs_indexed(self.fasta_file)
         # TODO: Genome is read_contigs twice unnecessarily. This could be sped up.
         self.contigs = filter_by_contigs(self.contigs, extract_contigs)
         extract_contigs = [x.name.split()[0] for x in self.contigs]
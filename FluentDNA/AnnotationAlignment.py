@@ -10,7 +10,6 @@ instance of annotated elements in parallel and skip the rest of the genomes.
 Currently, this is targeted at repeats on chr19 of Human and Chimp.
 """
 import os
-from DNASkittleUtils.DDVUtils import editable_str
 
 from FluentDNA.ChainParser import ChainParser
 from DNASkittleUtils.CommandLineUtils import just_the_name
@@ -19,6 +18,7 @@ from FluentDNA.RepeatAnnotations import max_consensus_width, read_repeatmasker_c
 from FluentDNA.Span import alignment_chopping_index, AlignedSpans, Span
 from FluentDNA.TransposonLayout import TransposonLayout
 from FluentDNA.FluentDNAUtils import make_output_directory
+from FluentDNA.PackedSequence import SequenceBuffer
 
 
 def create_aligned_annotation_fragments(alignment, repeat_entries):
@@ -75,8 +75,8 @@ def align_annotation(annotation_filename, ref_fasta, query_fasta, chain_file):
         # modify chain.alignment to only contain annotated stretches
         chain.output_folder = chain.output_prefix + ending
         make_output_directory(chain.output_folder)  # create a folder specifically for this repeat
-        chain.query_seq_gapped = editable_str('')  # these need to be cleared so they don't accumulate the previous family
-        chain.ref_seq_gapped = editable_str('')
+        chain.query_seq_gapped = SequenceBuffer()  # these need to be cleared so they don't accumulate the previous family
+        chain.ref_seq_gapped = SequenceBuffer()
         trimmed_alignment = create_aligned_annotation_fragments(chain.alignment, repeat_entries)
         chain.create_fasta_from_composite_alignment(previous_chr=None, alignment=trimmed_alignment)  # populates chain.query_seq_gapped and ref_seq_gapped
         # or if no fasta output is wanted: query_uniq_array, ref_uniq_array = chain.compute_unique_sequence()
@@ -7,8 +7,8 @@ from itertools import chain
 import gzip
 from DNASkittleUtils.Contigs import Contig, read_contigs, write_contigs_to_file
 
-from DNASkittleUtils.DDVUtils import editable_str
-from FluentDNA import gap_char
+import numpy as np
+from FluentDNA.PackedSequence import PackedSequence, as_codes, gap_codes
 
 try:
     from urllib.parse import unquote
@@ -241,7 +241,8 @@ def parseGFF(gff_file):
 def handle_tail(seq_array, scaffold_lengths, sc_index):
     if scaffold_lengths is not None:
         remaining = scaffold_lengths[sc_index] - len(seq_array)
-        seq_array.extend( gap_char * remaining)
+        seq_array = np.concatenate((seq_array, gap_codes(max(0, remaining))))
+    return seq_array
 
 
 def squish_fasta(scaffolds, annotation_width, base_width):
@@ -251,13 +252,11 @@ def squish_fasta(scaffolds, annotation_width, base_width):
     remainder = base_width - (skip_size * annotation_width)
     skips = list(chain([skip_size] * (annotation_width - 1), [skip_size + remainder]))
     for contig in scaffolds:
-        work = editable_str('')
-        i = 0; x = 0
-        while i < len(contig.seq):
-            work.append(contig.seq[i])
-            i += skips[x % annotation_width]
-            x += 1
-        squished_versions.append(Contig(contig.name, ''.join(work)))
+        codes = as_codes(contig.seq)
+        steps = np.tile(skips, len(codes) // base_width + 1)  # one repeat of skips covers base_width
+        samples = np.concatenate(([0], np.cumsum(steps)))
+        samples = samples[samples < len(codes)]
+        squished_versions.append(Contig(contig.name, PackedSequence(codes[samples])))
     return squished_versions
 
 
@@ -279,7 +278,9 @@ def create_fasta_from_annotation(gff, scaffold_names, scaffold_lengths=None, out
                     'mRNA':FeatureRep('A', 4),
                     'transcript':FeatureRep('N', 5),
                     'repeat': FeatureRep('R', 6)}
-    symbol_priority = defaultdict(lambda: 20, {f.symbol: f.priority for f in features.values()})
+    symbol_priority = np.full(256, 20, dtype=np.int64)  # lookup table by letter
+    for f in features.values():
+        symbol_priority[ord(f.symbol)] = f.priority
     if isinstance(gff, str):
         gff = parseGFF(gff)  # gff parameter was a filename
     chromosome_lengths = gather_chromosome_lengths(gff)
@@ -287,20 +288,19 @@ def create_fasta_from_annotation(gff, scaffold_names, scaffold_lengths=None, out
     scaffolds = []
     for sc_index, scaff_name in enumerate(scaffold_names):  # Exact match required (case sensitive)
         if scaff_name in gff.keys():
-            seq_array = editable_str(gap_char * (chromosome_lengths[scaff_name] + 1))
+            seq_array = gap_codes(chromosome_lengths[scaff_name] + 1)
             for entry in gff[scaff_name]:
                 assert isinstance(entry, GFFAnnotation), "This isn't a proper GFF object"
                 if entry.type in features.keys():
                     count += 1
                     my = features[entry.type]
-                    for i in range(entry.start, entry.end + 1):
-                        if symbol_priority[seq_array[i]] > my.priority :
-                            seq_array[i] = my.symbol
+                    region = seq_array[entry.start: entry.end + 1]  # view, assignments go to seq_array
+                    region[symbol_priority[region] > my.priority] = ord(my.symbol)
                 if entry.type == 'gene':
                     # TODO: output header JSON every time we find a gene
                     pass
-            handle_tail(seq_array, scaffold_lengths, sc_index)
-            scaffolds.append(Contig(scaff_name, ''.join(seq_array)))
+            seq_array = handle_tail(seq_array, scaffold_lengths, sc_index)
+            scaffolds.append(Contig(scaff_name, PackedSequence(seq_array)))
         else:
             print("No matches for '%s'" % scaff_name)
     if scaffolds:
@@ -0,0 +1,421 @@
+"""Image canvas kept in a numpy.memmap file instead of RAM, for images larger than memory.
+MemmapCanvas implements the part of the PIL.Image interface that TileLayout and DeepZoom use:
+size, mode, paste, crop, convert, palettes, load() for single pixels and save() as PNG.
+Everything that goes in or out is a PIL image of one region, so the whole canvas is never
+resident.  The OS pages the file in and out as drawing touches it.
+
+The file is a standard .npy array of shape (height, width, channels) with a small .json
+sidecar for the mode and palette, so it can be reopened later, e.g. by --image.
+"""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import json
+import os
+import struct
+import zlib
+from collections import deque
+
+import numpy as np
+from PIL import Image
+
+mode_channels = {'P': 1, 'L': 1, 'RGB': 3, 'RGBA': 4}
+png_color_types = {'L': 0, 'RGB': 2, 'P': 3, 'RGBA': 6}
+
+
+def sidecar_path(canvas_path):
+    return canvas_path + '.json'
+
+
+def is_canvas_file(path):
+    return path.endswith('.npy') and os.path.exists(sidecar_path(path))
+
+
+class CanvasPixels(object):
+    """Pixel access for draw_pixel(), the same as the PixelAccess returned by Image.load()"""
+    def __init__(self, canvas):
+        self.canvas = canvas
+
+    def __getitem__(self, xy):
+        value = self.canvas.array[xy[1], xy[0]]
+        return int(value[0]) if len(value) == 1 else tuple(int(v) for v in value)
+
+    def __setitem__(self, xy, color):
+        if isinstance(color, int):
+            color = (color,)
+        channels = self.canvas.channels
+        self.canvas.array[xy[1], xy[0]] = (tuple(color) + (255,) * channels)[:channels]
+
+
+class MemmapCanvas(object):
+    def __init__(self, path, size=None, mode='RGB', color=0, palette=None):
+        """Creates a new canvas file at path, or opens an existing one when size is None.
+        :param color: background, either a palette index or a color tuple"""
+        self.path = path
+        if size is None:
+            with open(sidecar_path(path), 'r') as sidecar:
+                header = json.load(sidecar)
+            self.mode, self.palette = header['mode'], header['palette']
+            self.array = np.load(path, mmap_mode='r+')
+        else:
+            self.mode, self.palette = mode, palette
+            width, height = size
+            self.array = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8,
+                                                   shape=(height, width, mode_channels[mode]))
+            if isinstance(color, tuple):  # like Image.new(), alpha is opaque unless given
+                color = (color + (255,) * self.channels)[:self.channels]
+            if np.any(color):  # a new file is already zeros
+                for top, bottom in self.bands():
+                    self.array[top: bottom] = color
+            self.write_sidecar()
+
+    @property
+    def width(self):
+        return self.array.shape[1]
+
+    @property
+    def height(self):
+        return self.array.shape[0]
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    @property
+    def channels(self):
+        return self.array.shape[2]
+
+    def getbands(self):
+        return tuple(self.mode)
+
+    def getpalette(self):
+        return list(self.palette) if self.palette else None
+
+    def putpalette(self, palette):
+        self.palette = list(palette)
+        self.write_sidecar()
+
+    def write_sidecar(self):
+        with open(sidecar_path(self.path), 'w') as sidecar:
+            json.dump({'mode': self.mode, 'palette': self.palette}, sidecar)
+
+    def load(self):
+        return CanvasPixels(self)
+
+    def bands(self, band_height=None):
+        """(top, bottom) row ranges of about 64MB each"""
+        band_height = band_height or max(1, (64 * 1024 * 1024) // max(1, self.width * self.channels))
+        for top in range(0, self.height, band_height):
+            yield top, min(top + band_height, self.height)
+
+    def clip(self, box):
+        """box clipped to the canvas, and the offset of the clipped box inside the original"""
+        left, top, right, bottom = [int(v) for v in box]
+        clipped = (max(0, left), max(0, top), min(self.width, right), min(self.height, bottom))
+        return clipped, (clipped[0] - left, clipped[1] - top)
+
+    def to_image(self, pixels):
+        image = Image.fromarray(pixels[:, :, 0] if self.channels == 1 else pixels, self.mode)
+        if self.mode == 'P' and self.palette:
+            image.putpalette(self.palette)
+        return image
+
+    def crop(self, box):
+        """PIL image of the region.  Like Image.crop(), areas outside the canvas are zeros."""
+        left, top, right, bottom = [int(v) for v in box]
+        pixels = np.zeros((max(0, bottom - top), max(0, right - left), self.channels), dtype=np.uint8)
+        (l, t, r, b), (dx, dy) = self.clip(box)
+        if r > l and b > t:
+            pixels[dy: dy + b - t, dx: dx + r - l] = self.array[t: b, l: r]
+        return self.to_image(pixels)
+
+    def paste_array(self, pixels, x, y):
+        """Writes a (height, width, channels) uint8 array with its upper left corner at x, y"""
+        (l, t, r, b), (dx, dy) = self.clip((x, y, x + pixels.shape[1], y + pixels.shape[0]))
+        if r > l and b > t:
+            self.array[t: b, l: r] = pixels[dy: dy + b - t, dx: dx + r - l]
+
+    def paste(self, im, box=None, mask=None):
+        """Same as Image.paste() for a PIL image.  Masked pastes are blended on a copy of the region."""
+        box = tuple(box or (0, 0))[:2]
+        if mask is not None:
+            region = self.crop(box + (box[0] + im.width, box[1] + im.height))
+            region.paste(im, (0, 0), mask)
+            im = region
+        elif im.mode != self.mode:
+            im = im.convert(self.mode)
+        pixels = np.asarray(im)
+        self.paste_array(pixels.reshape(pixels.shape[0], pixels.shape[1], -1), box[0], box[1])
+
+    def convert(self, mode, path=None):
+        """New canvas in another mode, converted one band at a time.  Without a path the new
+        canvas takes over this file and this canvas is closed."""
+        replace = path is None
+        converted = MemmapCanvas(self.path + '.converted.npy' if replace else path, self.size, mode)
+        for top, bottom in self.bands():
+            converted.paste(self.crop((0, top, self.width, bottom)).convert(mode), (0, top))
+        if replace:
+            converted.close()
+            self.close(delete=True)
+            os.rename(converted.path, self.path)
+            os.rename(sidecar_path(converted.path), sidecar_path(self.path))
+            converted = MemmapCanvas(self.path)
+        return converted
+
+    def save(self, fp, format='PNG'):
+        write_png(fp, self)
+
+    def flush(self):
+        self.array.flush()
+
+    def close(self, delete=False):
+        """Releases the memory map.  delete also removes the file and its sidecar."""
+        if self.array is not None:
+            self.array.flush()
+        self.array = None
+        if delete:
+            delete_canvas(self.path)
+
+
+def delete_canvas(path):
+    for file_path in (path, sidecar_path(path)):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+class BandCanvas(object):
+    """One band of rows of a bigger image, for drawing titles while rendering straight to tiles.
+    Coordinates are in the full image and anything outside the band is clipped, so titles are
+    drawn with the same positions they would have on a whole canvas.  With left, the band is
+    a window that also starts part way across the image, like a single tile."""
+    def __init__(self, image, top, full_size, left=0):
+        self.image = image
+        self.top = top
+        self.left = left
+        self.width, self.height = full_size
+
+    @property
+    def mode(self):
+        return self.image.mode
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def getbands(self):
+        return self.image.getbands()
+
+    def getpalette(self):
+        return self.image.getpalette()
+
+    def putpalette(self, palette):
+        self.image.putpalette(palette)
+
+    def crop(self, box):
+        return self.image.crop((box[0] - self.left, box[1] - self.top, box[2] - self.left, box[3] - self.top))
+
+    def paste(self, im, box=None, mask=None):
+        box = tuple(box or (0, 0))
+        shifted = (box[0] - self.left, box[1] - self.top) + \
+            ((box[2] - self.left, box[3] - self.top) if len(box) == 4 else ())
+        self.image.paste(im, shifted, mask)
+
+    def pixels(self):
+        """(height, width, channels) array of the band"""
+        pixels = np.asarray(self.image)
+        return pixels.reshape(pixels.shape[0], pixels.shape[1], -1)
+
+
+def open_image(path):
+    """MemmapCanvas for a canvas file, otherwise a PIL image"""
+    if is_canvas_file(path):
+        return MemmapCanvas(path, None)
+    return Image.open(path)
+
+
+def png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + \
+        struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+
+def deflate_piece(data, compress_level):
+    """Raw deflate blocks ending on a byte boundary (full flush), so pieces compressed
+    separately can be concatenated into one stream"""
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+
+class PngWriter(object):
+    """PNG written one band of rows at a time, so images larger than memory can be saved.
+    Rows use PNG filter type 0 (none), which suits blocks of flat nucleotide color.
+    With workers > 1, pieces of about piece_size bytes are compressed on a pool of threads
+    (zlib releases the GIL) and stitched into one zlib stream the same way pigz does for gzip."""
+    def __init__(self, path, width, height, mode, palette=None, compress_level=6, workers=1,
+                 piece_size=1024 * 1024):
+        self.png = open(path, 'wb')
+        self.png.write(b'\x89PNG\r\n\x1a\n')
+        self.png.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8,
+                                                      png_color_types[mode], 0, 0, 0)))
+        if mode == 'P':
+            self.png.write(png_chunk(b'PLTE', bytes(bytearray(palette[:768]))))
+        self.compress_level = compress_level
+        self.workers = workers
+        self.piece_size = piece_size
+        if workers > 1:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(workers)
+            self.pending = deque()  # compressed pieces in row order
+            self.checksum = zlib.adler32(b'')
+            self.png.write(png_chunk(b'IDAT', b'\x78\x9c'))  # zlib header
+        else:
+            self.pool = None
+            self.compressor = zlib.compressobj(compress_level)
+
+    def write_rows(self, rows):
+        """rows is a (height, width, channels) uint8 array"""
+        rows = np.asarray(rows).reshape(rows.shape[0], -1)
+        filtered = np.zeros((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)  # filter byte
+        filtered[:, 1:] = rows
+        if self.pool is None:
+            data = self.compressor.compress(filtered.tobytes())
+            if data:
+                self.png.write(png_chunk(b'IDAT', data))
+            return
+        rows_per_piece = max(1, self.piece_size // filtered.shape[1])
+        for top in range(0, len(filtered), rows_per_piece):
+            data = filtered[top: top + rows_per_piece].tobytes()
+            self.checksum = zlib.adler32(data, self.checksum)
+            self.pending.append(self.pool.apply_async(deflate_piece, (data, self.compress_level)))
+            self.write_pieces(2 * self.workers)
+
+    def write_pieces(self, keep_pending=0):
+        """Writes finished pieces in order, waiting while more than keep_pending are queued"""
+        while self.pending and (len(self.pending) > keep_pending or self.pending[0].ready()):
+            self.png.write(png_chunk(b'IDAT', self.pending.popleft().get()))
+
+    def close(self):
+        if self.pool is None:
+            self.png.write(png_chunk(b'IDAT', self.compressor.flush()))
+        else:
+            self.write_pieces()
+            self.pool.close()
+            self.pool.join()
+            final_block = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15).flush()
+            self.png.write(png_chunk(b'IDAT', final_block + struct.pack('>I', self.checksum & 0xffffffff)))
+        self.png.write(png_chunk(b'IEND', b''))
+        self.png.close()
+
+
+def image_bands(image, band_bytes=64 * 1024 * 1024):
+    """(top, bottom, pixels) bands of a MemmapCanvas or PIL image"""
+    if isinstance(image, MemmapCanvas):
+        for top, bottom in image.bands():
+            yield top, bottom, image.array[top: bottom]
+        return
+    band_height = max(1, band_bytes // max(1, image.width * len(image.getbands())))
+    for top in range(0, image.height, band_height):
+        bottom = min(top + band_height, image.height)
+        pixels = np.asarray(image.crop((0, top, image.width, bottom)))
+        yield top, bottom, pixels.reshape(pixels.shape[0], pixels.shape[1], -1)
+
+
+def write_png(path, canvas, compress_level=6, workers=1, verbose=False):
+    """Saves a MemmapCanvas or PIL image as a PNG one band at a time.  workers are threads
+    compressing in parallel, see PngWriter."""
+    if canvas.mode not in png_color_types:
+        canvas.save(path, 'PNG', compress_level=compress_level)  # PIL image in a mode PngWriter doesn't write
+        return
+    png = PngWriter(path, canvas.width, canvas.height, canvas.mode,
+                    canvas.getpalette() if canvas.mode == 'P' else None, compress_level, workers)
+    for top, bottom, pixels in image_bands(canvas):
+        png.write_rows(pixels)
+        if verbose:
+            print(str(bottom / canvas.height * 100)[:4], '% written', flush=True)  # pseudo progress bar
+    png.close()
+
+
+class PngReader(object):
+    """Decodes a PNG one band of rows at a time, so pyramids can be made from images larger
+    than memory.  zlib inflates the rows and PIL's PNG decoder undoes the row filters: each band
+    is handed to it with the row above the band in front, since filters refer to the row above.
+    Only 8 bit, non-interlaced images without transparency chunks can be read this way, which
+    is everything FluentDNA writes.  open() returns None for anything else."""
+    color_modes = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}
+
+    def __init__(self, path, width, height, mode, palette, data_offset):
+        self.path = path
+        self.width, self.height = width, height
+        self.mode = mode
+        self.palette = palette
+        self.data_offset = data_offset  # first chunk after the header chunks
+        self.channels = len(mode)
+
+    @staticmethod
+    def open(path):
+        with open(path, 'rb') as png:
+            if png.read(8) != b'\x89PNG\r\n\x1a\n':
+                return None
+            width = height = mode = palette = None
+            while True:
+                offset = png.tell()
+                header = png.read(8)
+                if len(header) < 8:
+                    return None
+                length, chunk_type = struct.unpack('>I4s', header)
+                if chunk_type == b'IDAT':
+                    break
+                data = png.read(length)
+                png.read(4)  # crc
+                if chunk_type == b'IHDR':
+                    width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', data)
+                    if bit_depth != 8 or interlace or color_type not in PngReader.color_modes:
+                        return None
+                    mode = PngReader.color_modes[color_type]
+                elif chunk_type == b'PLTE':
+                    palette = list(bytearray(data))
+                elif chunk_type == b'tRNS':
+                    return None
+        if mode is None or (mode == 'P' and palette is None):
+            return None
+        return PngReader(path, width, height, mode, palette, offset)
+
+    def compressed_chunks(self):
+        with open(self.path, 'rb') as png:
+            png.seek(self.data_offset)
+            while True:
+                header = png.read(8)
+                if len(header) < 8:
+                    return
+                length, chunk_type = struct.unpack('>I4s', header)
+                data = png.read(length)
+                png.read(4)
+                if chunk_type == b'IDAT':
+                    yield data
+                elif chunk_type == b'IEND':
+                    return
+
+    def bands(self, band_height=256):
+        """(top, pixels) for every band_height rows, pixels is a (rows, width, channels) uint8 array"""
+        stride = self.width * self.channels + 1  # filter byte + pixels
+        inflater = zlib.decompressobj()
+        pending = bytearray()
+        previous = bytes(bytearray(stride))  # rows above the image count as zeros
+        top = 0
+        chunks = self.compressed_chunks()
+        while top < self.height:
+            rows = min(band_height, self.height - top)
+            while len(pending) < rows * stride:
+                data = next(chunks, None)
+                if data is None:
+                    pending += inflater.flush()
+                    if len(pending) < rows * stride:
+                        raise IOError("%s is truncated at row %i" % (self.path, top + len(pending) // stride))
+                    break
+                pending += inflater.decompress(data)
+            band = Image.frombytes(self.mode, (self.width, rows + 1),
+                                   zlib.compress(previous + pending[:rows * stride], 0), 'zip', self.mode)
+            del pending[:rows * stride]
+            pixels = np.asarray(band).reshape(rows + 1, self.width, self.channels)
+            previous = b'\x00' + pixels[-1].tobytes()  # unfiltered, so it needs no filter
+            yield top, pixels[1:]
+            top += rows
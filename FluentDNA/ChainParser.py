@@ -6,6 +6,8 @@ import sys
 import traceback
 from collections import namedtuple
 
+import numpy as np
+
 try:
     from blist import blist
 except ImportError:
@@ -17,11 +19,12 @@ except ImportError:
 
 
 from DNASkittleUtils.CommandLineUtils import just_the_name
-from DNASkittleUtils.Contigs import pluck_contig, write_complete_fasta
-from DNASkittleUtils.DDVUtils import first_word, ReverseComplement, BlankIterator, editable_str
+from DNASkittleUtils.DDVUtils import first_word, BlankIterator
 from FluentDNA.DefaultOrderedDict import DefaultOrderedDict
+from FluentDNA.FastaIndex import pluck_contig_indexed
 from FluentDNA.ChainFiles import chain_file_to_list, match
 from FluentDNA.FluentDNAUtils import make_output_directory, keydefaultdict, read_contigs_to_dict, copy_to_sources
+from FluentDNA.PackedSequence import SequenceBuffer, as_packed, sequence_positions, write_complete_fasta_packed
 from FluentDNA.Span import AlignedSpans, Span, alignment_chopping_index
 from FluentDNA import gap_char
 from FluentDNA.TileLayout import hex_to_rgb
@@ -88,12 +91,13 @@ class ChainParser(object):
         self.query_sequence = ''
         self.ref_sequence = ''
         self.ref_chr_name = ''
-        self.query_seq_gapped = editable_str('')
-        self.ref_seq_gapped = editable_str('')
+        self.query_seq_gapped = SequenceBuffer()
+        self.ref_seq_gapped = SequenceBuffer()
         self.output_fastas = []
         self.alignment = blist()  # optimized for inserts in the middle
         if type(self.alignment) == type([]):
             print("WARNING: blist library not installed: Genome alignment will be very slow.")
+        self.packed_query_contigs = {}  # loaded on first use, shared by both strands
         self.stored_rev_comps = {}
         self.gapped = '_gapped'
         self.stats = initial_stats()
@@ -273,7 +277,7 @@ class ChainParser(object):
         it from using complementary character for interchromosomal."""
         if alignment is None:
             alignment = self.alignment
-        query_source_annotation = editable_str('')  # only used if translocation_markup
+        query_source_annotation = SequenceBuffer()  # only used if translocation_markup
 
         for pair in alignment:
             if previous_chr != (pair.query.contig_name, pair.query.strand):
@@ -346,7 +350,7 @@ class ChainParser(object):
                         self.stored_rev_comps[query_name] = self.rev_comp_contig(query_name)  # caching for performance
                     self.query_sequence = self.stored_rev_comps[query_name]
                 else:
-                    self.query_sequence = self.query_contigs[query_name]
+                    self.query_sequence = self.packed_query_contig(query_name)
             else:
                 return self.missing_query_sequence(query_name)
             return True
@@ -357,8 +361,15 @@ class ChainParser(object):
         return False
 
 
+    def packed_query_contig(self, query_name):
+        query_name = query_name.lower()
+        if query_name not in self.packed_query_contigs:
+            self.packed_query_contigs[query_name] = as_packed(self.query_contigs[query_name])
+        return self.packed_query_contigs[query_name]
+
+
     def rev_comp_contig(self, query_name):
-        return ReverseComplement(self.query_contigs[query_name.lower()])
+        return self.packed_query_contig(query_name).reverse_complement()  # a view, no copy
 
 
     def setup_chain_start(self, chain, is_master_alignment):
@@ -410,8 +421,8 @@ class ChainParser(object):
         if prepend_output_folder:
             query_gap_name = os.path.join(self.output_folder, 'sources', query_gap_name)
             ref_gap_name = os.path.join(self.output_folder, 'sources', ref_gap_name)
-        write_complete_fasta(query_gap_name, self.query_seq_gapped)
-        write_complete_fasta(ref_gap_name, self.ref_seq_gapped)
+        write_complete_fasta_packed(query_gap_name, self.query_seq_gapped)
+        write_complete_fasta_packed(ref_gap_name, self.ref_seq_gapped)
         print("Finished creating gapped fasta files", ref_gap_name, query_gap_name)
         return ref_gap_name, query_gap_name
 
@@ -426,90 +437,58 @@ class ChainParser(object):
         query_unique_name = os.path.join(self.output_folder, 'sources', query_unique_name)
         ref_unique_name = os.path.basename(ref_gapped_name.replace(self.gapped, '_unique'))
         ref_unique_name = os.path.join(self.output_folder, 'sources', ref_unique_name)
-        write_complete_fasta(query_unique_name, query_uniq_array)
-        write_complete_fasta(ref_unique_name, ref_uniq_array)
+        write_complete_fasta_packed(query_unique_name, query_uniq_array)
+        write_complete_fasta_packed(ref_unique_name, ref_uniq_array)
 
         return ref_unique_name, query_unique_name
 
 
     def compute_unique_with_markup(self, translocation_markup):
-        query_uniq_array = editable_str(self.query_seq_gapped)
-        ref_uniq_array = editable_str(self.ref_seq_gapped)
-        print("Done allocating unique array")
         markup_to_fill_char = keydefaultdict(lambda k: k,
             {m.char: m.fill for m in self.translocation_types})
+        fill_table = np.arange(256, dtype=np.uint8)
+        for char, fill in markup_to_fill_char.items():
+            fill_table[ord(char)] = ord(fill)
+        markup = translocation_markup.values()
+        return self.mark_shared_sequence(lambda q_shared: fill_table[markup[q_shared]])
 
-        # query_uniq_array is already initialized to contain header characters
-        q = scan_past_header(self.query_seq_gapped, 0)
-        r = scan_past_header(self.ref_seq_gapped, 0)
-        while q < len(self.query_seq_gapped) and r < len(self.ref_seq_gapped):
-            q = scan_past_header(self.query_seq_gapped,
-                                 q)  # query_uniq_array is already initialized to contain header characters
-            r = scan_past_header(self.ref_seq_gapped, r)
-
-            # only overlapping section
-            q_letter = self.query_seq_gapped[q]
-            r_letter = self.ref_seq_gapped[r]
-            fill_char = markup_to_fill_char[translocation_markup[q]]
-            if q_letter == r_letter:
-                query_uniq_array[q] = fill_char
-                ref_uniq_array[r] = fill_char
-                self.stats['Shared seq bp'] += 1
-            else:  # Not equal
-                if q_letter == 'N':
-                    query_uniq_array[q] = gap_char
-                    self.stats['Query N to ref in bp'] += 1
-                elif r_letter == 'N':
-                    ref_uniq_array[r] = gap_char
-                    self.stats['Ref N to query bp'] += 1
-                else:  # No N's involved
-                    if q_letter == gap_char:
-                        self.stats['Ref unique bp'] += 1
-                    elif r_letter == gap_char:
-                        self.stats['Query unique bp'] += 1
-                    else:
-                        self.stats['Aligned Variance in bp'] += 1
-            q += 1
-            r += 1
 
-        return query_uniq_array, ref_uniq_array
+    def compute_unique_sequence(self):
+        return self.mark_shared_sequence(lambda q_shared: ord(gap_char))
 
 
-    def compute_unique_sequence(self):
-        query_uniq_array = editable_str(self.query_seq_gapped)
-        ref_uniq_array = editable_str(self.ref_seq_gapped)
+    def mark_shared_sequence(self, fill_for_shared):
+        """Compares the two gapped sequences letter by letter, skipping headers, and returns
+        copies with shared sequence overwritten by fill_for_shared(query indices).
+        N's opposite real sequence are also removed.  Tallies self.stats along the way."""
+        query_uniq_array = self.query_seq_gapped.packed()
+        ref_uniq_array = self.ref_seq_gapped.packed()
         print("Done allocating unique array")
-        # query_uniq_array is already initialized to contain header characters
-        q = scan_past_header(self.query_seq_gapped, 0)
-        r = scan_past_header(self.ref_seq_gapped, 0)
-        while q < len(self.query_seq_gapped) and r < len(self.ref_seq_gapped):
-            q = scan_past_header(self.query_seq_gapped, q)  # query_uniq_array is already initialized to contain header characters
-            r = scan_past_header(self.ref_seq_gapped, r)
-
-            # only overlapping section
-            q_letter = self.query_seq_gapped[q]
-            r_letter = self.ref_seq_gapped[r]
-            if q_letter == r_letter:
-                query_uniq_array[q] = gap_char
-                ref_uniq_array[r] = gap_char
-                self.stats['Shared seq bp'] += 1
-            else:  # Not equal
-                if q_letter == 'N':
-                    query_uniq_array[q] = gap_char
-                    self.stats['Query N to ref in bp'] += 1
-                elif r_letter == 'N':
-                    ref_uniq_array[r] = gap_char
-                    self.stats['Ref N to query bp'] += 1
-                else:  # No N's involved
-                    if q_letter == gap_char:
-                        self.stats['Ref unique bp'] += 1
-                    elif r_letter == gap_char:
-                        self.stats['Query unique bp'] += 1
-                    else:
-                        self.stats['Aligned Variance in bp'] += 1
-            q += 1
-            r += 1
-
+        # header characters are skipped, so they're preserved in the unique arrays
+        q = sequence_positions(query_uniq_array)
+        r = sequence_positions(ref_uniq_array)
+        overlap = min(len(q), len(r))  # only overlapping section
+        q, r = q[:overlap], r[:overlap]
+        q_letter, r_letter = query_uniq_array.codes[q], ref_uniq_array.codes[r]
+
+        shared = q_letter == r_letter
+        query_n = ~shared & (q_letter == ord('N'))
+        ref_n = ~shared & ~query_n & (r_letter == ord('N'))
+        no_n = ~shared & ~query_n & ~ref_n
+        ref_unique = no_n & (q_letter == ord(gap_char))
+        query_unique = no_n & ~ref_unique & (r_letter == ord(gap_char))
+
+        fill = fill_for_shared(q[shared])
+        query_uniq_array.codes[q[shared]] = fill
+        ref_uniq_array.codes[r[shared]] = fill
+        query_uniq_array.codes[q[query_n]] = ord(gap_char)
+        ref_uniq_array.codes[r[ref_n]] = ord(gap_char)
+
+        counts = {'Shared seq bp': shared, 'Query N to ref in bp': query_n, 'Ref N to query bp': ref_n,
+                  'Ref unique bp': ref_unique, 'Query unique bp': query_unique,
+                  'Aligned Variance in bp': no_n & ~ref_unique & ~query_unique}
+        for key, mask in counts.items():
+            self.stats[key] += int(np.count_nonzero(mask))
         return query_uniq_array, ref_uniq_array
 
 
@@ -543,15 +522,15 @@ class ChainParser(object):
         # Reset values from previous iteration
         self.ref_chr_name = ref_chr
         self.query_sequence = ''
-        self.query_seq_gapped = editable_str('')
-        self.ref_seq_gapped = editable_str('')
+        self.query_seq_gapped = SequenceBuffer()
+        self.ref_seq_gapped = SequenceBuffer()
         self.output_fastas = []
         self.alignment = blist()  # Alignment is specific to the chromosome
         self.stats = initial_stats()
         if ref_chr in self.ref_contigs:
-            self.ref_sequence = self.ref_contigs[ref_chr]  # only need the reference chromosome read, skip the others
+            self.ref_sequence = as_packed(self.ref_contigs[ref_chr])  # only need the reference chromosome read, skip the others
         else:
-            self.ref_sequence = pluck_contig(ref_chr, self.ref_source)
+            self.ref_sequence = as_packed(pluck_contig_indexed(ref_chr, self.ref_source))
         # self.chain_list = chain_file_to_list(chain_name)
         copy_to_sources(self.output_folder, self.ref_source)
         copy_to_sources(self.output_folder, self.query_source)
@@ -587,7 +566,7 @@ class ChainParser(object):
     def write_markup_file(self, ref, translocation_markup):
         markup = os.path.join(self.output_folder, 'sources',
                               just_the_name(ref) + '__translocation_markup.fa')
-        write_complete_fasta(markup, translocation_markup)
+        write_complete_fasta_packed(markup, translocation_markup)
         return markup
 
     def parse_chain(self, chromosomes):# -> list:
@@ -0,0 +1,177 @@
+"""Nucleotide counts of any range of a contig without reading the range, for the results server's
+api/composition requests (see ResultsServer.py).  When the sequence chunks are written, the
+running totals of A, C, G, T and N at every block boundary are saved in a small binary sidecar,
+sources/<fasta>.counts.  It stays out of chunks/ so that --pack_chunks (TilePack.py) can't move
+it where the server won't find it.  A query is the difference of two running totals plus at most
+two partial blocks read from the indexed FASTA, so its cost doesn't depend on the range length.
+Except when the FASTA has uneven line lengths: then there is no random access and every partial
+block (and every api/sequence request) decodes its whole contig.
+
+Sidecar layout, little-endian:
+    b'FDNACNT1', uint32 block size, uint32 header length, JSON header
+    for each contig: (ceil(length / block) + 1, 5) running totals
+The header holds the FASTA path (relative to the sidecar), the dtype of the totals and the
+name and length of each contig, in the same order as the chunk files."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+from FluentDNA.FastaIndex import IndexedFasta
+from FluentDNA.PackedSequence import as_codes
+
+COUNTED = 'ACGTN'
+MAGIC = b'FDNACNT1'
+COUNTS_SUFFIX = '.counts'
+
+
+def composition_counts_path(output_folder, fasta_name):
+    return os.path.join(output_folder, 'sources', fasta_name + COUNTS_SUFFIX)
+
+
+def block_counts(codes, block):
+    """(blocks, 5) counts of ACGTN in each block of codes, the last block may be partial"""
+    padded = np.zeros(-(-len(codes) // block) * block, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    padded = padded.reshape(-1, block)
+    counts = [(padded == ord(base)) | (padded == ord(base.lower())) for base in COUNTED]
+    return np.stack([c.sum(axis=1) for c in counts], axis=1)
+
+
+class CountsWriter(object):
+    """Collects the running totals of each contig passed through counted(), then close() writes
+    the sidecar.  fasta is where the server will read sequence from."""
+    def __init__(self, path, fasta, block=1024):
+        self.path = path
+        self.fasta = fasta
+        self.block = block
+        self.contigs = []  # (name, length)
+        self.totals = []
+
+    def counted(self, contigs):
+        for contig in contigs:
+            self.add(contig.name, contig.seq)
+            yield contig
+
+    def add(self, name, seq, piece=4 * 1024 * 1024):
+        piece -= piece % self.block
+        parts = [np.zeros((1, len(COUNTED)), dtype=np.uint64)]
+        for start in range(0, len(seq), piece):
+            parts.append(block_counts(as_codes(seq[start: start + piece]), self.block))
+        self.contigs.append((name, len(seq)))
+        self.totals.append(np.cumsum(np.concatenate(parts).astype(np.uint64), axis=0))
+
+    def close(self):
+        longest = max([length for name, length in self.contigs] or [0])
+        dtype = '<u4' if longest < 2 ** 32 else '<u8'
+        folder = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        try:
+            fasta = os.path.relpath(os.path.abspath(self.fasta), folder)
+        except ValueError:  # another drive on Windows
+            fasta = os.path.abspath(self.fasta)
+        header = json.dumps({'fasta': fasta.replace(os.sep, '/'), 'dtype': dtype,
+                             'contigs': self.contigs}).encode('utf-8')
+        with open(self.path + '.partial', 'wb') as f:
+            f.write(MAGIC + struct.pack('<II', self.block, len(header)) + header)
+            for totals in self.totals:
+                f.write(totals.astype(dtype).tobytes())
+        os.replace(self.path + '.partial', self.path)
+
+
+class CompositionCounts(object):
+    """Reads a sidecar written by CountsWriter.  Positions are 0-based and end is exclusive,
+    like Python slices.  contig is the contig number (an int) or its name (a str, even "1" is a name,
+    as in Ensembl and NCBI chromosome naming)."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, self.block, header_length = struct.unpack('<8sII', f.read(16))
+            if magic != MAGIC:
+                raise ValueError("%s is not a composition counts file" % path)
+            header = json.loads(f.read(header_length).decode('utf-8'))
+        self.fasta_path = os.path.join(os.path.dirname(path), *header['fasta'].split('/'))
+        self.names = [name for name, length in header['contigs']]
+        self.lengths = [length for name, length in header['contigs']]
+        self.indices = {}  # name -> first contig with that name
+        for i, name in enumerate(self.names):
+            self.indices.setdefault(name, i)
+        data = np.memmap(path, dtype=header['dtype'], mode='r', offset=16 + header_length)
+        self.totals, offset = [], 0
+        for length in self.lengths:
+            rows = -(-length // self.block) + 1
+            self.totals.append(data[offset: offset + rows * len(COUNTED)].reshape(rows, len(COUNTED)))
+            offset += rows * len(COUNTED)
+        self.fasta = None  # opened by the first sequence() call
+        self.sequences = {}  # contig index -> IndexedSequence
+        self.uneven = False
+        self.lock = threading.Lock()
+
+    def contig_index(self, contig):
+        if isinstance(contig, (int, np.integer)):
+            index = int(contig)
+            if not 0 <= index < len(self.names):
+                raise KeyError("No contig number %i" % index)
+            return index
+        if contig not in self.indices:
+            raise KeyError("No contig named %s" % contig)
+        return self.indices[contig]
+
+    def clamp(self, index, start, end):
+        length = self.lengths[index]
+        start = max(0, min(length, int(start)))
+        end = length if end is None else max(start, min(length, int(end)))
+        return start, end
+
+    def sequence(self, contig, start=0, end=None):
+        """Upper case sequence str from the indexed FASTA"""
+        index = self.contig_index(contig)
+        start, end = self.clamp(index, start, end)
+        with self.lock:
+            if self.fasta is None:
+                self.open_fasta()
+        return self.sequences[index][start: end]
+
+    def open_fasta(self):
+        fasta = IndexedFasta(self.fasta_path, allow_uneven=True)
+        by_header = {}  # repeated names are matched in order
+        for c in fasta.contigs():
+            by_header.setdefault(c.name, []).append(c.seq)
+        seen = {}
+        for i, name in enumerate(self.names):
+            occurrence = seen[name] = seen.get(name, -1) + 1
+            self.sequences[i] = by_header[name][occurrence]
+        self.uneven = any(getattr(seq, 'uneven', False) for seq in self.sequences.values())
+        if self.uneven:
+            print("Note: %s has uneven line lengths, sequence and composition queries decode whole "
+                  "contigs.  Reformatting it with even lines makes them much faster." % self.fasta_path)
+        self.fasta = fasta
+
+    def running_total(self, index, position):
+        """Counts of ACGTN before position"""
+        block = position // self.block
+        total = self.totals[index][block].astype(np.int64)
+        if position % self.block:
+            codes = as_codes(self.sequence(index, block * self.block, position))
+            total = total + block_counts(codes, self.block)[0]
+        return total
+
+    def counts(self, contig, start=0, end=None):
+        """{'A':, 'C':, 'G':, 'T':, 'N':, 'other':, 'length':} between start and end"""
+        index = self.contig_index(contig)
+        start, end = self.clamp(index, start, end)
+        counts = self.running_total(index, end) - self.running_total(index, start)
+        result = dict((base, int(count)) for base, count in zip(COUNTED, counts))
+        result['other'] = end - start - int(counts.sum())
+        result['length'] = end - start
+        return result
+
+    def close(self):
+        if self.fasta is not None:
+            self.fasta.close()
@@ -0,0 +1,137 @@
+"""Low zoom Deep Zoom levels computed from sequence composition instead of from pixels.
+Zoomed out, one pixel stands for thousands of nucleotides.  Rather than rendering every
+nucleotide and reducing the image level by level, the color sums of each nucleotide run that
+falls in one zoomed out pixel are added up straight from the sequence, so the low levels cost
+O(genome) and can be written before (or without) the full resolution image.
+
+Pixels are exact box averages of the full resolution image: nucleotide colors, the background
+in padding and margins, and titles, which are drawn on their own and added as the difference
+they make to the pixels under them.  TileLayout.draw_composition_levels() is the user."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import math
+import os
+
+import numpy as np
+from PIL import Image
+
+from FluentDNA.deepzoom import DZIDescriptor, TileSaver
+
+
+def composition_level_count(descriptor, min_bp_per_pixel):
+    """Number of levels, counting up from level 0, where one pixel covers at least min_bp_per_pixel
+    full resolution pixels, which is one nucleotide each.  The full resolution level never counts."""
+    if min_bp_per_pixel <= 0:
+        return 0
+    smallest_factor = int(math.ceil(math.log(min_bp_per_pixel, 4)))  # pixel covers 4 ** k pixels
+    return max(0, descriptor.num_levels - max(1, smallest_factor))
+
+
+def block_sums(pixels, x, y, factor):
+    """Sums of pixels (rows, columns, channels) in factor x factor blocks of the full image grid.
+    Returns the sums and the block column, row of the first one."""
+    height, width = pixels.shape[:2]
+    row_starts = np.unique(np.concatenate(([0], np.arange(-y % factor, height, factor))))
+    column_starts = np.unique(np.concatenate(([0], np.arange(-x % factor, width, factor))))
+    sums = np.add.reduceat(np.add.reduceat(pixels.astype(np.int64), row_starts, axis=0), column_starts, axis=1)
+    return sums, x // factor, y // factor
+
+
+class CompositionPyramid(object):
+    """Color sums for the pixels of one zoomed out level, factor full image pixels on a side.
+    Nucleotides and titles are added, then levels() averages in the background and yields
+    that level and every smaller one."""
+    def __init__(self, width, height, factor, layout_frame, background=(255, 255, 255)):
+        self.width, self.height = width, height
+        self.factor = factor
+        self.layout_frame = layout_frame
+        self.background = np.array(background, dtype=np.int64)
+        self.columns = -(-width // factor)
+        self.rows = -(-height // factor)
+        self.sums = np.zeros((self.rows * self.columns, len(background)), dtype=np.int64)
+        self.covered = np.zeros(self.rows * self.columns, dtype=np.int64)  # nucleotide pixels
+        self.title_changes = np.zeros((self.rows, self.columns, len(background)), dtype=np.int64)
+
+    def add_sequence(self, progress, codes, color_table):
+        """codes (uint8) laid out from progress on.  Every line of the layout is one row of
+        consecutive pixels, so only line starts need a position, and consecutive nucleotides
+        in the same zoomed out pixel are summed as one run."""
+        if not len(codes):
+            return
+        base_width = self.layout_frame.base_width
+        positions = np.arange(progress, progress + len(codes), dtype=np.int64)
+        lines = positions // base_width
+        first_line = lines[0]
+        line_x, line_y = self.layout_frame.positions_on_screen(
+            np.arange(first_line, lines[-1] + 1, dtype=np.int64) * base_width)
+        x = line_x[lines - first_line] + positions % base_width
+        y = line_y[lines - first_line]
+        pixel = (y // self.factor) * self.columns + x // self.factor
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(pixel)) + 1))
+        run_sums = np.add.reduceat(color_table[codes].astype(np.int64), starts, axis=0)
+        np.add.at(self.sums, pixel[starts], run_sums)
+        np.add.at(self.covered, pixel[starts], np.diff(np.concatenate((starts, [len(codes)]))))
+
+    def add_title(self, title, upper_left, underneath=None):
+        """title is the RGBA image TileLayout.write_title() pastes with itself as the mask.
+        underneath(xs, ys) gives the colors of the pixels it covers, by default the background."""
+        x, y = int(upper_left[0]), int(upper_left[1])
+        left, top = max(0, x), max(0, y)
+        right, bottom = min(self.width, x + title.width), min(self.height, y + title.height)
+        if right <= left or bottom <= top:
+            return
+        rgba = np.asarray(title.crop((left - x, top - y, right - x, bottom - y))).astype(np.int64)
+        ys, xs = np.nonzero(rgba[:, :, 3])
+        if not len(ys):
+            return
+        channels = len(self.background)
+        if underneath is None:
+            under = np.tile(self.background, (len(ys), 1))
+        else:
+            under = np.asarray(underneath(xs + left, ys + top), dtype=np.int64)
+        alpha = rgba[ys, xs, 3:]
+        pasted = (under * (255 - alpha) + rgba[ys, xs, :channels] * alpha + 127) // 255
+        changes = np.zeros((bottom - top, right - left, channels), dtype=np.int64)
+        changes[ys, xs] = pasted - under
+        sums, column, row = block_sums(changes, left, top, self.factor)
+        self.title_changes[row: row + sums.shape[0], column: column + sums.shape[1]] += sums
+
+    def levels(self):
+        """(factor, pixels) for this level and every level below it, each a (rows, columns,
+        channels) uint8 array.  Averages are over the part of each block inside the image."""
+        block_width = np.minimum(self.factor, self.width - np.arange(self.columns) * self.factor)
+        block_height = np.minimum(self.factor, self.height - np.arange(self.rows) * self.factor)
+        area = np.outer(block_height, block_width).astype(np.int64)
+        sums = self.sums.reshape(self.rows, self.columns, -1) + self.title_changes
+        sums += (area - self.covered.reshape(area.shape))[:, :, None] * self.background
+        factor = self.factor
+        while True:
+            yield factor, ((sums * 2 + area[:, :, None]) // (area[:, :, None] * 2)).astype(np.uint8)
+            if sums.shape[0] == 1 and sums.shape[1] == 1:
+                break
+            sums, _, _ = block_sums(sums, 0, 0, 2)
+            area = block_sums(area[:, :, None], 0, 0, 2)[0][:, :, 0]
+            factor *= 2
+
+
+def write_levels(pyramid, level_count, destination, width, height, tile_size=256, tile_overlap=1,
+                 tile_format="png", image_quality=0.95, compress_level=6, palette_tiles=False):
+    """Cuts tiles for Deep Zoom levels level_count - 1 down to 0 out of CompositionPyramid.levels().
+    The descriptor is left to whatever makes the higher levels."""
+    descriptor = DZIDescriptor(width=width, height=height, tile_size=tile_size,
+                               tile_overlap=tile_overlap, tile_format=tile_format)
+    image_files = os.path.splitext(destination)[0] + "_files"
+    tile_saver = TileSaver(tile_format, image_quality, compress_level, palette_tiles)
+    for level, (factor, pixels) in zip(reversed(range(level_count)), pyramid.levels()):
+        assert (pixels.shape[1], pixels.shape[0]) == descriptor.get_dimensions(level), "Level size mismatch"
+        level_dir = os.path.join(image_files, str(level))
+        if not os.path.isdir(level_dir):
+            os.makedirs(level_dir)
+        columns, rows = descriptor.get_num_tiles(level)
+        for row in range(rows):
+            for column in range(columns):
+                x1, y1, x2, y2 = descriptor.get_tile_bounds(level, column, row)
+                tile_saver.save(Image.fromarray(pixels[y1:y2, x1:x2]),
+                                os.path.join(level_dir, "%s_%s.%s" % (column, row, tile_format)))
+    tile_saver.report()
@@ -0,0 +1,259 @@
+"""Random access to FASTA files through a samtools style .fai byte offset index.
+The file is memory-mapped and each contig is exposed as an IndexedSequence, a lazy view
+that only reads the bytes that are sliced out of it.  A whole genome never needs to be
+resident as Python strings, the OS pages sequence in and out as layouts touch it.
+
+Index format (one line per contig, tab separated, identical to samtools faidx):
+    name    length    offset    line_bases    line_width
+
+Files with uneven line lengths can't be described by a .fai.  For streaming readers they
+can still be opened with a header/length scan (allow_uneven=True): those contigs are
+marked with line_bases == 0 and every read decodes the whole contig, which is fine when
+each contig is read exactly once, like the TileLayout draw pass.
+"""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import mmap
+import os
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+from DNASkittleUtils.Contigs import Contig, read_contigs
+
+FaiRecord = namedtuple('FaiRecord', ['name', 'length', 'offset', 'line_bases', 'line_width', 'end'])
+FaiRecord.__new__.__defaults__ = (None,)  # 'end' is not stored in .fai files
+
+
+class IrregularFastaError(ValueError):
+    """Raised when a FASTA file can't be described by a .fai index, usually because
+    sequence lines within one contig are not all the same length."""
+    pass
+
+
+def fai_path_for(fasta_path):
+    return fasta_path + '.fai'
+
+
+def build_fasta_index(fasta_path, allow_uneven=False):
+    """Scan the whole file once and return a list of FaiRecord.
+    Raises IrregularFastaError if the file can't be randomly accessed, unless allow_uneven
+    is set, in which case uneven contigs are returned with line_bases = 0."""
+    records = []
+    name, length, offset, line_bases, line_width = None, 0, 0, None, None
+    short_line_seen = False  # only the last line of a contig may be shorter
+    uneven = False
+    position = 0
+    with open(fasta_path, 'rb') as fasta:
+        for line in fasta:
+            line_start = position
+            position += len(line)
+            if line.startswith(b'>'):
+                if name is not None:
+                    records.append(_finish_record(name, length, offset, line_bases, line_width,
+                                                  uneven, line_start))
+                header = line[1:].decode('utf-8').strip()
+                name = header.split()[0] if header else ''
+                length, offset, line_bases, line_width = 0, position, None, None
+                short_line_seen, uneven = False, False
+                continue
+            if name is None:
+                if not line.strip():
+                    continue  # leading blank lines
+                raise IrregularFastaError("%s does not start with a '>' header" % fasta_path)
+            bases = line.rstrip(b'\r\n')
+            if not bases:
+                short_line_seen = True  # blank lines are only allowed after the sequence body
+                continue
+            if line_bases is None:
+                line_bases, line_width = len(bases), len(line)
+            elif short_line_seen or len(bases) > line_bases or \
+                    (len(bases) == line_bases and line.endswith(b'\n') and len(line) != line_width):
+                if not allow_uneven:
+                    raise IrregularFastaError("Uneven line lengths in %s at byte %i" % (fasta_path, line_start))
+                uneven = True
+            elif len(bases) < line_bases:
+                short_line_seen = True
+            length += len(bases)
+    if name is not None:
+        records.append(_finish_record(name, length, offset, line_bases, line_width, uneven, position))
+    return records
+
+
+def _finish_record(name, length, offset, line_bases, line_width, uneven, end):
+    if uneven:
+        line_bases, line_width = 0, 0
+    return FaiRecord(name, length, offset, line_bases or 0, line_width or 0, end)
+
+
+def read_fasta_index(fai_path):
+    records = []
+    with open(fai_path, 'r') as fai:
+        for line in fai:
+            columns = line.rstrip('\r\n').split('\t')
+            if len(columns) < 5:
+                continue
+            records.append(FaiRecord(columns[0], *[int(x) for x in columns[1:5]]))
+    return records
+
+
+def write_fasta_index(fai_path, records):
+    with open(fai_path, 'w') as fai:
+        for r in records:
+            fai.write('%s\t%i\t%i\t%i\t%i\n' % r[:5])
+
+
+def fasta_index(fasta_path, allow_uneven=False):
+    """Reuses an existing .fai if it is newer than the FASTA, otherwise builds one and
+    tries to save it next to the FASTA for next time.  Uneven files fall back to a
+    header/length scan when allow_uneven is set.  The scan can't be saved as a .fai."""
+    fai_path = fai_path_for(fasta_path)
+    if os.path.exists(fai_path) and os.path.getmtime(fai_path) >= os.path.getmtime(fasta_path):
+        return read_fasta_index(fai_path)
+    start_time = datetime.now()
+    try:
+        records = build_fasta_index(fasta_path)
+    except IrregularFastaError as e:
+        if not allow_uneven:
+            raise
+        print("Note: %s  Contigs with uneven lines will be read whole." % e, file=sys.stderr)
+        return build_fasta_index(fasta_path, allow_uneven=True)
+    try:
+        write_fasta_index(fai_path, records)
+        print("Indexed %i contigs in %s:" % (len(records), fai_path), datetime.now() - start_time)
+    except (IOError, OSError):
+        pass  # read only directory, the index just won't be reused
+    return records
+
+
+def map_fasta(fasta_path):
+    with open(fasta_path, 'rb') as fasta:  # mmap keeps its own handle
+        return mmap.mmap(fasta.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class IndexedSequence(object):
+    """Lazy, read-only view of one contig inside a memory-mapped FASTA.  Slicing returns
+    upper case str, the same as DNASkittleUtils.Contigs.read_contigs() would have stored.
+    fetch_bytes() skips the str conversion for renderers that work on raw bytes."""
+    def __init__(self, mapped_file, record, fasta_path=None):
+        self.mapped_file = mapped_file
+        self.record = record
+        self.fasta_path = fasta_path  # lets another process map the same contig
+        self.length = record.length
+        self.uneven = record.line_bases == 0 and record.length > 0
+
+    def __len__(self):
+        return self.length
+
+    def _byte_offset(self, index):
+        r = self.record
+        return r.offset + (index // r.line_bases) * r.line_width + index % r.line_bases
+
+    def fetch_bytes(self, start=0, end=None):
+        """Upper case sequence bytes between start and end with newlines removed."""
+        end = self.length if end is None else min(end, self.length)
+        start = max(0, start)
+        if end <= start:
+            return b''
+        if self.uneven:  # no random access, decode the whole contig
+            raw = self.mapped_file[self.record.offset: self.record.end]
+            return raw.translate(None, b'\r\n').upper()[start: end]
+        raw = self.mapped_file[self._byte_offset(start): self._byte_offset(end - 1) + 1]
+        return raw.translate(None, b'\r\n').upper()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step == 1:
+                return self.fetch_bytes(start, stop).decode('latin-1')
+            return ''.join(self[i] for i in range(start, stop, step))  # rare, not optimized
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("Sequence index %i out of range for %s" % (key, self.record.name))
+        if self.uneven:
+            return self[key: key + 1]
+        return chr(self.mapped_file[self._byte_offset(key)]).upper()
+
+    def __iter__(self):
+        block = self.length if self.uneven else 1024 * 1024
+        for start in range(0, self.length, block):
+            for c in self[start: start + block]:
+                yield c
+
+    def __str__(self):
+        return self[:]
+
+    def __repr__(self):
+        return '<IndexedSequence "%s" %i nucleotides>' % (self.record.name, self.length)
+
+
+class IndexedFasta(object):
+    """Opens a FASTA through its .fai index.  contigs() returns DNASkittleUtils Contig
+    objects whose .seq is an IndexedSequence, so they can be used anywhere read_contigs()
+    output is used."""
+    def __init__(self, fasta_path, allow_uneven=False):
+        self.path = fasta_path
+        self.records = fasta_index(fasta_path, allow_uneven)
+        self.mapped_file = map_fasta(fasta_path)
+
+    def header(self, record):
+        """Full header line (without '>') which read_contigs() uses as the contig name.
+        The .fai only stores the first word."""
+        line_start = self.mapped_file.rfind(b'\n', 0, record.offset - 1) + 1
+        return self.mapped_file[line_start + 1: record.offset].decode('utf-8').rstrip('\r\n')
+
+    def sequence(self, record):
+        return IndexedSequence(self.mapped_file, record, self.path)
+
+    def contigs(self):
+        # read_contigs() drops empty entries except for the last one
+        last = len(self.records) - 1
+        return [Contig(self.header(r), self.sequence(r)) for i, r in enumerate(self.records)
+                if r.length or i == last]
+
+    def find(self, contig_name):
+        """First contig whose full header matches, ignoring case and trailing spaces, like
+        pluck_contig().  The first word alone doesn't match: "chr1" isn't ">chr1 extra"."""
+        target = contig_name.upper()
+        for r in self.records:
+            if self.header(r).rstrip().upper() == target:
+                return self.sequence(r)
+        raise IOError("Contig not found." + '>' + contig_name + "   inside " + self.path)
+
+    def close(self):
+        self.mapped_file.close()
+
+
+def has_non_ascii(file_path, chunk_size=16 * 1024 * 1024):
+    """True if any byte of the file is above 127, meaning it isn't a text FASTA.  The index
+    reads sequence as latin-1, which never fails, so binary files have to be caught here."""
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            if not chunk.isascii():
+                return True
+    return False
+
+
+def read_contigs_indexed(input_file_path, streaming=False):
+    """Drop in replacement for read_contigs() that returns lazy memory-mapped contigs.
+    Falls back to reading everything into memory when the file can't be indexed.
+    :param streaming: the caller reads each contig once, front to back, so files with
+    uneven line lengths can be opened by a header/length scan instead of read whole."""
+    try:
+        return IndexedFasta(input_file_path, allow_uneven=streaming).contigs()
+    except ValueError as e:  # IrregularFastaError, UnicodeDecodeError or mmap of an empty file
+        print("Note: Unable to index %s, reading the whole file into memory.  %s" % (input_file_path, e),
+              file=sys.stderr)
+        return read_contigs(input_file_path)
+
+
+def pluck_contig_indexed(chromosome_name, genome_source):
+    """Same as DNASkittleUtils.Contigs.pluck_contig() but only maps the one contig."""
+    try:
+        fasta = IndexedFasta(genome_source)
+    except ValueError:
+        from DNASkittleUtils.Contigs import pluck_contig
+        return pluck_contig(chromosome_name, genome_source)
+    return fasta.find(chromosome_name)
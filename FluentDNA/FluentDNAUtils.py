@@ -8,9 +8,10 @@ import textwrap
 from collections import defaultdict
 from datetime import datetime
 
-from DNASkittleUtils.Contigs import read_contigs
 from PIL import ImageDraw
 
+from FluentDNA.FastaIndex import read_contigs_indexed
+
 
 class keydefaultdict(defaultdict):
     """https://stackoverflow.com/a/2912455/3067894"""
@@ -65,19 +66,29 @@ def filter_by_contigs(unfiltered, extract_contigs):
 def read_contigs_to_dict(input_file_path, extract_contigs=None):
     print("Reading contigs... ", input_file_path)
     start_time = datetime.now()
-    contig_list = read_contigs(input_file_path)
+    contig_list = read_contigs_indexed(input_file_path)
     contig_list = filter_by_contigs(contig_list, extract_contigs)
     contig_dict = {c.name.lower(): c.seq for c in contig_list}  # capitalization!!!!
     print("Read %i FASTA Contigs in:" % len(contig_dict), datetime.now() - start_time)
     return contig_dict
 
 
-def create_deepzoom_stack(input_image, output_dzi):
+def create_deepzoom_stack(input_image, output_dzi, workers=1, tile_format="png", compress_level=6,
+                          palette_tiles=False, resume=False, lowest_level=0):
+    """:param input_image: file path, or the image itself (PIL image, MemmapCanvas or numpy array)
+    :param workers: number of processes encoding tiles
+    :param resume: continue from the tiles an interrupted run recorded in <output_dzi>_progress.json
+    :param lowest_level: levels below this were already written, e.g. by TileLayout.draw_composition_levels()
+    The other options are described in deepzoom.TileSaver and docs/tile_encoding.md"""
     import FluentDNA.deepzoom
     creator = FluentDNA.deepzoom.ImageCreator(tile_size=256,
                                     tile_overlap=1,
-                                    tile_format="png",
-                                    resize_filter="antialias")# cubic bilinear bicubic nearest antialias
+                                    tile_format=tile_format,
+                                    workers=workers,
+                                    compress_level=compress_level,
+                                    palette_tiles=palette_tiles,
+                                    resume=resume,
+                                    lowest_level=lowest_level)
     creator.create(input_image, output_dzi)
 
 
@@ -1,6 +1,7 @@
 import traceback
 
 import sys
+import numpy as np
 from PIL import Image, ImageFont
 
 from FluentDNA.Annotations import GFFAnnotation, find_universal_prefix, GFF3Record, parseGFF
@@ -20,7 +21,8 @@ def blend_pixel(markup_canvas, pt, c, overwrite=False):
 def annotation_points(entry, renderer, start_offset):
     # important to include title and reset padding in coordinate frame
     # TODO use unsigned shorts (max 65535) for memory
-    annotation_points = tuple(renderer.position_on_screen(i + start_offset) for i in range(entry.start, entry.end))
+    xs, ys = renderer.positions_on_screen(np.arange(entry.start, entry.end) + start_offset)
+    annotation_points = tuple(zip(xs.tolist(), ys.tolist()))
 
     return annotation_points
 
@@ -55,6 +57,8 @@ class HighlightedAnnotation(TileLayout):
 
     def draw_extras(self):
         """Drawing Annotations labels and shadow outlines"""
+        if any(a is not None for a in (self.annotation, self.query_annotation, self.repeat_annotation)):
+            self.expand_canvas()  # highlights blend with the nucleotide colors
 
         positions = self.contig_struct()
         for sc_index, coordinate_frame in enumerate(positions):  # Exact match required (case sensitive)
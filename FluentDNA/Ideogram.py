@@ -14,8 +14,8 @@ try e.g. python3 Ideogram.py -x 3 3 3 -y 3 3 3
 import sys
 from itertools import chain
 
-from DNASkittleUtils.Contigs import read_contigs
 
+from FluentDNA.FastaIndex import read_contigs_indexed
 from FluentDNA.FluentDNAUtils import beep
 from FluentDNA.HighlightedAnnotation import HighlightedAnnotation
 import os
@@ -28,6 +28,7 @@ from FluentDNA.Layouts import LayoutFrame, LayoutLevel
 class IdeogramCoordinateFrame(LayoutFrame):
     def __init__(self, x_radices, y_radices, x_scale, y_scale, border_width):
         self.point_mapping = [] # for annotation and testing purposes
+        self.point_array = None  # numpy copy of point_mapping for positions_on_screen()
         self.origin = (border_width, border_width)
         self.fibre_padding = 3
         self.x_radices = x_radices
@@ -121,6 +122,31 @@ class IdeogramCoordinateFrame(LayoutFrame):
     def relative_position(self, progress):
         return self.point_mapping[progress]
 
+    def progress_at_points(self, x, y):
+        """Port of peano_mouse_position() in nucleotideNumber.js.  Same as the tiled version
+        except that odd increments flip the direction of the next axis."""
+        remaining = [np.array(x, dtype=np.int64) - self.origin[0], np.array(y, dtype=np.int64) - self.origin[1]]
+        progress = np.zeros(remaining[0].shape, dtype=np.int64)
+        valid = (remaining[0] >= 0) & (remaining[1] >= 0)
+        axis_flipped = [np.zeros(progress.shape, dtype=bool), np.zeros(progress.shape, dtype=bool)]
+        for i in range(len(self.levels) - 1, -1, -1):
+            level = self.levels[i]
+            part = i % 2
+            full_increments = remaining[part] // level.thickness
+            relative_progress = np.where(axis_flipped[part], level.modulo - full_increments - 1, full_increments)
+            progress += level.chunk_size * relative_progress
+            remaining[part] -= full_increments * level.thickness
+            axis_flipped[(part + 1) % 2] ^= full_increments % 2 == 1  # XOR stacks recursive flips
+            if i != 1:
+                valid &= (remaining[part] < level.thickness - level.padding) | (remaining[part] >= level.thickness)
+        return np.where(valid, progress, -1)
+
+    def relative_positions(self, progress):
+        if self.point_array is None or len(self.point_array) != len(self.point_mapping):
+            self.point_array = np.array(self.point_mapping, dtype=np.int64).reshape(-1, 2)
+        xy = self.point_array[np.asarray(progress, dtype=np.int64)]
+        return xy[..., 0], xy[..., 1]
+
 
     def handle_multi_column_annotations(self, start, stop):
         """In 2D fractal layout, this method is much simpler since there's no columns per se.
@@ -200,7 +226,7 @@ class Ideogram(HighlightedAnnotation):
     def process_file(self, input_file_path, output_folder, output_file_name,
                      no_webpage=False, extract_contigs=None):
         if extract_contigs is None:
-            contigs = read_contigs(input_file_path)
+            contigs = read_contigs_indexed(input_file_path)
             extract_contigs = [contigs[0].name.split()[0]]
             print("Extracting ", extract_contigs)
 
@@ -1,4 +1,8 @@
 import sys
+from bisect import bisect_right
+from collections import namedtuple
+
+import numpy as np
 from PIL import Image, ImageDraw
 from FluentDNA.FluentDNAUtils import multi_line_height
 
@@ -72,6 +76,42 @@ class LayoutFrame(list):
         xy = self.relative_position(progress)
         return xy[0] + self.origin[0], xy[1] + self.origin[1]
 
+    def relative_positions(self, progress):
+        """Vectorized relative_position() for an array of progress values.
+        Returns x and y as int64 arrays of the same shape."""
+        progress = np.asarray(progress, dtype=np.int64)
+        xy = [np.zeros(progress.shape, dtype=np.int64), np.zeros(progress.shape, dtype=np.int64)]
+        for i, level in enumerate(self.levels):
+            xy[i % 2] += level.thickness * (progress // level.chunk_size % level.modulo)
+        return xy[0], xy[1]
+
+    def positions_on_screen(self, progress):
+        """Vectorized position_on_screen(): x and y arrays for a whole region in one call"""
+        x, y = self.relative_positions(progress)
+        return x + self.origin[0], y + self.origin[1]
+
+    def progress_at(self, x, y):
+        """Inverse of position_on_screen().  Returns None if x, y is in a margin."""
+        progress = int(self.progress_at_points([x], [y])[0])
+        return progress if progress >= 0 else None
+
+    def progress_at_points(self, x, y):
+        """Vectorized progress_at(), -1 where the pixel is in a margin.
+        Port of tiled_layout_mouse_position() in nucleotideNumber.js"""
+        remaining = [np.array(x, dtype=np.int64) - self.origin[0], np.array(y, dtype=np.int64) - self.origin[1]]
+        progress = np.zeros(remaining[0].shape, dtype=np.int64)
+        valid = (remaining[0] >= 0) & (remaining[1] >= 0)
+        for i in range(len(self.levels) - 1, -1, -1):
+            level = self.levels[i]
+            part = i % 2
+            full_increments = remaining[part] // level.thickness
+            # add total nucleotide size for every full increment of this level e.g. Tile Y height
+            progress += level.chunk_size * full_increments
+            remaining[part] -= full_increments * level.thickness
+            if i != 1:  # check for invalid coordinate (margins)
+                valid &= (remaining[part] < level.thickness - level.padding) | (remaining[part] >= level.thickness)
+        return np.where(valid, progress, -1)
+
 
     def handle_multi_column_annotations(coord_frame, start, stop):
         interval = abs(stop - start)
@@ -131,6 +171,53 @@ class LayoutFrame(list):
 
 
 
+SequencePosition = namedtuple('SequencePosition', ['contig_index', 'contig_name', 'index_inside_contig', 'in_title'])
+
+
+class ContigSpacing(object):
+    """Sorted table of where each contig lands in layout progress, for going from a pixel
+    back to a contig.  Python version of nucleotide_coordinates_to_sequence_index()."""
+    def __init__(self, names, title_starts, seq_starts, seq_ends):
+        self.names = names
+        self.title_starts = np.asarray(title_starts, dtype=np.int64)
+        self.seq_starts = np.asarray(seq_starts, dtype=np.int64)
+        self.seq_ends = np.asarray(seq_ends, dtype=np.int64)
+
+    def resolve(self, progress):
+        """SequencePosition for one progress value, or None if it's between contigs.
+        index_inside_contig is 0 based."""
+        if progress is None:
+            return None
+        i = bisect_right(self.seq_ends, progress)  # first contig that ends after progress
+        if i == len(self.seq_ends) or progress < self.title_starts[i]:
+            return None
+        if progress < self.seq_starts[i]:  # cursor is in the label
+            return SequencePosition(i, self.names[i], 0, True)
+        return SequencePosition(i, self.names[i], int(progress - self.seq_starts[i]), False)
+
+    def resolve_all(self, progress):
+        """Vectorized resolve().  Returns contig_index, index_inside_contig and in_title arrays,
+        contig_index is -1 where there is no contig."""
+        progress = np.asarray(progress, dtype=np.int64)
+        index = np.searchsorted(self.seq_ends, progress, side='right')
+        found = (index < len(self.seq_ends)) & (progress >= 0)
+        safe = np.minimum(index, len(self.seq_ends) - 1)
+        found &= progress >= self.title_starts[safe]
+        in_title = found & (progress < self.seq_starts[safe])
+        index_inside_contig = np.where(found & ~in_title, progress - self.seq_starts[safe], 0)
+        return np.where(found, index, -1), index_inside_contig, in_title
+
+
+def contig_spacing_from_contigs(contigs):
+    """ContigSpacing from contigs that have been through TileLayout.calc_all_padding()"""
+    lengths = np.array([len(c.seq) for c in contigs], dtype=np.int64)
+    title = np.array([c.title_padding for c in contigs], dtype=np.int64)
+    before = np.array([c.reset_padding for c in contigs], dtype=np.int64) + title
+    after = lengths + np.array([c.tail_padding for c in contigs], dtype=np.int64)
+    seq_starts = np.cumsum(before) + np.concatenate(([0], np.cumsum(after)[:-1]))
+    return ContigSpacing([c.name for c in contigs], seq_starts - title, seq_starts, seq_starts + lengths)
+
+
 def level_layout_factory(modulos, padding, origin):
     # noinspection PyListCreation
     levels = [
@@ -23,7 +23,8 @@ def fastas_in_folder(input_fasta_folder):
     if not os.path.isdir(input_fasta_folder) and os.path.exists(input_fasta_folder):
         return [input_fasta_folder]
     else:
-        return list(natsorted(glob(os.path.join(input_fasta_folder, '*.fa*'))))
+        return list(natsorted(f for f in glob(os.path.join(input_fasta_folder, '*.fa*'))
+                              if not f.endswith('.fai')))  # skip FastaIndex files
 
 
 
@@ -220,6 +221,8 @@ class MultipleAlignmentLayout(TileLayout):
         else:
             for single_MSA in files:
                 self.read_contigs_and_calc_padding(single_MSA, None)
+                for contig in self.contigs:  # small files: don't hold one memory map open per file
+                    contig.seq = contig.seq[:]
                 fasta_name = os.path.basename(single_MSA)
                 self.fasta_sources.append(fasta_name)
                 self.all_contents[fasta_name] = self.contigs  # store contigs so the can be wiped
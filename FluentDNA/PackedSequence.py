@@ -0,0 +1,255 @@
+"""Compact sequence containers backed by numpy.uint8 arrays instead of Python str.
+PackedSequence stores one byte per nucleotide and hands out zero-copy views for slices
+and reverse complements, so ChainParser no longer needs a full copy of each reverse strand.
+TwoBitSequence packs four nucleotides per byte with a side table for runs of anything
+that isn't ACGT (mostly N's), for keeping whole genomes resident.
+SequenceBuffer is the growable one byte per character replacement for editable_str().
+
+Slicing any of them with [start:end] returns a plain str, so they can be used anywhere a
+Contig.seq string is expected.  The .codes array is there for vectorized work.
+"""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+from array import array
+
+import numpy as np
+from DNASkittleUtils.Contigs import write_complete_fasta
+
+from FluentDNA import gap_char
+
+
+def _lookup_table(pairs, default=None):
+    table = np.arange(256, dtype=np.uint8) if default is None else np.full(256, default, dtype=np.uint8)
+    for key, value in pairs:
+        table[ord(key)] = value
+    return table
+
+
+# Same pairs as DNASkittleUtils.DDVUtils.nucleotide_complements, everything else maps to itself
+COMPLEMENT = _lookup_table([(a, ord(b)) for a, b in zip('ACGTNX', 'TGCANX')])
+TWO_BIT_LETTERS = np.frombuffer(b'ACGT', dtype=np.uint8)
+TWO_BIT_VALUES = _lookup_table(zip('ACGT', range(4)), default=0)
+IS_TWO_BIT = _lookup_table(zip('ACGT', [1] * 4), default=0).astype(bool)
+
+
+def as_codes(seq):
+    """uint8 array for any sequence type used in FluentDNA.  Shares memory when possible."""
+    if isinstance(seq, (PackedSequence, TwoBitSequence, SequenceBuffer)):
+        return seq.values()
+    if isinstance(seq, np.ndarray):
+        return seq
+    if hasattr(seq, 'fetch_bytes'):  # FastaIndex.IndexedSequence
+        return np.frombuffer(seq.fetch_bytes(), dtype=np.uint8)
+    if isinstance(seq, array):  # editable_str()
+        seq = seq.tounicode()
+    if isinstance(seq, str):
+        seq = seq.encode('latin-1')
+    return np.frombuffer(bytes(seq), dtype=np.uint8)
+
+
+def as_packed(seq):
+    if isinstance(seq, PackedSequence):
+        return seq
+    return PackedSequence(as_codes(seq))
+
+
+def decode(codes):
+    return codes.tobytes().decode('latin-1')
+
+
+class PackedSequence(object):
+    """One byte per nucleotide.  Slices and reverse complements are views that share the
+    same memory, complementing happens as bytes are read out."""
+    def __init__(self, codes, complemented=False):
+        self.codes = codes  # numpy.uint8, possibly a reversed view
+        self.complemented = complemented
+
+    def __len__(self):
+        return len(self.codes)
+
+    def values(self):
+        """Actual nucleotide codes.  This is a copy for reverse complement views."""
+        return COMPLEMENT[self.codes] if self.complemented else self.codes
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            piece = self.codes[key]
+            return decode(COMPLEMENT[piece] if self.complemented else piece)
+        c = self.codes[key]
+        return chr(COMPLEMENT[c] if self.complemented else c)
+
+    def __iter__(self):
+        block = 1024 * 1024
+        for start in range(0, len(self), block):
+            for c in self[start: start + block]:
+                yield c
+
+    def view(self, start, end):
+        return PackedSequence(self.codes[start: end], self.complemented)
+
+    def reverse_complement(self):
+        return PackedSequence(self.codes[::-1], not self.complemented)
+
+    def matches(self, other):
+        """Vectorized comparison: boolean array that is True where both sequences have the
+        same letter.  Stops at the end of the shorter sequence."""
+        a, b = self.values(), as_codes(other)
+        length = min(len(a), len(b))
+        return a[:length] == b[:length]
+
+    def count(self, letter):
+        code = COMPLEMENT[ord(letter)] if self.complemented else ord(letter)
+        return int(np.count_nonzero(self.codes == code))
+
+    def pack_2bit(self):
+        return TwoBitSequence.from_codes(self.values())
+
+    def tobytes(self):
+        return self.values().tobytes()
+
+    def __str__(self):
+        return self[:]
+
+    def __repr__(self):
+        return '<PackedSequence %i nucleotides%s>' % (len(self), ' (reverse complement)' * self.complemented)
+
+
+class TwoBitSequence(object):
+    """Four nucleotides per byte.  Runs of any other letter (N, gaps, IUPAC codes) are kept
+    in a side table of (start, end, letter) and written back over the ACGT bits on read."""
+    def __init__(self, packed, length, run_starts, run_ends, run_letters):
+        self.packed = packed
+        self.length = length
+        self.run_starts = run_starts
+        self.run_ends = run_ends
+        self.run_letters = run_letters
+
+    @staticmethod
+    def from_codes(codes):
+        codes = as_codes(codes)
+        length = len(codes)
+        others = np.flatnonzero(~IS_TWO_BIT[codes])
+        if len(others):  # a new run starts wherever the position jumps or the letter changes
+            breaks = np.flatnonzero((np.diff(others) != 1) | (np.diff(codes[others]) != 0)) + 1
+            run_starts = others[np.concatenate(([0], breaks))]
+            run_ends = others[np.concatenate((breaks - 1, [len(others) - 1]))] + 1
+        else:
+            run_starts = run_ends = np.zeros(0, dtype=np.int64)
+        bits = np.zeros(-(-length // 4) * 4, dtype=np.uint8)
+        bits[:length] = TWO_BIT_VALUES[codes]
+        packed = (bits[0::4] << 6) | (bits[1::4] << 4) | (bits[2::4] << 2) | bits[3::4]
+        return TwoBitSequence(packed, length, run_starts, run_ends, codes[run_starts].copy())
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes + self.run_starts.nbytes + self.run_ends.nbytes + self.run_letters.nbytes
+
+    def values(self, start=0, end=None):
+        """Unpacked uint8 codes between start and end"""
+        end = self.length if end is None else min(end, self.length)
+        start = max(0, start)
+        if end <= start:
+            return np.zeros(0, dtype=np.uint8)
+        first_byte = start // 4
+        chunk = self.packed[first_byte: (end + 3) // 4]
+        bits = np.empty((len(chunk), 4), dtype=np.uint8)
+        for column, shift in enumerate((6, 4, 2, 0)):
+            bits[:, column] = (chunk >> shift) & 3
+        offset = first_byte * 4
+        codes = TWO_BIT_LETTERS[bits.ravel()[start - offset: end - offset]]
+        first_run = np.searchsorted(self.run_ends, start, side='right')
+        last_run = np.searchsorted(self.run_starts, end, side='left')
+        for i in range(first_run, last_run):
+            codes[max(self.run_starts[i], start) - start: min(self.run_ends[i], end) - start] = self.run_letters[i]
+        return codes
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step == 1:
+                return decode(self.values(start, stop))
+            return self.to_packed()[key]
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("Sequence index %i out of range" % key)
+        return chr(self.values(key, key + 1)[0])
+
+    def to_packed(self):
+        return PackedSequence(self.values())
+
+    def __str__(self):
+        return self[:]
+
+    def __repr__(self):
+        return '<TwoBitSequence %i nucleotides in %i bytes>' % (self.length, self.nbytes)
+
+
+class SequenceBuffer(object):
+    """Growable, editable sequence at one byte per character.  Accepts str on extend and
+    item assignment like editable_str(), which used two to four bytes per character."""
+    def __init__(self, initial=''):
+        self.data = bytearray()
+        self.extend(initial)
+
+    def extend(self, seq):
+        if isinstance(seq, str):
+            self.data.extend(seq.encode('latin-1'))
+        elif isinstance(seq, SequenceBuffer):
+            self.data.extend(seq.data)
+        else:
+            self.data.extend(as_codes(seq).tobytes())
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.data[key].decode('latin-1')
+        return chr(self.data[key])
+
+    def __setitem__(self, key, value):
+        self.data[key] = ord(value)
+
+    def values(self):
+        """Copy of the contents as a uint8 array.  A copy so the buffer can keep growing."""
+        return np.frombuffer(self.data, dtype=np.uint8).copy()
+
+    def packed(self):
+        return PackedSequence(self.values())
+
+    def __str__(self):
+        return self.data.decode('latin-1')
+
+    def __repr__(self):
+        return '<SequenceBuffer %i characters>' % len(self)
+
+
+def write_complete_fasta_packed(file_path, seq):
+    """write_complete_fasta() for any sequence type.  It only checks the first character
+    for an existing header, so it's passed separately."""
+    text = str(seq) if not isinstance(seq, array) else seq.tounicode()
+    write_complete_fasta(file_path, [text[:1], text[1:]])
+
+
+def sequence_positions(codes):
+    """Indices of every sequence character, skipping newlines and '>' or ';' header lines.
+    Vectorized version of walking a gapped FASTA with ChainParser.scan_past_header()."""
+    codes = as_codes(codes)
+    is_newline = codes == ord('\n')
+    newlines = np.flatnonzero(is_newline)
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_starts = line_starts[line_starts < len(codes)]
+    first_letters = codes[line_starts]
+    is_header = np.zeros(len(newlines) + 1, dtype=bool)
+    is_header[:len(line_starts)] = (first_letters == ord('>')) | (first_letters == ord(';'))
+    line_number = np.cumsum(is_newline) - is_newline
+    return np.flatnonzero(~is_newline & ~is_header[line_number])
+
+
+def gap_codes(length):
+    return np.full(length, ord(gap_char), dtype=np.uint8)
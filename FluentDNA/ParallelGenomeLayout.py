@@ -181,5 +181,5 @@ class ParallelLayout(TileLayout):
         return reset_padding, title_padding, tail
 
 
-    def draw_title(self, total_progress, contig):
-        super(ParallelLayout, self).draw_title(total_progress, contig)
+    def draw_title(self, total_progress, contig, canvas=None):
+        super(ParallelLayout, self).draw_title(total_progress, contig, canvas)
@@ -0,0 +1,320 @@
+"""HTTP server for the FluentDNA results folder used by run_server().  It is the standard
+library file server with what a Deep Zoom viewer needs over a slow network:
+  * one thread per connection and HTTP/1.1 keep-alive, for the dozens of tile requests a pan makes
+  * ETag and Last-Modified, answering If-None-Match / If-Modified-Since with 304 Not Modified
+  * single byte Range requests (206 Partial Content), with If-Range
+  * precompressed files: x.gz is sent for x to clients that accept gzip (see precompress())
+  * files that were moved into a tiles.pack (see TilePack.py) are answered under their original URLs
+  * <result>/api/sequence and <result>/api/composition, with the parameters
+    source (the FASTA file name in chunks/), contig (the name) or index (the contig number, counting
+    from 0 in file order), start and end (0-based, end exclusive).  sequence is plain text from the indexed FASTA, composition is the JSON counts of
+    A, C, G, T, N and other letters from the sources/<fasta>.counts sidecar in CompositionCounts.py.
+Start it on its own with:  python -m FluentDNA.ResultsServer [--host 0.0.0.0] [--port 8000] [folder]"""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import gzip
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import zlib
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from io import BytesIO
+
+try:
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:  # Python 2
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+
+from FluentDNA.CompositionCounts import CompositionCounts, composition_counts_path
+from FluentDNA.TilePack import TilePack, find_pack
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+API = re.compile(r'^(.*)/api/(sequence|composition)$')
+MAX_SEQUENCE = 16 * 1024 * 1024  # longest range api/sequence returns
+PRECOMPRESSED = ('.json', '.js', '.css', '.txt', '.xml', '.bin')  # types precompress() gzips by default, not the large sources/*.fa
+
+
+class Resource(object):
+    """What a request resolved to: an open file, its size and validators"""
+    def __init__(self, stream, size, mtime, etag, content_type, encoding=None):
+        self.stream = stream
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.content_type = content_type
+        self.encoding = encoding  # 'gzip' for a precompressed copy
+
+
+class ResultsRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, every response has a Content-Length
+    packs = {}  # pack path -> TilePack, opened once and shared by every request
+    packs_lock = threading.Lock()
+    counts = {}  # sidecar path -> (mtime, CompositionCounts)
+    counts_lock = threading.Lock()
+
+    def server_root(self):
+        return getattr(self, 'directory', None) or os.getcwd()
+
+    def open_pack(self, pack_path):
+        with self.packs_lock:
+            if pack_path not in self.packs:
+                self.packs[pack_path] = TilePack(pack_path)
+            return self.packs[pack_path]
+
+    def open_counts(self, counts_path):
+        mtime = os.path.getmtime(counts_path)
+        with self.counts_lock:
+            if counts_path not in self.counts or self.counts[counts_path][0] != mtime:
+                self.counts[counts_path] = (mtime, CompositionCounts(counts_path))
+            return self.counts[counts_path][1]
+
+    def send_head(self):
+        self.send_length = None
+        api = API.match(urlsplit(self.path).path)
+        if api:
+            resource = self.api_resource(self.translate_path(api.group(1) + '/'), api.group(2))
+            return None if resource is None else self.send_resource(resource)
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or path.endswith('/'):
+            return SimpleHTTPRequestHandler.send_head(self)  # redirects, index.html and listings
+        resource = self.find_resource(path)
+        if resource is None:
+            self.send_error(404, "File not found")
+            return None
+        return self.send_resource(resource)
+
+    def find_resource(self, path):
+        content_type = self.guess_type(path)
+        if self.accepts_gzip() and 'Range' not in self.headers and os.path.isfile(path + '.gz'):
+            return self.file_resource(path + '.gz', content_type, 'gzip')
+        if os.path.isfile(path):
+            return self.file_resource(path, content_type)
+        if os.path.isfile(path + '.gz'):  # only the compressed copy was kept
+            with gzip.open(path + '.gz', 'rb') as f:
+                data = f.read()
+            stat = os.stat(path + '.gz')
+            return Resource(BytesIO(data), len(data), stat.st_mtime,
+                            '"%x-%x-d"' % (int(stat.st_mtime * 1000), stat.st_size), content_type)
+        pack_path = find_pack(path, self.server_root())
+        if pack_path is not None:
+            name = os.path.relpath(path, os.path.dirname(pack_path)).replace(os.sep, '/')
+            pack = self.open_pack(pack_path)
+            if name in pack:
+                data = pack.read(name)
+                offset, length = pack.entries[name]
+                mtime = os.path.getmtime(pack.path)
+                return Resource(BytesIO(data), len(data), mtime,
+                                '"%x-%x-%x"' % (int(mtime * 1000), offset, length), content_type)
+        return None
+
+    def api_resource(self, result_dir, endpoint):
+        query = dict((key, values[-1]) for key, values in parse_qs(urlsplit(self.path).query).items())
+        source = query.get('source', '')
+        counts_path = composition_counts_path(result_dir, source)
+        if not source or source != os.path.basename(source) or not os.path.isfile(counts_path):
+            self.send_error(404, "No sequence data for source '%s'" % source)
+            return None
+        try:
+            counts = self.open_counts(counts_path)
+            if 'index' in query:
+                index = counts.contig_index(int(query['index']))
+            else:
+                index = counts.contig_index(query.get('contig', ''))
+            start, end = counts.clamp(index, query.get('start', 0), query.get('end'))
+            if endpoint == 'sequence':
+                if end - start > MAX_SEQUENCE:
+                    self.send_error(400, "At most %i bp of sequence per request" % MAX_SEQUENCE)
+                    return None
+                data = counts.sequence(index, start, end).encode('latin-1')
+                content_type = 'text/plain'
+            else:
+                result = counts.counts(index, start, end)
+                result.update(contig=counts.names[index], start=start, end=end)
+                data = json.dumps(result, sort_keys=True).encode('utf-8')
+                content_type = 'application/json'
+        except KeyError as e:
+            self.send_error(404, str(e.args[0]))
+            return None
+        except (ValueError, IOError, OSError) as e:
+            self.send_error(400, str(e))
+            return None
+        mtime = os.path.getmtime(counts_path)
+        return Resource(BytesIO(data), len(data), mtime,
+                        '"%x-%x-%x"' % (int(mtime * 1000), len(data), zlib.crc32(data) & 0xffffffff), content_type)
+
+    def file_resource(self, path, content_type, encoding=None):
+        try:
+            stream = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+        stat = os.fstat(stream.fileno())
+        return Resource(stream, stat.st_size, stat.st_mtime,
+                        '"%x-%x%s"' % (int(stat.st_mtime * 1000), stat.st_size, '-gz' if encoding else ''),
+                        content_type, encoding)
+
+    def accepts_gzip(self):
+        """Accept-Encoding lists gzip, or *, with a quality above 0.  gzip itself wins over *."""
+        qualities = {}
+        for token in self.headers.get('Accept-Encoding', '').split(','):
+            parts = token.split(';')
+            quality = 1.0
+            for parameter in parts[1:]:
+                name, _, value = parameter.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            qualities[parts[0].strip().lower()] = quality
+        for coding in ('gzip', 'x-gzip', '*'):
+            if coding in qualities:
+                return qualities[coding] > 0
+        return False
+
+    def not_modified(self, resource):
+        if 'If-None-Match' in self.headers:
+            tags = [tag.strip() for tag in self.headers['If-None-Match'].split(',')]
+            return '*' in tags or resource.etag in tags or 'W/' + resource.etag in tags
+        since = self.header_time('If-Modified-Since')
+        return since is not None and int(resource.mtime) <= since
+
+    def header_time(self, name):
+        parsed = parsedate_tz(self.headers.get(name, ''))
+        return mktime_tz(parsed) if parsed else None
+
+    def requested_range(self, resource):
+        """(first, last) byte to send, None for the whole file, or False if it can't be satisfied"""
+        match = RANGE.match(self.headers.get('Range', '').strip())
+        if not match or not any(match.groups()):
+            return None  # no Range, or several ranges: the whole file is a valid answer
+        if 'If-Range' in self.headers:
+            validator = self.headers['If-Range'].strip()
+            if validator != resource.etag and self.header_time('If-Range') != int(resource.mtime):
+                return None  # the client's copy is out of date, send all of it
+        first, last = match.groups()
+        if not first:  # last n bytes
+            first, last = max(0, resource.size - int(last)), resource.size - 1
+        else:
+            first, last = int(first), min(int(last) if last else resource.size - 1, resource.size - 1)
+        if first >= resource.size or first > last:
+            return False
+        return first, last
+
+    def send_resource(self, resource):
+        if self.not_modified(resource):
+            resource.stream.close()
+            self.send_response(304)
+            self.send_validators(resource)
+            self.end_headers()
+            return None
+        byte_range = self.requested_range(resource)
+        if byte_range is False:
+            resource.stream.close()
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%i" % resource.size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        if byte_range is None:
+            self.send_response(200)
+            self.send_length = resource.size
+        else:
+            first, last = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %i-%i/%i" % (first, last, resource.size))
+            resource.stream.seek(first)
+            self.send_length = last - first + 1
+        self.send_header("Content-type", resource.content_type)
+        self.send_header("Content-Length", str(self.send_length))
+        self.send_header("Accept-Ranges", "bytes")
+        if resource.encoding:
+            self.send_header("Content-Encoding", resource.encoding)
+        self.send_validators(resource)
+        self.end_headers()
+        return resource.stream
+
+    def send_validators(self, resource):
+        self.send_header("ETag", resource.etag)
+        self.send_header("Last-Modified", formatdate(resource.mtime, usegmt=True))
+        self.send_header("Vary", "Accept-Encoding")
+
+    def copyfile(self, source, outputfile):
+        """Only the requested range, when there is one"""
+        remaining = getattr(self, 'send_length', None)
+        if remaining is None:
+            return shutil.copyfileobj(source, outputfile)
+        while remaining > 0:
+            data = source.read(min(remaining, 64 * 1024))
+            if not data:
+                break
+            outputfile.write(data)
+            remaining -= len(data)
+
+
+class ResultsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True  # don't wait for open keep-alive connections on shutdown
+    allow_reuse_address = True
+
+
+def precompress(result_dir, extensions=PRECOMPRESSED, compress_level=9):
+    """Writes x.gz next to every file with one of the extensions under result_dir (sequence
+    chunks, JSON, scripts), unless it is already up to date.  Returns the number written."""
+    written = 0
+    for root, dirs, files in os.walk(result_dir):
+        for file_name in files:
+            if not file_name.endswith(extensions):
+                continue
+            path = os.path.join(root, file_name)
+            if os.path.exists(path + '.gz') and os.path.getmtime(path + '.gz') >= os.path.getmtime(path):
+                continue
+            with open(path, 'rb') as original, gzip.open(path + '.gz', 'wb', compress_level) as compressed:
+                shutil.copyfileobj(original, compressed)
+            written += 1
+    return written
+
+
+def serve(folder, host="localhost", port=8000):
+    """Serves folder until interrupted.  Raises OSError if the port is taken."""
+    os.chdir(folder)
+    httpd = ResultsServer((host, port), ResultsRequestHandler)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("FluentDNA Server shutdown.")
+    finally:
+        httpd.server_close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(usage="python -m FluentDNA.ResultsServer [--host 0.0.0.0] [--port 8000] "
+                                           "[--precompress] [folder]",
+                                     description="Serves a FluentDNA results folder.")
+    parser.add_argument('folder', nargs='?', default='.', help="Folder to serve, by default the current one.")
+    parser.add_argument('--host', default='localhost',
+                        help="Address to listen on.  0.0.0.0 makes it reachable from other computers.")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--precompress', action='store_true',
+                        help="Write .gz copies of the sequence chunks and other text files first.")
+    args = parser.parse_args()
+    if args.precompress:
+        print("Compressed %i files" % precompress(args.folder))
+    print("Serving %s at http://%s:%i" % (os.path.abspath(args.folder), args.host, args.port))
+    try:
+        serve(args.folder, args.host, args.port)
+    except OSError as e:
+        print("Couldn't listen on %s:%i: %s" % (args.host, args.port, e), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,38 @@
 from __future__ import print_function, division, absolute_import, \
     with_statement, generators, nested_scopes
 
+import json
 import math
 import os
+import struct
+import threading
 import traceback
 from collections import defaultdict
 from datetime import datetime
 
 import sys
-from DNASkittleUtils.Contigs import read_contigs, Contig, write_contigs_to_file
+import numpy as np
+from DNASkittleUtils.Contigs import Contig, write_contigs_to_file
 from DNASkittleUtils.DDVUtils import copytree
 from PIL import Image, ImageDraw, ImageFont
 
 from FluentDNA import gap_char
+from FluentDNA.Canvas import MemmapCanvas, BandCanvas, PngWriter, write_png
+from FluentDNA.FastaIndex import read_contigs_indexed, IndexedSequence, map_fasta, has_non_ascii
 from FluentDNA.FluentDNAUtils import multi_line_height, pretty_contig_name, viridis_palette, \
     make_output_directory, filter_by_contigs, copy_to_sources
-from FluentDNA.Layouts import LayoutFrame, LayoutLevel, level_layout_factory, parse_custom_layout
+from FluentDNA.Layouts import LayoutFrame, LayoutLevel, level_layout_factory, parse_custom_layout, \
+    contig_spacing_from_contigs
+from FluentDNA.PackedSequence import as_packed, as_codes
+from FluentDNA.CompositionCounts import CountsWriter, composition_counts_path
+from FluentDNA.CompositionPyramid import CompositionPyramid, composition_level_count, write_levels
+from FluentDNA.deepzoom import DZIDescriptor, PyramidWriter
 
 small_title_bp = 10000
 protein_found_message = False
+sequence_block_bp = 65536  # nucleotides in each chunks/ sequence file the viewer fetches
+embedded_contigs = 1000  # contigs per file in index.html, the viewer loads the rest from contig_positions.bin
+contig_position_columns = ('xy_title_start', 'xy_seq_start', 'xy_seq_end', 'nuc_seq_start')
 
 
 
@@ -41,7 +55,9 @@ def is_protein_sequence(contig):
 class TileLayout(object):
     def __init__(self, use_titles=True, sort_contigs=False,
                  low_contrast=False, base_width=100, border_width=3,
-                 custom_layout=None):
+                 custom_layout=None, indexed_canvas=False, disk_canvas=False, direct_tiles=False,
+                 direct_tiles_png=False, workers=1, tile_options=None, master_png='now',
+                 png_compress_level=6, composition_bp=0):
         self.fasta_sources = []  # to be added in output_fasta for each file
         self.use_titles = use_titles
         self.skip_small_titles = False
@@ -61,6 +77,20 @@ class TileLayout(object):
         self.draw = None
         self.pixels = None
         self.pil_mode = 'RGB'  # no alpha channel means less RAM used
+        self.indexed_canvas = indexed_canvas  # one byte per pixel 'P' mode, expanded only for compositing
+        self.canvas_colors = {}  # RGB -> palette index for an indexed canvas
+        self.disk_canvas = disk_canvas  # memory-mapped canvas file for images larger than RAM
+        self.canvas_path = None
+        self.direct_tiles = direct_tiles  # render the zoom stack straight from sequence, no full canvas
+        self.direct_tiles_png = direct_tiles_png  # also stream the full image out as a PNG
+        self.tiles_written = False
+        self.tile_options = tile_options or {}  # tile_format, compress_level, palette_tiles, resume for --direct_tiles
+        self.master_png = master_png  # 'now', 'background' while the zoom stack is made, or 'skip'
+        self.png_pending = False  # output_image() left the PNG for write_deferred_png()
+        self.png_compress_level = png_compress_level  # zlib level of the PNG, compressed by self.workers threads
+        self.composition_bp = composition_bp  # zoom levels with this many bp per pixel come from composition
+        self.composition_levels = 0  # low zoom levels draw_composition_levels() already wrote
+        self.workers = workers  # processes drawing nucleotides into a shared canvas file
         self.contigs = []
         self.contig_memory = []
         self.image_length = 0
@@ -174,12 +204,22 @@ class TileLayout(object):
         make_output_directory(output_folder, no_webpage)
         start_time = datetime.now()
         self.final_output_location = output_folder
+        if self.disk_canvas or self.workers > 1:
+            self.canvas_path = os.path.join(output_folder, '' if no_webpage else 'sources',
+                                            output_file_name + '.canvas.npy')
+        # Metadata pass: only names and lengths from the index, no sequence is read
         self.image_length = self.read_contigs_and_calc_padding(input_file_path, extract_contigs)
         print("Read contigs from", input_file_path, ":", datetime.now() - start_time)
+        if self.composition_bp and not no_webpage:
+            self.draw_composition_levels(os.path.join(output_folder, 'GeneratedImages', "dzc_output.xml"))
+            print("Drew low zoom levels from composition:", datetime.now() - start_time)
+        if self.direct_tiles and not no_webpage:
+            self.process_file_to_tiles(input_file_path, output_folder, output_file_name, extract_contigs)
+            return start_time
         self.prepare_image(self.image_length)
         print("Initialized Image:", datetime.now() - start_time, "\n")
         try:  # These try catch statements ensure we get at least some output.  These jobs can take hours
-            self.draw_nucleotides()
+            self.draw_nucleotides()  # Streaming pass: one contig in memory at a time
             print("\nDrew Nucleotides:", datetime.now() - start_time)
         except Exception as e:
             print('Encountered exception while drawing nucleotides:', '\n')
@@ -206,32 +246,334 @@ class TileLayout(object):
         return start_time
 
 
+    def process_file_to_tiles(self, input_file_path, output_folder, output_file_name, extract_contigs=None):
+        """Rest of process_file() for direct_tiles.  Titles are drawn band by band, draw_extras()
+        is not supported because it needs the whole canvas."""
+        start_time = datetime.now()
+        self.final_output_location = os.path.join(output_folder, 'sources', output_file_name + ".png")
+        self.draw_tiles(os.path.join(output_folder, 'GeneratedImages', "dzc_output.xml"),
+                        self.final_output_location if self.direct_tiles_png else None)
+        print("Drew tiles:", datetime.now() - start_time)
+        self.output_fasta(output_folder, input_file_path, False, extract_contigs, self.sort_contigs)
+        print("Output Fasta in:", datetime.now() - start_time)
+
+    def draw_tiles(self, destination, png_path=None, band_height=64):
+        """Direct to tiles rendering.  The full resolution image is colored one band of rows at a
+        time straight from the sequence, by mapping each pixel back to a contig position, and
+        handed to a PyramidWriter that cuts tiles and builds the lower levels.  There is never a
+        full size canvas.  png_path optionally streams the same rows out as a PNG."""
+        width, height = self.max_dimensions(self.image_length)
+        print("Image dimensions are", width, "x", height, "pixels, drawing tiles to", destination)
+        titles = []
+        for total_progress, contig in (self.title_positions() if self.use_titles else []):
+            top = self.position_on_screen(total_progress)[1]
+            bottom = self.position_on_screen(total_progress + contig.title_padding - 2)[1]
+            titles.append((top, bottom + 1, total_progress, contig))
+        if self.indexed_canvas and titles:
+            # the palette goes out before any title is drawn, title blends couldn't be added to it
+            print("Note: titles blend colors that aren't in the palette, drawing tiles in full color.")
+            self.indexed_canvas = False
+        mode, background = self.canvas_mode()
+        blank = Image.new(mode, (width, band_height), background)
+        self.image = BandCanvas(blank, 0, (width, height))
+        if self.indexed_canvas:
+            self.image.putpalette(self.canvas_palette())
+        color_table = self.palette_lookup_table()  # may add colors to the palette
+        palette = self.image.getpalette() if self.indexed_canvas else None
+        blank = BandCanvas(blank, 0, (width, height)).pixels()
+        spacing = self.contig_spacing()
+        pyramid = PyramidWriter(width, height, destination, palette=palette, workers=self.workers,
+                                lowest_level=self.composition_levels, **self.tile_options)
+        png = PngWriter(png_path, width, height, mode, palette, self.png_compress_level) if png_path else None
+        for top in range(0, height, band_height):
+            bottom = min(height, top + band_height)
+            pixels = self.color_band(top, bottom, blank[:bottom - top].copy(), spacing, color_table)
+            band = Image.fromarray(pixels[:, :, 0] if pixels.shape[2] == 1 else pixels, mode)
+            if palette:
+                band.putpalette(palette)
+            self.image = BandCanvas(band, top, (width, height))
+            for title_top, title_bottom, total_progress, contig in titles:
+                if title_top < bottom and title_bottom > top:
+                    self.draw_title(total_progress, contig)
+            pixels = self.image.pixels()
+            pyramid.add_rows(pixels)
+            if png:
+                png.write_rows(pixels)
+            if top // band_height % 100 == 0:
+                print(str(bottom / height * 100)[:4], '% done', flush=True)  # pseudo progress bar
+        pyramid.close()
+        if png:
+            png.close()
+        self.tiles_written = True
+
+    def color_band(self, top, bottom, pixels, spacing, color_table):
+        """Colors rows top to bottom of the full image into pixels, a blank (rows, width, channels)
+        array, by looking up the contig and nucleotide under every pixel."""
+        width = pixels.shape[1]
+        ys, xs = np.divmod(np.arange(top * width, bottom * width, dtype=np.int64), width)
+        self.color_points(xs, ys, pixels.reshape(-1, pixels.shape[2]), spacing, color_table)
+        return pixels
+
+    def color_points(self, xs, ys, colors, spacing, color_table):
+        """Sets colors[i] to the nucleotide color under pixel xs[i], ys[i].  Pixels that aren't
+        on a nucleotide are left alone."""
+        contig_index, offset, in_title = spacing.resolve_all(self.levels.progress_at_points(xs, ys))
+        on_sequence = np.flatnonzero((contig_index >= 0) & ~in_title)
+        contig_index, offset = contig_index[on_sequence], offset[on_sequence]
+        order = np.argsort(contig_index, kind='stable')
+        boundaries = np.flatnonzero(np.diff(contig_index[order])) + 1
+        for group in np.split(order, boundaries) if len(order) else []:
+            contig = self.contigs[contig_index[group[0]]]
+            start, end = offset[group].min(), offset[group].max() + 1
+            codes = as_codes(contig.seq[int(start): int(end)])  # only the part inside these pixels
+            colors[on_sequence[group]] = color_table[codes[offset[group] - start]]
+
+    def draw_composition_levels(self, destination):
+        """Writes the Deep Zoom levels where a pixel covers at least self.composition_bp nucleotides
+        straight from the sequence (see CompositionPyramid.py), before any drawing.  Whatever makes
+        the zoom stack afterwards starts above them."""
+        width, height = self.max_dimensions(self.image_length)
+        descriptor = DZIDescriptor(width, height, tile_size=256, tile_overlap=1)
+        self.composition_levels = composition_level_count(descriptor, self.composition_bp)
+        if not self.composition_levels:
+            print("No zoom level has", self.composition_bp, "bp per pixel, drawing every level from pixels")
+            return
+        factor = 2 ** (descriptor.num_levels - self.composition_levels)
+        print("Computing %i zoom levels from composition, %i pixels per side in the largest one" %
+              (self.composition_levels, factor))
+        pyramid = self.composition_pyramid(width, height, factor)
+        tile_options = dict((key, value) for key, value in self.tile_options.items()
+                            if key in ('tile_format', 'compress_level', 'palette_tiles'))
+        write_levels(pyramid, self.composition_levels, destination, width, height, **tile_options)
+
+    def composition_pyramid(self, width, height, factor):
+        """CompositionPyramid of the whole layout with factor x factor pixel blocks.  Titles are
+        drawn one at a time on their own.  Doesn't touch self.image."""
+        pyramid = CompositionPyramid(width, height, factor, self.levels, hex_to_rgb('#FFFFFF'))
+        color_table = self.palette_lookup_table('RGB')
+        spacing = self.contig_spacing()
+        piece = 4 * 1024 * 1024
+        for contig, seq_start in zip(self.contigs, spacing.seq_starts):
+            for start in range(0, len(contig.seq), piece):
+                codes = as_codes(contig.seq[start: start + piece])
+                pyramid.add_sequence(int(seq_start) + start, codes, color_table)
+        if self.use_titles:
+            def underneath(xs, ys):  # titles can reach a few pixels into the sequence
+                colors = np.tile(pyramid.background, (len(xs), 1))
+                self.color_points(xs, ys, colors, spacing, color_table)
+                return colors
+            collector = TitleCollector(pyramid, underneath)
+            for total_progress, contig in self.title_positions():
+                self.draw_title(total_progress, contig, collector)
+        return pyramid
+
     def draw_extras(self):
         """Placeholder method for child classes"""
         pass
 
+    def iter_contig_sequences(self):
+        """Streaming draw pass: yields (contig, sequence) with the sequence of just that contig read
+        into memory.  The previous contig is released when the next one is read, so peak memory is
+        the canvas plus the largest contig, at one byte per nucleotide."""
+        for contig in self.contigs:
+            yield contig, as_packed(contig.seq)
+
     def draw_nucleotides(self, verbose=True):
+        """Vectorized renderer: sequence bytes go through a 256 entry color table and each
+        column is pasted as one block.  Pixel identical to draw_nucleotides_reference()."""
+        color_table = self.palette_lookup_table()
+        if self.workers > 1 and isinstance(self.image, MemmapCanvas):
+            return self.draw_nucleotides_parallel(color_table, verbose)
         total_progress = 0
         # Layout contigs one at a time
-        for contig_index, contig in enumerate(self.contigs):
+        for contig_index, (contig, seq) in enumerate(self.iter_contig_sequences()):
             total_progress += contig.reset_padding + contig.title_padding
-            seq_length = len(contig.seq)
+            self.draw_sequence(seq.values(), total_progress, color_table)
+            total_progress += len(seq)
+            total_progress += contig.tail_padding  # add trailing white space after the contig sequence body
+            if verbose:
+                self.print_draw_progress(contig_index, contig, total_progress)
+
+    def draw_nucleotides_parallel(self, color_table, verbose=True):
+        """Splits the sequence into pieces of about equal size and draws them in a process pool.
+        Every piece already has a fixed place in the layout, so the workers write disjoint pixels
+        of the same canvas file.  Big chromosomes are cut at whole lines."""
+        from multiprocessing import Pool
+        tasks = self.raster_tasks(self.workers * 4)
+        total = float(sum(end - start for task in tasks for source, start, end, progress in task))
+        self.image.flush()
+        print("Drawing with %i workers" % self.workers)
+        pool = Pool(self.workers, initializer=init_raster_worker,
+                    initargs=(self.canvas_path, self.each_layout, self.i_layout, color_table))
+        try:
+            done = 0
+            for drawn in pool.imap_unordered(draw_raster_task, tasks):
+                done += drawn
+                if verbose:
+                    print(str(done / total * 100)[:4], '% done', flush=True)  # pseudo progress bar
+        finally:
+            pool.close()
+            pool.join()
+
+    def raster_tasks(self, n_tasks):
+        """Lists of (source, start, end, progress) pieces for draw_raster_task().  source is the
+        FASTA path and index record for memory-mapped contigs, otherwise the codes themselves."""
+        line = self.levels[1].chunk_size
+        total = sum(len(contig.seq) for contig in self.contigs)
+        piece = max(line, total // max(1, n_tasks) // line * line)
+        tasks, task, task_size = [], [], 0
+        total_progress = 0
+        for contig in self.contigs:
+            total_progress += contig.reset_padding + contig.title_padding
+            length = len(contig.seq)
+            indexed = isinstance(contig.seq, IndexedSequence) and contig.seq.fasta_path
+            for start in range(0, length, piece):
+                end = min(length, start + piece)
+                source = (contig.seq.fasta_path, contig.seq.record) if indexed else as_codes(contig.seq[start: end])
+                task.append((source, start, end, total_progress + start))
+                task_size += end - start
+                if task_size >= piece:
+                    tasks.append(task)
+                    task, task_size = [], 0
+            total_progress += length + contig.tail_padding
+        if task:
+            tasks.append(task)
+        return tasks
+
+    def draw_nucleotides_reference(self, verbose=True):
+        """One pixel at a time through draw_pixel().  Slow, but simple enough to check
+        draw_nucleotides() against."""
+        total_progress = 0
+        # Layout contigs one at a time
+        for contig_index, (contig, seq) in enumerate(self.iter_contig_sequences()):
+            total_progress += contig.reset_padding + contig.title_padding
+            seq_length = len(seq)
             line_width = self.levels[0].modulo
             for cx in range(0, seq_length, line_width):
                 x, y = self.position_on_screen(total_progress)
                 remaining = min(line_width, seq_length - cx)
                 total_progress += remaining
+                line = seq[cx: cx + remaining]
+                if self.using_spectrum:
+                    line = line.encode('latin-1')  # byte values index the spectrum palette
                 try:
                     for i in range(remaining):
-                        nuc = contig.seq[cx + i]
+                        nuc = line[i]
                         # if nuc != gap_char:
                         self.draw_pixel(nuc, x + i, y)
                 except IndexError:
                    print("Cursor fell off the image at", (x,y))
             total_progress += contig.tail_padding  # add trailing white space after the contig sequence body
-            if verbose and (len(self.contigs) < 100 or contig_index % (len(self.contigs) // 100) == 0):
-                print(str(total_progress / self.image_length * 100)[:4], '% done:', contig.name,
-                      flush=True)  # pseudo progress bar
+            if verbose:
+                self.print_draw_progress(contig_index, contig, total_progress)
+
+    def print_draw_progress(self, contig_index, contig, total_progress):
+        if len(self.contigs) < 100 or contig_index % (len(self.contigs) // 100) == 0:
+            print(str(total_progress / self.image_length * 100)[:4], '% done:', contig.name,
+                  flush=True)  # pseudo progress bar
+
+    def palette_lookup_table(self, mode=None):
+        """self.palette as a (256, channels) uint8 array indexed by byte value.  Built at draw
+        time because some layouts change palette between genomes.  On an indexed canvas the
+        table holds a single channel of palette indices instead.  mode defaults to the canvas mode."""
+        mode = mode or self.image.mode
+        channels = 3 if mode == 'P' else len(Image.new(mode, (1, 1)).getbands())
+        missing = self.palette.default_factory() if getattr(self.palette, 'default_factory', None) \
+            else (255, 0, 0)
+        table = np.empty((256, channels), dtype=np.uint8)
+        for code in range(256):
+            key = code if self.using_spectrum else chr(code)
+            color = tuple(self.palette[key] if key in self.palette else missing)
+            table[code] = (color + (255,) * channels)[:channels]  # opaque alpha, like PixelAccess
+        if mode == 'P':
+            table = np.array([[self.canvas_index(color)] for color in table], dtype=np.uint8)
+        return table
+
+    def canvas_index(self, color):
+        """Palette index of an RGB color on an indexed canvas.  New colors are added to the palette."""
+        color = tuple(int(c) for c in color[:3])
+        if color not in self.canvas_colors:
+            if len(self.canvas_colors) >= 256:
+                raise ValueError("More than 256 colors don't fit on an indexed canvas")
+            self.canvas_colors[color] = len(self.canvas_colors)
+            self.image.putpalette(self.canvas_palette())
+        return self.canvas_colors[color]
+
+    def canvas_palette(self):
+        """Flat 768 entry palette: colors in the order they were added, unused slots repeat the background"""
+        colors = [(255, 255, 255)] * 256
+        for color, index in self.canvas_colors.items():
+            colors[index] = color
+        return [channel for color in colors for channel in color]
+
+    def draw_sequence(self, codes, progress, color_table, min_block=1024, scatter_piece=1024 * 1024):
+        """Paints codes starting at progress.  Runs of whole lines that stay inside one column
+        are colored and pasted as a single block.  Everything else, such as the short or thick
+        lines of custom layouts, is gathered and scattered by scatter_pixels() in pieces."""
+        line_width = self.levels[0].modulo
+        line_level = self.levels[1]
+        cx = 0
+        scatter_start = 0  # codes[scatter_start: cx] are waiting for scatter_pixels()
+        while cx < len(codes):
+            p = progress + cx
+            lines = min(line_level.modulo - (p // line_level.chunk_size) % line_level.modulo,  # left in column
+                        (len(codes) - cx) // line_width)
+            if lines * line_width >= min_block and lines > 1 and line_level.thickness == 1 and not p % line_width:
+                x, y = self.position_on_screen(p)
+                if tuple(self.position_on_screen(p + (lines - 1) * line_width)) == (x, y + lines - 1):
+                    for piece in range(scatter_start, cx, scatter_piece):
+                        self.scatter_pixels(codes[piece: min(cx, piece + scatter_piece)], progress + piece, color_table)
+                    block = color_table[codes[cx: cx + lines * line_width]].reshape(lines, line_width, -1)
+                    self.paste_pixels(block, x, y)
+                    cx += lines * line_width
+                    scatter_start = cx
+                    continue
+            cx += max(1, lines) * line_width - p % line_width  # to the next line start
+            cx = min(cx, len(codes))
+        for piece in range(scatter_start, cx, scatter_piece):
+            self.scatter_pixels(codes[piece: min(cx, piece + scatter_piece)], progress + piece, color_table)
+
+    def scatter_pixels(self, codes, progress, color_table):
+        """Colors codes laid out from progress, with the position of every nucleotide from
+        positions_on_screen().  On a PIL image the bounding box is copied out, written and pasted
+        back, so pieces that span far apart columns are split until the box is reasonably full."""
+        if not len(codes):
+            return
+        xs, ys = self.positions_on_screen(np.arange(progress, progress + len(codes), dtype=np.int64))
+        inside = (xs < self.image.width) & (ys < self.image.height)
+        if not inside.all():
+            print("Cursor fell off the image at", (int(xs[~inside][0]), int(ys[~inside][0])))
+            codes, xs, ys = codes[inside], xs[inside], ys[inside]
+            if not len(codes):
+                return
+        if isinstance(self.image, MemmapCanvas):
+            self.image.array[ys, xs] = color_table[codes]
+        else:
+            self.scatter_points(codes, xs, ys, color_table)
+
+    def scatter_points(self, codes, xs, ys, color_table):
+        left, top, right, bottom = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+        if len(codes) > 1 and (right - left) * (bottom - top) > 4 * len(codes) + 65536:
+            half = len(codes) // 2
+            self.scatter_points(codes[:half], xs[:half], ys[:half], color_table)
+            self.scatter_points(codes[half:], xs[half:], ys[half:], color_table)
+            return
+        region = np.array(self.image.crop((left, top, right, bottom)))
+        if region.ndim == 2:  # palette indices
+            region = region[:, :, None]
+        region[ys - top, xs - left] = color_table[codes]
+        self.paste_pixels(region, left, top)
+
+    def paste_pixels(self, block, x, y):
+        """block is a (height, width, channels) uint8 array in the image mode"""
+        if x + block.shape[1] > self.image.width or y + block.shape[0] > self.image.height:
+            print("Cursor fell off the image at", (x, y))
+        if isinstance(self.image, MemmapCanvas):
+            self.image.paste_array(block, int(x), int(y))
+            return
+        if block.shape[2] == 1:  # palette indices
+            block = block[:, :, 0]
+        self.image.paste(Image.fromarray(block, self.image.mode), (int(x), int(y)))
 
 
     def output_fasta(self, output_folder, fasta, no_webpage, extract_contigs, sort_contigs,
@@ -242,18 +584,29 @@ class TileLayout(object):
 
         #also make single file
         if not no_webpage:
-            write_contigs_to_chunks_dir(output_folder, bare_file, self.contigs)
-            self.remember_contig_spacing()
             fasta_destination = os.path.join(output_folder, 'sources', bare_file)
+            customized_fasta = create_source_download and (extract_contigs or sort_contigs)
+            if customized_fasta:
+                length_sum = sum([len(c.seq) for c in self.contigs])
+                fasta_destination = '%s__%ibp.fa' % (os.path.splitext(fasta_destination)[0], length_sum)
+            # running nucleotide totals for the server's composition queries
+            counts = CountsWriter(composition_counts_path(output_folder, bare_file),
+                                  fasta_destination if create_source_download else fasta)
+            write_contigs_to_chunks_dir(output_folder, bare_file, counts.counted(self.streamed_contigs()))
+            counts.close()
+            self.remember_contig_spacing()
             if create_source_download:
-                if extract_contigs or sort_contigs:  # customized_fasta
-                    length_sum = sum([len(c.seq) for c in self.contigs])
-                    fasta_destination = '%s__%ibp.fa' % (os.path.splitext(fasta_destination)[0], length_sum)
-                    write_contigs_to_file(fasta_destination, self.contigs)  # shortened fasta
+                if customized_fasta:
+                    write_contigs_to_file(fasta_destination, self.streamed_contigs(), verbose=False)  # shortened fasta
+                    print("Done writing ", len(self.contigs), "contigs and {:,}bp".format(length_sum))
                 else:
                     copy_to_sources(output_folder, fasta)
                 print("Sequence saved in:", fasta_destination)
 
+    def streamed_contigs(self):
+        """Contigs with their sequence read into memory one at a time, for writing files"""
+        return (Contig(contig.name, seq) for contig, seq in self.iter_contig_sequences())
+
     def calc_all_padding(self):
         total_progress = 0  # pointer in image
         seq_start = 0  # pointer in text
@@ -286,14 +639,13 @@ class TileLayout(object):
 
 
     def read_contigs_and_calc_padding(self, input_file_path, extract_contigs=None):
-        try:
-            self.contigs = read_contigs(input_file_path)
-        except UnicodeDecodeError as e:
-            print(e)
+        if has_non_ascii(input_file_path):
             print("Important: Non-standard characters detected.  Switching to 256 colormap for bytes")
             self.using_spectrum = True
             self.palette = viridis_palette()
             self.contigs = [Contig(input_file_path, open(input_file_path, 'rb').read())]
+        else:
+            self.contigs = read_contigs_indexed(input_file_path, streaming=True)  # names and lengths only
         self.contigs = filter_by_contigs(self.contigs, extract_contigs)
         self.protein_palette = is_protein_sequence(self.contigs[0])
         return self.calc_all_padding()
@@ -301,10 +653,37 @@ class TileLayout(object):
     def prepare_image(self, image_length):
         width, height = self.max_dimensions(image_length)
         print("Image dimensions are", width, "x", height, "pixels")
-        self.image = Image.new(self.pil_mode, (width, height), hex_to_rgb('#FFFFFF'))#ui_grey)
-        self.draw = ImageDraw.Draw(self.image)
+        mode, background = self.canvas_mode()
+        if self.canvas_path:
+            print("Drawing on", self.canvas_path)
+            self.image = MemmapCanvas(self.canvas_path, (width, height), mode, background)
+        else:
+            self.image = Image.new(mode, (width, height), background)#ui_grey)
+        if self.indexed_canvas:
+            self.image.putpalette(self.canvas_palette())
+        self.draw = ImageDraw.Draw(self.image) if isinstance(self.image, Image.Image) else None
         self.pixels = self.image.load()
 
+    def canvas_mode(self):
+        """PIL mode and background color for a new canvas"""
+        if self.indexed_canvas and self.using_spectrum:
+            print("Note: spectrum colors don't fit in a palette, using a full color canvas.")
+            self.indexed_canvas = False
+        if self.indexed_canvas:
+            self.canvas_colors = {hex_to_rgb('#FFFFFF'): 0}  # background is index 0
+            return 'P', 0
+        return self.pil_mode, hex_to_rgb('#FFFFFF')
+
+    def expand_canvas(self, mode=None):
+        """Converts an indexed canvas to full color (self.pil_mode) for compositing that blends
+        colors, like annotation highlights.  Does nothing to a canvas that is already full color."""
+        if self.image.mode == 'P':
+            mode = mode or self.pil_mode
+            print("Expanding indexed canvas to", mode)
+            self.image = self.image.convert(mode)
+            self.draw = ImageDraw.Draw(self.image) if isinstance(self.image, Image.Image) else None
+            self.pixels = self.image.load()
+
 
     def calc_padding(self, total_progress, next_segment_length):
         min_gap = (20 + 6) * self.base_width  # 20px font height, + 6px vertical padding  * 100 nt per line
@@ -352,21 +731,38 @@ class TileLayout(object):
     def position_on_screen(self, progress):  #Alias for layout: Optimize?
         return self.levels.position_on_screen(progress)
 
+    def positions_on_screen(self, progress):
+        return self.levels.positions_on_screen(progress)
+
+    def contig_spacing(self):
+        """Contig start table for self.contigs, keep it around for repeated lookups"""
+        return contig_spacing_from_contigs(self.contigs)
+
+    def sequence_at(self, x, y):
+        """SequencePosition of the contig and nucleotide under pixel x, y, or None"""
+        return self.contig_spacing().resolve(self.levels.progress_at(x, y))
+
 
     def draw_pixel(self, character, x, y):
         self.pixels[x, y] = self.palette[character]
 
 
     def draw_titles(self):
+        for total_progress, contig in self.title_positions():
+            self.draw_title(total_progress, contig)
+
+    def title_positions(self):
+        """(total_progress, contig) for every contig with enough room for a title"""
         total_progress = 0
         for contig in self.contigs:
             total_progress += contig.reset_padding  # is to move the cursor to the right line for a large title
             if contig.title_padding > self.title_skip_padding:  # there needs to be room to draw
-                self.draw_title(total_progress, contig)
+                yield total_progress, contig
             total_progress += contig.title_padding + len(contig.seq) + contig.tail_padding
 
 
-    def draw_title(self, total_progress, contig):
+    def draw_title(self, total_progress, contig, canvas=None):
+        """canvas defaults to self.image"""
         upper_left = self.position_on_screen(total_progress)
         bottom_right = self.position_on_screen(total_progress + contig.title_padding - 2)
         width, height = bottom_right[0] - upper_left[0], bottom_right[1] - upper_left[1]
@@ -393,7 +789,7 @@ class TileLayout(object):
 
         contig_name = contig.name
         self.write_title(contig_name, width, height, font_size, title_lines, title_width, upper_left,
-                         vertical_label, self.image)
+                         vertical_label, self.image if canvas is None else canvas)
 
 
     def write_title(self, text, width, height, font_size, title_lines, title_width, upper_left,
@@ -408,7 +804,35 @@ class TileLayout(object):
         if vertical_label:
             txt = txt.rotate(90, expand=True)
             upper_left[0] += 8  # adjusts baseline for more polish
-        canvas.paste(txt, (upper_left[0], upper_left[1]), txt)
+        if canvas.mode == 'P':  # only ever self.image
+            self.paste_onto_indexed(txt, upper_left)
+        else:
+            canvas.paste(txt, (upper_left[0], upper_left[1]), txt)
+
+    def paste_onto_indexed(self, overlay, upper_left):
+        """Alpha composites an RGBA overlay onto the indexed canvas.  Only the covered region is
+        expanded to RGB.  Blended colors get palette entries of their own, so titles come out the
+        same as on a full color canvas.  When the palette is full the canvas is expanded instead."""
+        box = (int(upper_left[0]), int(upper_left[1]),
+               int(upper_left[0]) + overlay.width, int(upper_left[1]) + overlay.height)
+        region = self.image.crop(box).convert('RGB')
+        region.paste(overlay, (0, 0), overlay)
+        pixels = np.asarray(region, dtype=np.int32)
+        packed = (pixels[:, :, 0] << 16) | (pixels[:, :, 1] << 8) | pixels[:, :, 2]
+        colors, inverse = np.unique(packed, return_inverse=True)
+        colors = [(c >> 16, (c >> 8) & 255, c & 255) for c in colors.tolist()]
+        new_colors = [color for color in colors if color not in self.canvas_colors]
+        if len(self.canvas_colors) + len(new_colors) > 256:
+            print("Note: titles blend more colors than fit in a palette.", end=' ')
+            self.expand_canvas()
+            self.image.paste(overlay, box[:2], overlay)
+            return
+        for color in new_colors:
+            self.canvas_colors[color] = len(self.canvas_colors)
+        if new_colors:
+            self.image.putpalette(self.canvas_palette())
+        indices = np.array([self.canvas_colors[color] for color in colors], dtype=np.uint8)
+        self.image.paste(Image.fromarray(indices[inverse].reshape(packed.shape), 'P'), box)
 
     def get_font(self, font_size):
         if font_size in self.fonts:
@@ -438,10 +862,34 @@ class TileLayout(object):
         if not no_webpage:  # sources directory only exists for non-quick
             output_folder = os.path.join(output_folder, 'sources',)
         self.final_output_location = os.path.join(output_folder, output_file_name + ".png")
+        if self.master_png != 'now' and not no_webpage:
+            self.png_pending = True  # DeepZoom is given the canvas itself
+            if isinstance(self.image, MemmapCanvas):
+                self.image.flush()
+            return
         print("-- Writing:", self.final_output_location, "--")
-        self.image.save(self.final_output_location, 'PNG')
+        write_png(self.final_output_location, self.image, self.png_compress_level, self.workers, verbose=True)
+        if isinstance(self.image, MemmapCanvas):
+            self.image.flush()  # DeepZoom reads the canvas file directly
         # del self.image
 
+    def write_deferred_png(self):
+        """Starts writing the PNG that output_image() put off in a thread, so it overlaps with
+        making the zoom stack.  Returns the thread to join, or None if there's nothing to write."""
+        if not self.png_pending or self.master_png == 'skip':
+            return None
+        print("-- Writing in the background:", self.final_output_location, "--")
+        thread = threading.Thread(target=write_png, args=(self.final_output_location, self.image,
+                                                          self.png_compress_level, self.workers))
+        thread.start()
+        return thread
+
+    def discard_canvas(self):
+        """Deletes the memory-mapped canvas file once nothing else needs to read it"""
+        if isinstance(self.image, MemmapCanvas):
+            self.image.close(delete=True)
+            self.image = None
+
 
     def max_dimensions(self, image_length):
         """ Uses Tile Layout to find the largest chunk size in each dimension (XY) that the
@@ -526,6 +974,7 @@ class TileLayout(object):
                 html_template = os.path.join(module_path, 'html_template')
                 copytree(html_template, output_folder)  # copies the whole template directory
             print("Copying HTML to", output_folder)
+            self.output_contig_positions(output_folder)
             html_content = {"title": output_file_name.replace('_', ' '),
                             "fasta_sources": str(self.fasta_sources),
                             "layout_algorithm": self.layout_algorithm,
@@ -554,8 +1003,6 @@ class TileLayout(object):
         json = []
         xy_seq_start = 0
         for index, contig in enumerate(self.contigs):
-            if index > 1000:
-                break  # I don't want to use a slice operator on the for loop because that will copy it
             xy_seq_start += contig.reset_padding + contig.title_padding
             xy_seq_end = xy_seq_start + len(contig.seq)
             json.append({"name": contig.name.replace("'", ""), "xy_seq_start": xy_seq_start, "xy_seq_end": xy_seq_end,
@@ -570,7 +1017,7 @@ class TileLayout(object):
         typically because output_fasta() was called for a webpage"""
         json = []
         for source in self.contig_memory:  # all files that have been processed
-            json.append([x for x in source])  # ',\n'.join(
+            json.append(source[:embedded_contigs])  # the rest are in contig_positions.bin
         if not json:
             print("Warning: no sequence position data was stored for the webpage.", file=sys.stderr)
         contigs_per_file = str(json)
@@ -617,9 +1064,17 @@ class TileLayout(object):
     def remember_contig_spacing(self):
         self.contig_memory.append(self.contig_struct())
 
+    def output_contig_positions(self, output_folder):
+        """Every contig position of each file, in the order of fasta_sources like ContigSpacingJSON"""
+        for bare_file, positions in zip(self.fasta_sources, self.contig_memory):
+            chunks_dir = os.path.join(output_folder, 'chunks', bare_file)
+            if not os.path.isdir(chunks_dir):
+                os.makedirs(chunks_dir)
+            write_contig_positions(os.path.join(chunks_dir, 'contig_positions.bin'), positions)
+
     def find_layout_height_by_chromosomes(self):
         """Set the number of mega-rows and the height of the layout.
-        Returns a new layout based on the current fasta file."""
+        Returns a new layout based on the current fasta file.  Only contig lengths are used."""
         if self.using_custom_layout:
             return self.levels
         lengths = [len(c.seq) for c in self.contigs]
@@ -641,13 +1096,78 @@ class TileLayout(object):
                                     [l.padding for l in self.levels],
                                     self.levels.origin)
 
-def write_contigs_to_chunks_dir(project_dir, fasta_name, contigs):
+raster_worker = {}  # per process state for draw_nucleotides_parallel()
+
+
+def init_raster_worker(canvas_path, each_layout, i_layout, color_table):
+    layout = TileLayout()  # only used for its layout and drawing methods
+    layout.each_layout, layout.i_layout = each_layout, i_layout
+    layout.image = MemmapCanvas(canvas_path)
+    raster_worker.update(layout=layout, color_table=color_table, mapped_files={})
+
+
+def draw_raster_task(task):
+    layout, mapped_files = raster_worker['layout'], raster_worker['mapped_files']
+    drawn = 0
+    for source, start, end, progress in task:
+        if isinstance(source, np.ndarray):
+            codes = source
+        else:
+            fasta_path, record = source
+            if fasta_path not in mapped_files:
+                mapped_files[fasta_path] = map_fasta(fasta_path)
+            sequence = IndexedSequence(mapped_files[fasta_path], record)
+            codes = np.frombuffer(sequence.fetch_bytes(start, end), dtype=np.uint8)
+        layout.draw_sequence(codes, progress, raster_worker['color_table'])
+        drawn += end - start
+    layout.image.flush()
+    return drawn
+
+
+class TitleCollector(object):
+    """Stands in for the canvas while titles are drawn for a CompositionPyramid"""
+    mode = 'RGB'
+
+    def __init__(self, pyramid, underneath=None):
+        self.pyramid = pyramid
+        self.underneath = underneath
+
+    def paste(self, im, box=None, mask=None):
+        self.pyramid.add_title(im, box, self.underneath)
+
+
+def write_contigs_to_chunks_dir(project_dir, fasta_name, contigs, block=sequence_block_bp):
+    """The viewer fetches sequence around the cursor from chunks/<fasta>/<contig>_<block>.txt, the
+    bare sequence of each contig cut into pieces of block nucleotides.  index.json next to them has
+    the block size and the name and length of each contig, numbered like ContigSpacingJSON."""
     chunks_dir = os.path.join(project_dir, 'chunks', fasta_name)
     try:
         os.makedirs(chunks_dir, exist_ok=True)
     except BaseException:
         pass
+    index = []
     for i, contig in enumerate(contigs):
-        filename = os.path.join(chunks_dir, '%i.fa' % i)
-        write_contigs_to_file(filename, [contig],verbose=False)
-
+        length = len(contig.seq)
+        for b, start in enumerate(range(0, length, block)):
+            with open(os.path.join(chunks_dir, '%i_%i.txt' % (i, b)), 'w') as f:
+                f.write(contig.seq[start: start + block])
+        index.append((contig.name, length))
+    with open(os.path.join(chunks_dir, 'index.json'), 'w') as f:
+        json.dump({'block': block, 'contigs': index}, f)
+
+
+def write_contig_positions(path, positions):
+    """Columns of contig_struct() that the viewer binary searches for the contig under the cursor,
+    so every contig of a fragmented assembly can be found without putting them all in index.html.
+    Little-endian: b'FDNAPOS1', uint32 header length, JSON header (count, dtype, columns), zero
+    padding to a multiple of 8 bytes, one array per column, then the names joined by newlines."""
+    columns = np.array([[p[c] for c in contig_position_columns] for p in positions],
+                       dtype=np.int64).reshape(-1, len(contig_position_columns))
+    dtype = 'u4' if not columns.size or (columns.min() >= 0 and columns.max() < 2 ** 32) else 'f8'
+    header = json.dumps({'count': len(positions), 'dtype': dtype,
+                         'columns': contig_position_columns}).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(b'FDNAPOS1' + struct.pack('<I', len(header)) + header)
+        f.write(b'\0' * (-(12 + len(header)) % 8))
+        f.write(columns.T.astype('<' + dtype).tobytes())
+        f.write('\n'.join(p['name'] for p in positions).encode('utf-8'))
@@ -0,0 +1,159 @@
+"""Single file pack of the many small files in a result folder: the DeepZoom tiles under
+GeneratedImages/dzc_output_files/ and optionally the sequence chunks/.  Copying, rsyncing and
+deleting one pack is much faster than hundreds of thousands of tiny files.  The results server
+(ResultsServer.py) answers the original URLs out of the pack by seeking to each entry.
+
+Pack layout (all integers big endian):
+    b'FDNAPACK'                          magic
+    file contents, one after another     hard linked files (solid tiles) are stored once
+    index: for every entry
+        >QQH  offset, length, name length
+        name                             utf-8 path relative to the result folder, '/' separated
+    >Q  offset of the index
+    b'FDNAPACK'
+Convert an existing result folder with:  python -m FluentDNA.TilePack results/<name>
+"""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import os
+import shutil
+import struct
+import sys
+import threading
+
+PACK_NAME = 'tiles.pack'
+MAGIC = b'FDNAPACK'
+ENTRY = struct.Struct('>QQH')
+FOOTER = struct.Struct('>Q8s')
+TILES_DIR = os.path.join('GeneratedImages', 'dzc_output_files')
+
+
+class TilePackWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.pack = open(path, 'wb')
+        self.pack.write(MAGIC)
+        self.index = []  # (name, offset, length)
+        self.stored = {}  # (device, inode) -> (offset, length) of hard linked files
+
+    def add_file(self, name, file_path):
+        stat = os.stat(file_path)
+        key = (stat.st_dev, stat.st_ino)
+        if stat.st_nlink > 1 and key in self.stored:
+            offset, length = self.stored[key]
+        else:
+            offset = self.pack.tell()
+            with open(file_path, 'rb') as f:
+                shutil.copyfileobj(f, self.pack)
+            length = self.pack.tell() - offset
+            self.stored[key] = (offset, length)
+        self.index.append((name, offset, length))
+
+    def close(self):
+        index_offset = self.pack.tell()
+        for name, offset, length in self.index:
+            encoded = name.encode('utf-8')
+            self.pack.write(ENTRY.pack(offset, length, len(encoded)) + encoded)
+        self.pack.write(FOOTER.pack(index_offset, MAGIC))
+        self.pack.close()
+
+
+class TilePack(object):
+    """Read only access to a pack.  read() seeks to one entry, it is safe to share between threads."""
+    def __init__(self, path):
+        self.path = path
+        self.pack = open(path, 'rb')
+        self.lock = threading.Lock()
+        self.pack.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, magic = FOOTER.unpack(self.pack.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a FluentDNA tile pack" % path)
+        self.pack.seek(index_offset)
+        index = self.pack.read(os.path.getsize(path) - FOOTER.size - index_offset)
+        self.entries = {}  # name -> (offset, length)
+        position = 0
+        while position < len(index):
+            offset, length, name_length = ENTRY.unpack_from(index, position)
+            position += ENTRY.size
+            self.entries[index[position: position + name_length].decode('utf-8')] = (offset, length)
+            position += name_length
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def read(self, name):
+        offset, length = self.entries[name]
+        with self.lock:
+            self.pack.seek(offset)
+            return self.pack.read(length)
+
+    def close(self):
+        self.pack.close()
+
+
+def packed_folders(result_dir, include_chunks=False):
+    folders = [TILES_DIR]
+    if include_chunks:
+        folders.append('chunks')
+    return [f for f in folders if os.path.isdir(os.path.join(result_dir, f))]
+
+
+def pack_results(result_dir, include_chunks=False, remove_files=True):
+    """Moves every tile (and sequence chunk) of a result folder into result_dir/tiles.pack.
+    The loose files are only removed once the pack is complete."""
+    folders = packed_folders(result_dir, include_chunks)
+    pack_path = os.path.join(result_dir, PACK_NAME)
+    writer = TilePackWriter(pack_path + '.partial')
+    for folder in folders:
+        for root, dirs, files in os.walk(os.path.join(result_dir, folder)):
+            dirs.sort()
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                writer.add_file(os.path.relpath(file_path, result_dir).replace(os.sep, '/'), file_path)
+    writer.close()
+    if os.path.exists(pack_path):
+        os.remove(pack_path)  # os.rename() won't replace a file on Windows
+    os.rename(writer.path, pack_path)
+    print("Packed %i files into %s" % (len(writer.index), pack_path))
+    if remove_files:
+        for folder in folders:
+            shutil.rmtree(os.path.join(result_dir, folder))
+    return pack_path
+
+
+def find_pack(file_path, server_root):
+    """Path of the tiles.pack in the closest folder above file_path, without leaving server_root"""
+    folder = os.path.dirname(os.path.abspath(file_path))
+    server_root = os.path.abspath(server_root)
+    while folder.startswith(server_root):
+        candidate = os.path.join(folder, PACK_NAME)
+        if os.path.isfile(candidate):
+            return candidate
+        if folder == server_root:
+            break
+        folder = os.path.dirname(folder)
+    return None
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(usage="python -m FluentDNA.TilePack results/<name> [--chunks] [--keep]",
+                                     description="Moves the DeepZoom tiles of an existing FluentDNA result "
+                                                 "folder into a single %s file." % PACK_NAME)
+    parser.add_argument('result_dirs', nargs='+', help="Result folders containing GeneratedImages/")
+    parser.add_argument('--chunks', action='store_true', help="Also pack the chunks/ sequence files.")
+    parser.add_argument('--keep', action='store_true', help="Don't delete the loose files afterwards.")
+    args = parser.parse_args()
+    for result_dir in args.result_dirs:
+        if not packed_folders(result_dir, args.chunks):
+            print("Nothing to pack in", result_dir, file=sys.stderr)
+            continue
+        pack_results(result_dir, args.chunks, not args.keep)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""Deep Zoom tiles rendered when the viewer asks for them (fluentdna --lazy_tiles), for genomes
+that are looked at once.  Nothing is drawn up front: the layout (contig padding from
+calc_all_padding() and the LayoutFrame) and the memory-mapped FASTA are kept by a TileRenderer,
+which colors the pixels of one requested tile straight from the sequence.  Zoomed in levels are
+drawn from nucleotides and shrunk the same way as a full pyramid, the zoomed out levels where a
+pixel covers at least composition_bp nucleotides come from a CompositionPyramid computed once.
+
+Encoded tiles are kept by a TileCache, an LRU in memory in front of an LRU on disk, both with a
+size limit.  The disk cache is the normal dzc_output_files folder, so a tile that was looked at
+is a plain file in the result."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import json
+import os
+import re
+import shutil
+import threading
+import zlib
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from FluentDNA.Canvas import BandCanvas
+from FluentDNA.CompositionPyramid import composition_level_count
+from FluentDNA.ResultsServer import ResultsRequestHandler, Resource
+from FluentDNA.deepzoom import DZIDescriptor, encode_tile, reduce_by_half, source_fingerprint
+
+TILE_NAME = re.compile(r'^(\d+)_(\d+)\.(\w+)$')
+
+
+class TileRenderer(object):
+    """Any tile of the Deep Zoom pyramid of a TileLayout, rendered on its own.  The layout needs
+    its contigs read and padded (read_contigs_and_calc_padding), nothing has to be drawn."""
+    def __init__(self, layout, tile_size=256, tile_overlap=1, tile_format="png", image_quality=0.95,
+                 compress_level=6, palette_tiles=False):
+        self.layout = layout
+        self.width, self.height = layout.max_dimensions(layout.image_length)
+        self.descriptor = DZIDescriptor(self.width, self.height, tile_size, tile_overlap, tile_format)
+        self.encoding = (tile_format, image_quality, compress_level, palette_tiles)
+        self.spacing = layout.contig_spacing()
+        self.color_table = layout.palette_lookup_table('RGB')
+        self.background = (255, 255, 255)
+        self.composition_levels = composition_level_count(self.descriptor, layout.composition_bp)
+        self.composition = None  # level -> pixels, computed by the first zoomed out request
+        self.composition_lock = threading.Lock()
+        self.titles = self.title_boxes()
+        if any(getattr(contig.seq, 'uneven', False) for contig in layout.contigs):
+            print("Note: the FASTA has uneven line lengths, every tile decodes whole contigs.  "
+                  "Reformatting it with even lines makes tiles much faster.")
+
+    def title_boxes(self):
+        """(left, top, right, bottom, total_progress, contig) around every title, with room for
+        the offset of vertical labels"""
+        boxes = []
+        if not self.layout.use_titles:
+            return boxes
+        for total_progress, contig in self.layout.title_positions():
+            left, top = self.layout.position_on_screen(total_progress)
+            right, bottom = self.layout.position_on_screen(total_progress + contig.title_padding - 2)
+            boxes.append((left, top, max(right, left + bottom - top) + 9, bottom + 1, total_progress, contig))
+        return boxes
+
+    def settings(self):
+        """Everything the tiles depend on, so tiles cached by another run can be recognized"""
+        d = self.descriptor
+        fastas = sorted(set(contig.seq.fasta_path for contig in self.layout.contigs
+                            if getattr(contig.seq, 'fasta_path', None)))
+        return dict(width=d.width, height=d.height, tile_size=d.tile_size, tile_overlap=d.tile_overlap,
+                    encoding=list(self.encoding), layout=self.layout.all_layouts_json(),
+                    titles=self.layout.use_titles, contigs=len(self.layout.contigs),
+                    colors=zlib.crc32(self.color_table.tobytes()), composition_levels=self.composition_levels,
+                    sources=[source_fingerprint(path) for path in fastas])
+
+    def render_pixels(self, x1, y1, x2, y2, band_pixels=1024 * 1024):
+        """(height, width, 3) pixels of the full resolution image between x1, y1 and x2, y2.
+        Colored band_pixels at a time, which bounds the temporary position arrays."""
+        width = x2 - x1
+        pixels = np.empty((y2 - y1, width, 3), dtype=np.uint8)
+        pixels[:] = self.background
+        band_height = max(1, band_pixels // width)
+        for top in range(y1, y2, band_height):
+            bottom = min(y2, top + band_height)
+            ys, xs = np.divmod(np.arange((bottom - top) * width, dtype=np.int64), width)
+            self.layout.color_points(xs + x1, ys + top, pixels[top - y1: bottom - y1].reshape(-1, 3),
+                                     self.spacing, self.color_table)
+        overlapping = [(total_progress, contig) for left, top, right, bottom, total_progress, contig
+                       in self.titles if left < x2 and right > x1 and top < y2 and bottom > y1]
+        if overlapping:
+            window = BandCanvas(Image.fromarray(pixels), y1, (self.width, self.height), left=x1)
+            for total_progress, contig in overlapping:
+                self.layout.draw_title(total_progress, contig, window)
+            pixels = np.asarray(window.image)
+        return pixels
+
+    def composition_pixels(self, level):
+        """Pixels of a whole zoomed out level.  The first call computes all of them in one pass
+        over the sequence, which takes about as long as reading the FASTA."""
+        with self.composition_lock:
+            if self.composition is None:
+                factor = 2 ** (self.descriptor.num_levels - self.composition_levels)
+                print("Computing %i zoom levels from composition" % self.composition_levels)
+                pyramid = self.layout.composition_pyramid(self.width, self.height, factor)
+                self.composition = dict(zip(reversed(range(self.composition_levels)),
+                                            (pixels for factor, pixels in pyramid.levels())))
+        return self.composition[level]
+
+    def render_tile(self, level, column, row):
+        """PIL image of one tile.  Zoomed in tiles cover factor x factor pixels of the full
+        image each, which are drawn and halved like PyramidWriter would."""
+        x1, y1, x2, y2 = self.descriptor.get_tile_bounds(level, column, row)
+        if level < self.composition_levels:
+            return Image.fromarray(np.ascontiguousarray(self.composition_pixels(level)[y1:y2, x1:x2]))
+        halvings = self.descriptor.num_levels - 1 - level
+        factor = 2 ** halvings
+        pixels = self.render_pixels(x1 * factor, y1 * factor,
+                                    min(self.width, x2 * factor), min(self.height, y2 * factor))
+        for halving in range(halvings):  # the full image edge can cut the last row and column short
+            pixels = reduce_by_half(pixels, 2 ** halving, min(self.width, x2 * factor) - x1 * factor,
+                                    min(self.height, y2 * factor) - y1 * factor)
+        return Image.fromarray(pixels)
+
+    def tile_exists(self, level, column, row):
+        if not 0 <= level < self.descriptor.num_levels:
+            return False
+        columns, rows = self.descriptor.get_num_tiles(level)
+        return 0 <= column < columns and 0 <= row < rows
+
+    def encode(self, tile):
+        encoded = BytesIO()
+        encode_tile(tile, encoded, *self.encoding)
+        return encoded.getvalue()
+
+
+class TileCache(object):
+    """Encoded tiles of a TileRenderer: an LRU in memory, then an LRU of files in the _files folder
+    of destination, then rendering.  Both are limited in bytes and drop the least recently used
+    tiles first.  destination is the Deep Zoom descriptor, which is written here."""
+    def __init__(self, renderer, destination, memory_bytes=256 * 1024 * 1024, disk_bytes=4 * 1024 ** 3):
+        self.renderer = renderer
+        self.tile_dir = os.path.splitext(destination)[0] + "_files"
+        self.settings_path = os.path.splitext(destination)[0] + '_lazy.json'
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()  # (level, column, row) -> encoded tile
+        self.memory_used = 0
+        self.disk = OrderedDict()  # tile path -> size, least recently used first
+        self.disk_used = 0
+        self.lock = threading.Lock()
+        self.rendering = {}  # tile -> Event, so a tile requested twice at once is rendered once
+        self.rendered = 0
+        self.started = self.check_settings()  # Last-Modified of every tile
+        renderer.descriptor.save(destination)
+        self.scan_disk()
+
+    def check_settings(self):
+        """Deletes cached tiles made with other settings or another FASTA.  Returns when the
+        current settings were first used."""
+        settings = self.renderer.settings()
+        try:
+            with open(self.settings_path) as f:
+                if json.load(f) == settings:
+                    return os.path.getmtime(self.settings_path)
+        except (IOError, OSError, ValueError):
+            pass
+        if os.path.isdir(self.tile_dir):
+            print("Deleting tiles in", self.tile_dir, "that were made with other settings")
+            shutil.rmtree(self.tile_dir)
+        os.makedirs(os.path.dirname(os.path.abspath(self.settings_path)), exist_ok=True)
+        with open(self.settings_path, 'w') as f:
+            json.dump(settings, f)
+        return os.path.getmtime(self.settings_path)
+
+    def scan_disk(self):
+        """Tiles left by an earlier run count towards the disk limit, oldest first"""
+        found = []
+        for root, dirs, files in os.walk(self.tile_dir):
+            for file_name in files:
+                if TILE_NAME.match(file_name):
+                    path = os.path.join(root, file_name)
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, path, stat.st_size))
+        for mtime, path, size in sorted(found):
+            self.disk[path] = size
+            self.disk_used += size
+
+    def tile_path(self, level, column, row):
+        return os.path.join(self.tile_dir, str(level),
+                            "%i_%i.%s" % (column, row, self.renderer.descriptor.tile_format))
+
+    def get(self, level, column, row):
+        """Encoded tile, or None if it isn't part of the pyramid"""
+        if not self.renderer.tile_exists(level, column, row):
+            return None
+        key = (level, column, row)
+        while True:
+            with self.lock:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    return self.memory[key]
+                if key not in self.rendering:
+                    self.rendering[key] = threading.Event()
+                    break
+                waiting = self.rendering[key]
+            waiting.wait()  # another thread is rendering this tile, it will be in memory
+        try:
+            data = self.read_disk(key)
+            if data is None:
+                data = self.renderer.encode(self.renderer.render_tile(level, column, row))
+                self.write_disk(key, data)
+                self.rendered += 1
+            with self.lock:
+                self.remember(key, data)
+            return data
+        finally:
+            with self.lock:
+                self.rendering.pop(key).set()
+
+    def remember(self, key, data):
+        self.memory[key] = data
+        self.memory_used += len(data)
+        while self.memory_used > self.memory_bytes and len(self.memory) > 1:
+            old_key, old_data = self.memory.popitem(last=False)
+            self.memory_used -= len(old_data)
+
+    def read_disk(self, key):
+        path = self.tile_path(*key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)  # recently used, for the next scan_disk()
+        except (IOError, OSError):
+            return None
+        with self.lock:
+            if path in self.disk:
+                self.disk.move_to_end(path)
+        return data
+
+    def write_disk(self, key, data):
+        path = self.tile_path(*key)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        with open(path + '.partial', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.partial', path)  # other readers never see half a tile
+        with self.lock:
+            self.disk_used += len(data) - self.disk.pop(path, 0)
+            self.disk[path] = len(data)
+            evicted = []
+            while self.disk_used > self.disk_bytes and len(self.disk) > 1:
+                old_path, size = self.disk.popitem(last=False)
+                self.disk_used -= size
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+class LazyTileRequestHandler(ResultsRequestHandler):
+    """ResultsRequestHandler that answers tile requests of results registered in caches by
+    rendering them.  Everything else, including the validators and ranges, works the same."""
+    caches = {}  # dzc_output_files folder -> TileCache, see serve_lazy_tiles()
+
+    def find_resource(self, path):
+        level_dir, file_name = os.path.split(path)
+        tile_dir, level = os.path.split(level_dir)
+        cache = self.caches.get(tile_dir)
+        match = TILE_NAME.match(file_name)
+        if cache is None or not match or not level.isdigit() \
+                or match.group(3) != cache.renderer.descriptor.tile_format:
+            return ResultsRequestHandler.find_resource(self, path)
+        data = cache.get(int(level), int(match.group(1)), int(match.group(2)))
+        if data is None:
+            return None
+        return Resource(BytesIO(data), len(data), cache.started,
+                        '"%x-%s-%s"' % (int(cache.started), level, file_name), self.guess_type(path))
+
+
+def serve_lazy_tiles(cache):
+    """Answers the tile requests of cache's result with LazyTileRequestHandler"""
+    LazyTileRequestHandler.caches[os.path.abspath(cache.tile_dir)] = cache
@@ -5,6 +5,7 @@ import os
 from DNASkittleUtils.Contigs import write_complete_fasta
 from FluentDNA import gap_char
 from FluentDNA.ChainParser import ChainParser, Batch
+from FluentDNA.PackedSequence import decode
 from FluentDNA.Span import Span
 from FluentDNA.ChainFiles import fetch_all_chains
 
@@ -73,11 +74,11 @@ class UniqueOnlyChainParser(ChainParser):
     def write_zero_coverage_areas(self, unique_seq_file):
         uniq_collection = []  # of strings
         for region in self.uncovered_areas:
-            unique_region = self.ref_sequence[region.begin: region.end]
+            unique_region = self.ref_sequence.view(region.begin, region.end).values()
             if not self.preserve_Ns:
-                unique_region = unique_region.replace('N', '')
+                unique_region = unique_region[unique_region != ord('N')]
             if len(unique_region):
-                uniq_collection.append(unique_region + gap_char)
+                uniq_collection.append(decode(unique_region) + gap_char)
         write_complete_fasta(unique_seq_file, uniq_collection)
         print("Wrote", unique_seq_file)
         return unique_seq_file
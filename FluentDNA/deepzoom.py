@@ -36,12 +36,19 @@
 #===============================================================================
 
 
+import json
 import math
 import optparse
 import os
 from PIL import Image as PILImage
 import sys
+import warnings
 import xml.dom.minidom
+from collections import deque
+
+import numpy as np
+
+from FluentDNA.Canvas import MemmapCanvas, PngReader, open_image, mode_channels, is_canvas_file
 
 # Monkey Patch: Sets a much larger size to avoid the DecompressionBombWarning that
 # scares users.  FluentDNA will suck up a lot of RAM, but especially on clusters,
@@ -52,17 +59,10 @@ PILImage.MAX_IMAGE_PIXELS = 10 * 1024 * 1024 * 1024  # 10GB
 
 NS_DEEPZOOM = "http://schemas.microsoft.com/deepzoom/2008"
 
-resize_filter_map = {
-    "cubic": PILImage.CUBIC,
-    "bilinear": PILImage.BILINEAR,
-    "bicubic": PILImage.BICUBIC,
-    "nearest": PILImage.NEAREST,
-    "antialias": PILImage.ANTIALIAS,
-    }
-
 image_format_map = {
     "jpg": "jpg",
     "png": "png",
+    "webp": "webp",  # always lossless
     }
 
 class DZIDescriptor(object):
@@ -169,25 +169,57 @@ class Image(object):
 class ImageCreator(object):
     """Creates Deep Zoom images."""
     def __init__(self, tile_size=256, tile_overlap=1, tile_format="jpg",
-                 image_quality=0.95, resize_filter=None):
+                 image_quality=0.95, resize_filter=None, workers=1, compress_level=6, palette_tiles=False,
+                 resume=False, lowest_level=0):
+        """:param workers: processes encoding tiles.  Each one reads rows of tiles straight
+        from a memory-mapped copy of the level.
+        :param compress_level: see TileSaver, along with palette_tiles
+        :param resume: skip the rows of tiles a previous, interrupted run finished (see TileCheckpoint)
+        :param lowest_level: levels below this one were already written some other way
+        :param resize_filter: deprecated and ignored, every level is an exact 2x box reduction"""
         self.tile_size = int(tile_size)
+        self.resume = resume
+        self.lowest_level = lowest_level
+        self.workers = max(1, int(workers))
+        self.compress_level = compress_level
+        self.palette_tiles = palette_tiles
         self.tile_format = tile_format
         self.tile_overlap = _clamp(int(tile_overlap), 0, 10)
         self.image_quality = _clamp(image_quality, 0, 1.0)
         if not tile_format in image_format_map:
             self.tile_format = "jpg"
-        self.resize_filter = resize_filter
+        if resize_filter is not None:
+            warnings.warn("ImageCreator(resize_filter=...) is ignored, levels are exact 2x box reductions",
+                          FutureWarning, stacklevel=2)
 
     def get_image(self, level):
-        """Returns the bitmap image at the given level."""
+        """Returns the bitmap image at the given level.  Each level is an exact 2x box reduction
+        of the level above it instead of a resize of the full image, so levels have to be
+        requested from the largest down."""
         assert 0 <= level and level < self.descriptor.num_levels, "Invalid pyramid level"
         width, height = self.descriptor.get_dimensions(level)
         # don't transform to what we already have
         if self.descriptor.width == width and self.descriptor.height == height:
             return self.image
-        if (self.resize_filter is None) or (self.resize_filter not in resize_filter_map):
-            return self.image.resize((width, height), PILImage.ANTIALIAS)
-        return self.image.resize((width, height), resize_filter_map[self.resize_filter])
+        source = self.image if self.larger_level is None else self.larger_level
+        assert source.size == self.descriptor.get_dimensions(level + 1), "Levels must be made largest first"
+        return reduce_in_bands(source, os.path.join(self.scratch_dir, 'level_%i.npy' % level),
+                               factor=2 ** (self.descriptor.num_levels - 2 - level),
+                               full_size=(self.descriptor.width, self.descriptor.height))
+
+    def create_streamed(self, reader, destination):
+        """Deep Zoom image from a PngReader.  Memory is bounded by a few rows of tiles per level."""
+        writer = PyramidWriter(reader.width, reader.height, _expand(destination),
+                               tile_size=self.tile_size, tile_overlap=self.tile_overlap,
+                               tile_format=self.tile_format, image_quality=self.image_quality,
+                               palette=reader.palette if reader.mode == 'P' else None,
+                               compress_level=self.compress_level, palette_tiles=self.palette_tiles,
+                               workers=self.workers, resume=self.resume, source=reader.path,
+                               lowest_level=self.lowest_level)
+        print("Streaming %ix%i %s into tiles" % (reader.width, reader.height, os.path.basename(reader.path)))
+        for top, pixels in reader.bands():
+            writer.add_rows(pixels)
+        writer.close()
 
     def tiles(self, level):
         """Iterator for all tiles in the given level. Returns (column, row) of a tile."""
@@ -197,8 +229,18 @@ class ImageCreator(object):
                 yield (column, row)
 
     def create(self, source, destination):
-        """Creates Deep Zoom image from source file and saves it to destination."""
-        self.image = PILImage.open(source)
+        """Creates Deep Zoom image from source file and saves it to destination.
+        source can also be an image that is already open: PIL image, MemmapCanvas or numpy array.
+        Plain 8-bit PNG files are streamed a band of rows at a time instead of decoded whole."""
+        opened = isinstance(source, str)
+        if opened and not is_canvas_file(source):
+            reader = PngReader.open(source)
+            if reader is not None:
+                return self.create_streamed(reader, destination)
+        self.image = open_image(source) if opened else source
+        if isinstance(self.image, np.ndarray):
+            self.image = PILImage.fromarray(self.image)
+        self.larger_level = None
         width, height = self.image.size
         self.descriptor = DZIDescriptor(width=width,
                                         height=height,
@@ -209,26 +251,439 @@ class ImageCreator(object):
         image_name = os.path.splitext(os.path.basename(destination))[0]
         dir_name = os.path.dirname(destination)
         image_files = _ensure(os.path.join(_ensure(dir_name), "%s_files"%image_name))
-
-        # Create tiles
-        for level in range(self.descriptor.num_levels):
-            level_dir = _ensure(os.path.join(image_files, str(level)))
-            level_image = self.get_image(level)
-            for (column, row) in self.tiles(level):
-                bounds = self.descriptor.get_tile_bounds(level, column, row)
-                tile = level_image.crop(bounds)
-                format = self.descriptor.tile_format
-                tile_path = os.path.join(level_dir,
-                                         "%s_%s.%s"%(column, row, format))
-                tile_file = open(tile_path, "wb")
-                if self.descriptor.tile_format == "jpg":
-                    tile.save(tile_file, "JPEG",
-                              quality=int(self.image_quality * 100))
+        self.scratch_dir = dir_name
+        self.tile_saver = TileSaver(self.descriptor.tile_format, self.image_quality,
+                                    self.compress_level, self.palette_tiles)
+        self.checkpoint = TileCheckpoint(destination, self.descriptor, image_files, self.tile_saver,
+                                         source, self.resume)
+        self.pool = None
+        if self.workers > 1:
+            from multiprocessing import Pool
+            self.pool = Pool(self.workers, initializer=init_tile_worker,
+                             initargs=(self.descriptor, self.tile_saver))  # each worker gets a copy
+
+        try:
+            # Create tiles, largest level first so each level can be made from the one before
+            for level in reversed(range(self.lowest_level, self.descriptor.num_levels)):
+                level_dir = _ensure(os.path.join(image_files, str(level)))
+                level_image = self.get_image(level)
+                if level_image is not self.image:  # the level above isn't needed anymore
+                    release(self.larger_level)
+                    self.larger_level = level_image
+                columns, rows = self.descriptor.get_num_tiles(level)
+                rows_left = [row for row in range(rows) if not self.checkpoint.is_done(level, row)]
+                if self.pool is not None and columns * len(rows_left) > 16:
+                    self.save_tiles_parallel(level, level_image, level_dir, rows_left)
                 else:
-                    tile.save(tile_file, self.descriptor.tile_format)
+                    for row in rows_left:
+                        for column in range(columns):
+                            bounds = self.descriptor.get_tile_bounds(level, column, row)
+                            tile_path = os.path.join(level_dir, "%s_%s.%s" % (column, row, self.descriptor.tile_format))
+                            self.tile_saver.save(level_image.crop(bounds), tile_path)
+                        self.checkpoint.finish_row(level, row)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+        release(self.larger_level)
+        self.larger_level = None
+        if opened and isinstance(self.image, MemmapCanvas):
+            self.image.close()
+        self.image = None
+        self.tile_saver.report()
 
         # Create descriptor
         self.descriptor.save(destination)
+        self.checkpoint.complete()
+
+    def save_tiles_parallel(self, level, level_image, level_dir, rows):
+        """Hands out one row of tiles per task.  Workers can't share a PIL image, so a level
+        that is in memory is first copied to a scratch canvas file they can all map."""
+        scratch = None
+        if isinstance(level_image, MemmapCanvas):
+            level_image.flush()
+            canvas_path = level_image.path
+        else:
+            mode = level_image.mode if level_image.mode in mode_channels else 'RGB'
+            canvas_path = os.path.join(self.scratch_dir, 'level_%i.tiles.npy' % level)
+            scratch = MemmapCanvas(canvas_path, level_image.size, mode,
+                                   palette=level_image.getpalette() if mode == 'P' else None)
+            for top, bottom in scratch.bands():
+                scratch.paste(level_image.crop((0, top, level_image.width, bottom)).convert(mode), (0, top))
+            scratch.flush()
+        tasks = [(canvas_path, level, row, level_dir) for row in rows]
+        try:
+            for row, linked in self.pool.imap_unordered(save_tile_row, tasks):
+                self.tile_saver.linked += linked
+                self.checkpoint.finish_row(level, row)
+        finally:
+            if scratch is not None:
+                scratch.close(delete=True)
+
+
+tile_worker = {}  # per process state for ImageCreator.save_tiles_parallel()
+
+
+def init_tile_worker(descriptor, tile_saver):
+    tile_worker.update(descriptor=descriptor, canvas=None, saver=tile_saver)
+
+
+def save_tile_row(task):
+    canvas_path, level, row, level_dir = task
+    descriptor, canvas = tile_worker['descriptor'], tile_worker['canvas']
+    if canvas is None or canvas.path != canvas_path:
+        if canvas is not None:
+            canvas.close()  # the previous level, which may already be deleted
+        canvas = tile_worker['canvas'] = MemmapCanvas(canvas_path)
+    saver = tile_worker['saver']
+    linked_before = saver.linked
+    columns, rows = descriptor.get_num_tiles(level)
+    for column in range(columns):
+        bounds = descriptor.get_tile_bounds(level, column, row)
+        tile_path = os.path.join(level_dir, "%s_%s.%s" % (column, row, descriptor.tile_format))
+        saver.save(canvas.crop(bounds), tile_path)
+    return row, saver.linked - linked_before
+
+
+def tile_image(pixels, palette=None):
+    """PIL image of a (height, width, channels) tile.  One channel is palette indices when there's a palette."""
+    if pixels.shape[2] == 1:
+        tile = PILImage.fromarray(pixels[:, :, 0], 'P' if palette is not None else 'L')
+        if palette is not None:
+            tile.putpalette(palette)
+        return tile
+    return PILImage.fromarray(pixels)
+
+
+def save_tile_pixels(pixels, palette, tile_path):
+    """PyramidWriter tile encoded by a worker process"""
+    saver = tile_worker['saver']
+    linked_before = saver.linked
+    saver.save(tile_image(pixels, palette), tile_path)
+    return saver.linked - linked_before
+
+
+def encode_tile(tile, tile_path, tile_format, image_quality, compress_level=6, palette_tiles=False):
+    if tile_format == "jpg" and tile.mode != 'RGB':  # JPEG has no alpha or palette
+        rgba = tile.convert('RGBA')
+        tile = PILImage.new('RGB', tile.size, (255, 255, 255))  # the white background of every layout
+        tile.paste(rgba, mask=rgba)
+    elif tile_format == "webp" and tile.mode not in ('RGB', 'RGBA'):
+        tile = tile.convert('RGB')  # palette tiles from an indexed canvas
+    if tile_format == "jpg":
+        tile.save(tile_path, "JPEG", quality=int(image_quality * 100))
+    elif tile_format == "webp":
+        tile.save(tile_path, "WEBP", lossless=True, method=compress_level * 6 // 9)
+    else:
+        if palette_tiles and tile.mode == 'RGB':
+            tile = palette_copy(tile) or tile
+        tile.save(tile_path, tile_format, compress_level=compress_level)
+
+
+def palette_copy(tile, max_colors=256):
+    """Lossless palette mode copy of an RGB tile, or None if it has more than max_colors.
+    Nucleotide tiles at the full resolution levels only have a few dozen colors."""
+    if tile.getcolors(max_colors) is None:
+        return None
+    pixels = np.asarray(tile).astype(np.uint32)
+    packed = (pixels[:, :, 0] << 16) | (pixels[:, :, 1] << 8) | pixels[:, :, 2]
+    colors, indices = np.unique(packed, return_inverse=True)
+    copy = PILImage.fromarray(indices.reshape(packed.shape).astype(np.uint8), 'P')
+    rgb = np.stack([(colors >> 16) & 255, (colors >> 8) & 255, colors & 255], axis=1)
+    copy.putpalette(rgb.astype(np.uint8).ravel().tolist())
+    return copy
+
+
+def solid_color_key(tile):
+    """(mode, size, color) if every pixel of the tile is the same color, otherwise None.
+    The first row is checked on its own so most busy tiles are rejected after one row."""
+    pixels = np.asarray(tile)
+    pixels = pixels.reshape(pixels.shape[0] * pixels.shape[1], -1)
+    if not len(pixels):
+        return None
+    color = pixels[0]
+    if not (pixels[:tile.size[0]] == color).all() or not (pixels == color).all():
+        return None
+    return tile.mode, tile.size, color.tobytes()
+
+
+class TileSaver(object):
+    """Encodes each distinct solid color tile once.  Later tiles of the same size and color
+    (title and contig padding, gaps between rows, N runs) are hard links to the first file.
+    The viewer can't tell the difference, but there's far less encoding and disk usage."""
+    def __init__(self, tile_format, image_quality, compress_level=6, palette_tiles=False):
+        """:param compress_level: 0-9, zlib level for png and effort for lossless webp tiles
+        :param palette_tiles: save png tiles with 256 colors or less in palette mode"""
+        self.tile_format = tile_format
+        self.image_quality = image_quality
+        self.compress_level = compress_level
+        self.palette_tiles = palette_tiles
+        self.solid_tiles = {}  # solid_color_key() -> path of the encoded tile
+        self.linked = 0
+
+    def save(self, tile, tile_path):
+        if os.path.lexists(tile_path):
+            os.remove(tile_path)  # writing into an old hard link would change every tile linked to it
+        key = solid_color_key(tile)
+        if key in self.solid_tiles:
+            try:
+                os.link(self.solid_tiles[key], tile_path)
+                self.linked += 1
+                return
+            except OSError:  # file system without hard links
+                del self.solid_tiles[key]
+        encode_tile(tile, tile_path, self.tile_format, self.image_quality,
+                    self.compress_level, self.palette_tiles)
+        if key is not None:
+            self.solid_tiles[key] = tile_path
+
+    def report(self):
+        if self.linked:
+            print("Linked %i solid color tiles instead of encoding them" % self.linked)
+
+
+class TileCheckpoint(object):
+    """Manifest of the rows of tiles already written for a Deep Zoom image, so a run that was
+    killed can start again where it stopped.  It is saved next to the descriptor after every
+    row of tiles and deleted once the descriptor is written.  On resume, the recorded rows are
+    only trusted if the settings match and every tile in them is a non-empty file."""
+    def __init__(self, destination, descriptor, image_files, tile_saver, source=None, resume=False):
+        self.path = os.path.splitext(destination)[0] + '_progress.json'
+        self.descriptor = descriptor
+        self.image_files = image_files
+        self.settings = dict(width=descriptor.width, height=descriptor.height, tile_size=descriptor.tile_size,
+                             tile_overlap=descriptor.tile_overlap, tile_format=descriptor.tile_format,
+                             image_quality=tile_saver.image_quality, compress_level=tile_saver.compress_level,
+                             palette_tiles=tile_saver.palette_tiles, source=source_fingerprint(source))
+        self.done = {}  # level -> set of finished tile rows
+        if resume:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if saved.get('settings') != self.settings:
+            print("Deep Zoom progress in", self.path, "is for a different image or settings, starting over")
+            return
+        kept = total = 0
+        for level, ranges in saved.get('rows', {}).items():
+            for start, end in ranges:
+                for row in range(start, end):
+                    total += 1
+                    if self.tiles_exist(int(level), row):
+                        self.done.setdefault(int(level), set()).add(row)
+                        kept += 1
+        print("Resuming Deep Zoom: %i rows of tiles already done" % kept +
+              (", %i with missing tiles will be redone" % (total - kept) if kept < total else ""))
+
+    def tiles_exist(self, level, row):
+        columns, rows = self.descriptor.get_num_tiles(level)
+        for column in range(columns):
+            try:
+                if not os.path.getsize(os.path.join(self.image_files, str(level), "%s_%s.%s" % (
+                        column, row, self.descriptor.tile_format))):
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def is_done(self, level, row):
+        return row in self.done.get(level, ())
+
+    def finish_row(self, level, row):
+        self.done.setdefault(level, set()).add(row)
+        self.save()
+
+    def save(self):
+        rows = {}
+        for level, done in self.done.items():
+            ranges = rows[str(level)] = []  # runs of finished rows keep the file small
+            for row in sorted(done):
+                if ranges and ranges[-1][1] == row:
+                    ranges[-1][1] = row + 1
+                else:
+                    ranges.append([row, row + 1])
+        with open(self.path + '.partial', 'w') as f:
+            json.dump({'settings': self.settings, 'rows': rows}, f)
+        os.replace(self.path + '.partial', self.path)  # a kill while saving leaves the old manifest
+
+    def complete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def source_fingerprint(source):
+    """Identifies an image file for TileCheckpoint.  Images in memory, and canvas files that
+    are drawn again by every run, can't be told apart."""
+    if not isinstance(source, str) or is_canvas_file(source):
+        return None
+    stat = os.stat(source)
+    return [os.path.abspath(source), stat.st_size, int(stat.st_mtime)]
+
+
+class PyramidWriter(object):
+    """Writes a Deep Zoom image from rows of the full resolution image, given top to bottom.
+    Each level only holds the rows its next row of tiles needs and passes 2x box reduced rows
+    down to the level below, so memory stays at a few rows of tiles however big the image is.
+    With workers > 1 the tiles are encoded by a process pool.  With resume, rows of tiles that
+    an interrupted run finished are skipped (see TileCheckpoint), though every row still has to
+    be added.  source identifies the image being streamed, if it's a file.  Levels below
+    lowest_level are left alone, for when they were already written another way."""
+    def __init__(self, width, height, destination, tile_size=256, tile_overlap=1,
+                 tile_format="png", image_quality=0.95, palette=None, compress_level=6, palette_tiles=False,
+                 workers=1, resume=False, source=None, lowest_level=0):
+        self.descriptor = DZIDescriptor(width=width, height=height, tile_size=tile_size,
+                                        tile_overlap=tile_overlap, tile_format=tile_format)
+        self.image_quality = image_quality
+        self.tile_saver = TileSaver(tile_format, image_quality, compress_level, palette_tiles)
+        self.workers = workers
+        self.pool = None
+        if workers > 1:
+            from multiprocessing import Pool
+            self.pool = Pool(workers, initializer=init_tile_worker, initargs=(self.descriptor, self.tile_saver))
+        # tiles being encoded, so the queue doesn't outgrow memory, and (None, (level, row)) after a row
+        self.pending = deque()
+        self.destination = _expand(destination)
+        image_name = os.path.splitext(os.path.basename(self.destination))[0]
+        self.image_files = _ensure(os.path.join(_ensure(os.path.dirname(self.destination)),
+                                                "%s_files" % image_name))
+        self.checkpoint = TileCheckpoint(self.destination, self.descriptor, self.image_files, self.tile_saver,
+                                         source, resume)
+        self.palette = palette  # rows at the top level are palette indices when this is set
+        self.lowest_level = lowest_level
+        levels = range(self.descriptor.num_levels)
+        self.buffers = {level: None for level in levels}  # rows not yet cut into tiles
+        self.buffer_top = {level: 0 for level in levels}  # level y of the first buffered row
+        self.next_tile_row = {level: 0 for level in levels}
+        self.unpaired = {level: None for level in levels}  # odd row waiting to be reduced
+        self.reduced_top = {level: 0 for level in levels}  # level y of the first row not yet reduced
+
+    def add_rows(self, pixels, level=None):
+        """pixels is a (rows, width, channels) uint8 array of the next rows of the level"""
+        level = self.descriptor.num_levels - 1 if level is None else level
+        buffer = self.buffers[level]
+        self.buffers[level] = pixels if buffer is None else np.concatenate((buffer, pixels))
+        self.write_tile_rows(level)
+        if level > self.lowest_level:
+            if self.palette is not None and level == self.descriptor.num_levels - 1:
+                colors = np.array(self.palette[:768], dtype=np.uint8).reshape(-1, 3)
+                pixels = colors[pixels[:, :, 0]]
+            if self.unpaired[level] is not None:
+                pixels = np.concatenate((self.unpaired[level], pixels))
+            even = len(pixels) - len(pixels) % 2
+            self.unpaired[level] = pixels[even:] if even < len(pixels) else None
+            if even:
+                self.add_rows(self.reduce(pixels[:even], level), level - 1)
+
+    def reduce(self, pixels, level):
+        """Rows for the level below from the next rows of level, weighted at the image edge"""
+        factor = 2 ** (self.descriptor.num_levels - 1 - level)
+        top = self.reduced_top[level]
+        self.reduced_top[level] += len(pixels)
+        return reduce_by_half(pixels, factor, self.descriptor.width, self.descriptor.height - top * factor)
+
+    def write_tile_rows(self, level, final=False):
+        columns, rows = self.descriptor.get_num_tiles(level)
+        level_dir = _ensure(os.path.join(self.image_files, str(level)))
+        buffer, top = self.buffers[level], self.buffer_top[level]
+        while self.next_tile_row[level] < rows:
+            row = self.next_tile_row[level]
+            y1, y2 = self.descriptor.get_tile_bounds(level, 0, row)[1::2]
+            if top + len(buffer) < y2 and not final:
+                break  # wait for more rows
+            if not self.checkpoint.is_done(level, row):
+                for column in range(columns):
+                    x1, _, x2, _ = self.descriptor.get_tile_bounds(level, column, row)
+                    self.save_tile(buffer[y1 - top: y2 - top, x1: x2], level,
+                                   os.path.join(level_dir, "%s_%s.%s" % (column, row, self.descriptor.tile_format)))
+                self.pending.append((None, (level, row)))
+                self.finish_tasks(8 * self.workers if self.pool is not None else 0)
+            self.next_tile_row[level] = row + 1
+            keep = (row + 1) * self.descriptor.tile_size - self.descriptor.tile_overlap  # next tile's top
+            buffer, top = buffer[keep - top:], keep
+        self.buffers[level], self.buffer_top[level] = buffer, top
+
+    def save_tile(self, pixels, level, tile_path):
+        palette = self.palette if pixels.shape[2] == 1 else None
+        if self.pool is None:
+            self.tile_saver.save(tile_image(pixels, palette), tile_path)
+            return
+        self.pending.append((self.pool.apply_async(save_tile_pixels, (pixels, palette, tile_path)), None))
+
+    def finish_tasks(self, keep=0):
+        """Waits for all but keep of the pending tiles.  A row is recorded once its tiles are written."""
+        while len(self.pending) > keep:
+            result, finished_row = self.pending.popleft()
+            if result is not None:
+                self.tile_saver.linked += result.get()
+            else:
+                self.checkpoint.finish_row(*finished_row)
+
+    def close(self):
+        """Writes the last partial rows of tiles in every level and the descriptor"""
+        try:
+            for level in reversed(range(self.lowest_level, self.descriptor.num_levels)):
+                self.write_tile_rows(level, final=True)
+                if level > self.lowest_level and self.unpaired[level] is not None:
+                    self.add_rows(self.reduce(self.unpaired[level], level), level - 1)
+                    self.unpaired[level] = None
+            self.finish_tasks()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        self.descriptor.save(self.destination)
+        self.checkpoint.complete()
+        self.tile_saver.report()
+
+
+def reduce_by_half(pixels, factor=1, width=None, height=None):
+    """2x2 box average of pixels that each stand for factor x factor pixels of the full image,
+    starting at a multiple of factor.  Like CompositionPyramid.levels(), each average is over the
+    part of the block inside the image: width and height are the full image size measured from
+    pixels[0, 0], and a last column or row that the edge cuts short counts by how much of it is
+    inside.  They can be left out when pixels doesn't reach the right or bottom edge."""
+    rows, columns = pixels.shape[:2]
+    row_weights = np.full(rows, factor, dtype=np.int64)
+    column_weights = np.full(columns, factor, dtype=np.int64)
+    if height is not None:
+        row_weights[-1] = min(factor, height - (rows - 1) * factor)
+    if width is not None:
+        column_weights[-1] = min(factor, width - (columns - 1) * factor)
+    # pairs of whole rows and columns are plain averages, the edge is weighted separately
+    even_rows = (rows - (row_weights[-1] != factor)) // 2 * 2
+    even_columns = (columns - (column_weights[-1] != factor)) // 2 * 2
+    reduced = np.empty(((rows + 1) // 2, (columns + 1) // 2) + pixels.shape[2:], dtype=np.uint8)
+    whole = pixels[:even_rows, :even_columns].astype(np.uint16)
+    total = whole[0::2, 0::2] + whole[1::2, 0::2] + whole[0::2, 1::2] + whole[1::2, 1::2]
+    reduced[:even_rows // 2, :even_columns // 2] = (total + 2) // 4
+    if even_rows < rows:
+        reduced[even_rows // 2:] = weighted_halves(pixels[even_rows:], row_weights[even_rows:], column_weights)
+    if even_columns < columns:
+        reduced[:even_rows // 2, even_columns // 2:] = weighted_halves(
+            pixels[:even_rows, even_columns:], row_weights[:even_rows], column_weights[even_columns:])
+    return reduced
+
+
+def weighted_halves(pixels, row_weights, column_weights):
+    """reduce_by_half() of a strip along the edge, each pixel weighted by its area in the full image"""
+    rows, columns = pixels.shape[:2]
+    area = np.zeros((rows + rows % 2, columns + columns % 2), dtype=np.int64)
+    area[:rows, :columns] = np.outer(row_weights, column_weights)
+    sums = np.zeros(area.shape + pixels.shape[2:], dtype=np.int64)
+    sums[:rows, :columns] = pixels
+    if pixels.ndim == 3:
+        area = area[:, :, None]
+    sums *= area
+    sums = sums[0::2, 0::2] + sums[1::2, 0::2] + sums[0::2, 1::2] + sums[1::2, 1::2]
+    area = area[0::2, 0::2] + area[1::2, 0::2] + area[0::2, 1::2] + area[1::2, 1::2]
+    return ((sums * 2 + area) // (area * 2)).astype(np.uint8)
 
 
 class CollectionCreator(object):
@@ -357,6 +812,36 @@ class CollectionCreator(object):
 
 ################################################################################
 
+def reduce_in_bands(source, scratch_path, band_height=512, memory_limit=128 * 1024 * 1024,
+                    factor=1, full_size=None):
+    """Half size copy of source (a PIL image or MemmapCanvas) made by reduce_by_half() one band
+    of rows at a time, so there is never a second full size copy of the source in memory.
+    Palette sources are expanded to RGB.  Results bigger than memory_limit go to a scratch canvas.
+    factor and full_size are for a source that is itself a reduced level, see reduce_by_half()."""
+    full_width, full_height = full_size or (source.width * factor, source.height * factor)
+    width, height = (source.width + 1) // 2, (source.height + 1) // 2
+    mode = 'RGBA' if source.mode == 'RGBA' else 'RGB'
+    if width * height * len(mode) > memory_limit:
+        result = MemmapCanvas(scratch_path, (width, height), mode)
+        pixels = result.array
+    else:
+        result = None
+        pixels = np.empty((height, width, len(mode)), dtype=np.uint8)
+    for top in range(0, source.height, band_height):  # band_height is even so rows stay paired
+        band = source.crop((0, top, source.width, min(source.height, top + band_height)))
+        if band.mode != mode:
+            band = band.convert(mode)
+        reduced = reduce_by_half(np.asarray(band), factor, full_width, full_height - top * factor)
+        pixels[top // 2: top // 2 + len(reduced)] = reduced
+    return result if result is not None else PILImage.fromarray(pixels, mode)
+
+
+def release(level_image):
+    """Scratch canvases are deleted once the next level has been made from them"""
+    if isinstance(level_image, MemmapCanvas):
+        level_image.close(delete=True)
+
+
 def _expand(d):
     return os.path.abspath(os.path.expanduser(os.path.expandvars(d)))
 
@@ -389,9 +874,6 @@ def main():
                       default=1, help="Overlap of the tiles in pixels (0-10). Default: 1")
     parser.add_option("-q", "--image_quality", dest="image_quality", type="float",
                       default=0.95, help="Quality of the image output (0-1). Default: 0.95")
-    parser.add_option("-r", "--resize_filter", dest="resize_filter", default="antialias",
-                      help="Type of filter for resizing (bicubic, nearest, \
-                            bilinear, antialias (best). Default: antialias")
 
     (options, args) = parser.parse_args()
 
@@ -406,13 +888,10 @@ def main():
 
     if not options.destination:
         options.destination = os.path.splitext(source)[0] + ".dzi"
-    if options.resize_filter and options.resize_filter in resize_filter_map:
-        options.resize_filter = resize_filter_map[options.resize_filter]
 
     creator = ImageCreator(tile_size=options.tile_size,
                            tile_format=options.tile_format,
-                           image_quality=options.image_quality,
-                           resize_filter=options.resize_filter)
+                           image_quality=options.image_quality)
     creator.create(source, options.destination)
 
 if __name__ == "__main__":
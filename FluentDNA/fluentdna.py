@@ -45,6 +45,7 @@ from FluentDNA import VERSION
 
 import argparse
 import gc
+import threading
 from datetime import datetime
 from DNASkittleUtils.CommandLineUtils import just_the_name
 from FluentDNA.FluentDNAUtils import create_deepzoom_stack, make_output_directory, base_directories, \
@@ -58,7 +59,12 @@ from FluentDNA.UniqueOnlyChainParser import UniqueOnlyChainParser
 from FluentDNA.AnnotatedAlignment import AnnotatedAlignment
 from FluentDNA.TileLayout import TileLayout
 from FluentDNA.MultipleAlignmentLayout import MultipleAlignmentLayout
-from DNASkittleUtils.Contigs import write_contigs_to_file, read_contigs
+from DNASkittleUtils.Contigs import write_contigs_to_file
+from FluentDNA.FastaIndex import read_contigs_indexed
+from FluentDNA.Canvas import delete_canvas, BandCanvas
+from FluentDNA.TilePack import pack_results
+from FluentDNA.ResultsServer import ResultsRequestHandler, ResultsServer, precompress
+from FluentDNA.TileServer import TileRenderer, TileCache, LazyTileRequestHandler, serve_lazy_tiles
 
 if sys.platform == 'win32':
     OS_DIR = 'windows'
@@ -95,29 +101,19 @@ def query_yes_no(question, default='yes'):
             sys.stdout.write("Please respond with 'yes' or 'no'.\n")
 
 
-def run_server(output_dir=None):
-    try:
-        from http import server
-        from socketserver import TCPServer
-    except ImportError:  # Python 2 imports
-        import SimpleHTTPServer as server
-        from SocketServer import TCPServer
-
+def run_server(output_dir=None, host="localhost", port=8000, handler=ResultsRequestHandler):
     SERVER_HOME, base = base_directories('')
     print("Setting up HTTP Server based from", SERVER_HOME)
     os.makedirs(SERVER_HOME, exist_ok=True)
     os.chdir(SERVER_HOME)
 
-    ADDRESS = "localhost"
-    PORT = 8000
-
-    url = "http://%s:%s" % (ADDRESS, str(PORT))
+    url = "http://%s:%s" % ("localhost" if host in ("", "0.0.0.0") else host, str(port))
 
     success = launch_browser(url, output_dir)
     try: # Try to determine if this is running in a terminal
         import FluentDNA
-        handler = server.SimpleHTTPRequestHandler
-        httpd = TCPServer((ADDRESS, PORT), handler)
+        # one thread per connection, with Range, 304s, .gz files and tiles.pack
+        httpd = ResultsServer((host, port), handler)
         print("Open a browser at " + url)
         print("If you are using this computer remotely, use CTRL+C to close the browser and "
               "find your results in " + os.path.join(os.path.dirname(FluentDNA.__file__),
@@ -127,6 +123,8 @@ def run_server(output_dir=None):
                 httpd.serve_forever()
             except KeyboardInterrupt:
                 print("FluentDNA Server shutdown.")
+            finally:
+                httpd.server_close()
     except OSError:
         print("A server is already running on this port.")
         print("You can access your results through the browser at %s" % url)
@@ -146,8 +144,11 @@ def launch_browser(url, output_dir):
 def done(args, output_dir=None):
     """Ensure that server always starts when requested.
     Otherwise system exit."""
+    if output_dir and getattr(args, 'precompress', False):
+        print("Compressed", precompress(output_dir), "files for the server")
     if not args.no_server and args.run_server:
-        run_server(output_dir)
+        handler = LazyTileRequestHandler if getattr(args, 'lazy_tiles', False) else ResultsRequestHandler
+        run_server(output_dir, args.host, args.port, handler)
     else:
         beep()
         hold_console_for_windows()
@@ -170,13 +171,19 @@ def ddv(args):
         #Don't overwrite old webpage when regenerating zoom stack from an image
         layout.generate_html(args.output_dir, args.output_name, overwrite_files=False)
         print("Creating Deep Zoom Structure for Existing Image...")
-        create_deepzoom_stack(args.image, os.path.join(args.output_dir, 'GeneratedImages', "dzc_output.xml"))
+        create_deepzoom_stack(args.image, os.path.join(args.output_dir, 'GeneratedImages', "dzc_output.xml"),
+                              args.workers, **tile_options(args))
         print("Done creating Deep Zoom Structure.")
+        if args.tile_pack or args.pack_chunks:
+            pack_results(args.output_dir, args.pack_chunks)
         done(args, args.output_dir)
 
     elif args.layout == "tiled":  # Typical Use Case
         # TODO: allow batch of tiling layout by chromosome
-        create_tile_layout_viz_from_fasta(args, args.fasta, args.output_name)
+        if args.lazy_tiles:
+            create_lazy_tile_viz(args, args.fasta, args.output_name)
+        else:
+            create_tile_layout_viz_from_fasta(args, args.fasta, args.output_name)
         done(args, args.output_dir)
 
     # ==========TODO: separate views that support batches of contigs============= #
@@ -229,7 +236,10 @@ def ddv(args):
         layout = HighlightedAnnotation(args.ref_annotation, args.query_annotation, args.repeat_annotation,
                                        use_titles=args.use_titles, sort_contigs=args.sort_contigs,
                                        low_contrast=args.low_contrast, base_width=args.base_width,
-                                       custom_layout=args.custom_layout, use_labels=args.use_labels)
+                                       custom_layout=args.custom_layout, use_labels=args.use_labels,
+                                       indexed_canvas=args.indexed_color, disk_canvas=args.disk_canvas,
+                                       workers=args.workers, master_png=args.master_png,
+                                       png_compress_level=args.png_compress_level)
         start_time = layout.process_file(args.fasta, args.output_dir, args.output_name,
                             args.no_webpage, args.contigs)
         finish_webpage(args, layout, args.output_name, start_time)
@@ -322,37 +332,94 @@ def create_tile_layout_viz_from_fasta(args, fasta, output_name, layout=None):
     if layout is None:
         layout = TileLayout(use_titles=args.use_titles, sort_contigs=args.sort_contigs,
                             low_contrast=args.low_contrast, base_width=args.base_width,
-                            custom_layout=args.custom_layout)
+                            custom_layout=args.custom_layout, indexed_canvas=args.indexed_color,
+                            disk_canvas=args.disk_canvas, direct_tiles=args.direct_tiles,
+                            direct_tiles_png=args.direct_tiles_png, workers=args.workers,
+                            tile_options=tile_options(args), master_png=args.master_png,
+                            png_compress_level=args.png_compress_level, composition_bp=args.composition_bp)
     start_time = layout.process_file(fasta, args.output_dir, output_name, args.no_webpage, args.contigs)
 
     finish_webpage(args, layout, output_name, start_time)
 
 
+def create_lazy_tile_viz(args, fasta, output_name):
+    """--lazy_tiles: only the layout is calculated and the webpage written.  The server renders
+    tiles as they are viewed (see TileServer.py) while the sequence chunks are written in the background."""
+    start_time = datetime.now()
+    if args.no_server:
+        print("Note: with --lazy_tiles and --no_server, no tiles are made.  Run --lazy_tiles again to view them.")
+    layout = TileLayout(use_titles=args.use_titles, sort_contigs=args.sort_contigs,
+                        low_contrast=args.low_contrast, base_width=args.base_width,
+                        custom_layout=args.custom_layout, composition_bp=args.composition_bp or 1000)
+    layout.image_length = layout.read_contigs_and_calc_padding(fasta, args.contigs)
+    renderer = TileRenderer(layout, tile_format=args.tile_format, compress_level=args.compress_level,
+                            palette_tiles=args.palette_tiles)
+    cache = TileCache(renderer, os.path.join(args.output_dir, 'GeneratedImages', "dzc_output.xml"),
+                      args.lazy_memory_mb * 1024 * 1024, args.lazy_disk_mb * 1024 * 1024)
+    print("Image dimensions are", renderer.width, "x", renderer.height, "pixels,", len(cache.disk),
+          "tiles cached from earlier runs")
+    layout.image = BandCanvas(None, 0, (renderer.width, renderer.height))  # only its size is used
+    layout.fasta_sources.append(os.path.basename(fasta))
+    layout.remember_contig_spacing()
+    layout.generate_html(args.output_dir, output_name)
+    with open(os.path.join(args.output_dir, 'sources', 'command.sh'), 'w') as f:
+        f.write(archive_execution_command() + '\n')
+    threading.Thread(target=layout.output_fasta, args=(args.output_dir, fasta, False, args.contigs,
+                                                       args.sort_contigs, False)).start()
+    if renderer.composition_levels:  # zoomed out tiles are the first ones a browser asks for
+        threading.Thread(target=renderer.composition_pixels, args=(0,), daemon=True).start()
+    serve_lazy_tiles(cache)
+    print("Ready to render tiles on request:", datetime.now() - start_time)
+
+
 def combine_files(batches, args, output_name):
     from itertools import chain
-    contigs = list(chain(*[read_contigs(batch.fastas[0]) for batch in batches]))
+    contigs = list(chain(*[read_contigs_indexed(batch.fastas[0]) for batch in batches]))
     fasta_output = os.path.join(args.output_dir, 'sources', output_name + '.fa')
     write_contigs_to_file(fasta_output, contigs)
     create_tile_layout_viz_from_fasta(args, fasta_output, output_name)
     copy_to_sources(args.output_dir, args.chain_file)
 
 
+def tile_options(args):
+    """Tile encoding keywords for create_deepzoom_stack() and PyramidWriter"""
+    return dict(tile_format=args.tile_format, compress_level=args.compress_level,
+                palette_tiles=args.palette_tiles, resume=args.resume)
+
+
 def finish_webpage(args, layout, output_name, start_time=datetime.now()):
     final_location = layout.final_output_location
+    canvas_path = layout.canvas_path  # DeepZoom reads a memory-mapped canvas instead of the PNG
+    tiles_written = layout.tiles_written  # --direct_tiles already made the zoom stack
+    composition_levels = layout.composition_levels  # --composition_bp already made the lowest levels
+    # with --master_png background or skip, DeepZoom is handed the image without a PNG round trip
+    deepzoom_source = canvas_path or (layout.image if layout.png_pending else
+                                      os.path.join(args.output_dir, final_location))
     print("Done creating Large Image at ", final_location)
     if not args.no_webpage:
         with open(os.path.join(os.path.dirname(final_location), 'command.sh'), 'w') as f:
             f.write(archive_execution_command() + '\n')  # original command that got us here
         layout.generate_html(args.output_dir, output_name)
+        png_thread = layout.write_deferred_png()
         del layout
         gc.collect()  # it's important to free the large amount of RAM this uses
-        print("Creating Deep Zoom Structure from Generated Image...")
-        create_deepzoom_stack(os.path.join(args.output_dir, final_location),
-                              os.path.join(args.output_dir, 'GeneratedImages', "dzc_output.xml"))
-        print("Done creating Deep Zoom Structure")
+        if not tiles_written:
+            print("Creating Deep Zoom Structure from Generated Image...")
+            create_deepzoom_stack(deepzoom_source,
+                                  os.path.join(args.output_dir, 'GeneratedImages', "dzc_output.xml"),
+                                  args.workers, lowest_level=composition_levels, **tile_options(args))
+            print("Done creating Deep Zoom Structure")
+        if png_thread is not None:
+            png_thread.join()
+            print("Done writing", final_location)
+        del deepzoom_source
+        if args.tile_pack or args.pack_chunks:
+            pack_results(args.output_dir, args.pack_chunks)
     else:
         del layout
         gc.collect()  # it's important to free the large amount of RAM this uses
+    if canvas_path:
+        delete_canvas(canvas_path)
     print("Total processing time: ", datetime.now() - start_time )
 
 
@@ -443,6 +510,109 @@ def main():
                         action='store_true',
                         help="No annotation labels rendered",
                         dest="no_labels")
+    parser.add_argument("-ic", "--indexed_color",
+                        action='store_true',
+                        help="Draw on a one byte per pixel palette image instead of RGB.  Uses a third "
+                             "of the RAM and writes palette PNGs.  Used by tiled and annotated layouts.  "
+                             "Output is identical to RGB, but titles that blend more colors than a palette "
+                             "holds switch the image back to RGB, as do titles with --direct_tiles.",
+                        dest="indexed_color")
+    parser.add_argument("-dc", "--disk_canvas",
+                        action='store_true',
+                        help="Keep the image in a memory-mapped file next to the output instead of RAM, "
+                             "for images larger than memory.  The file is deleted when the zoom stack is done.  "
+                             "Used by tiled and annotated layouts.",
+                        dest="disk_canvas")
+    parser.add_argument("-w", "--workers",
+                        default=1,
+                        type=int,
+                        help="Number of processes drawing nucleotides and encoding Deep Zoom tiles, and threads compressing the PNG.  "
+                             "More than 1 draws into a shared canvas file (see --disk_canvas).",
+                        dest="workers")
+    parser.add_argument("-dt", "--direct_tiles",
+                        action='store_true',
+                        help="Render the zoom stack tile by tile straight from the sequence instead of "
+                             "drawing one big image and cutting it up.  Memory stays at a few rows of tiles.  "
+                             "Used by the tiled layout.",
+                        dest="direct_tiles")
+    parser.add_argument("-dp", "--direct_tiles_png",
+                        action='store_true',
+                        help="With --direct_tiles, also write the full resolution PNG.",
+                        dest="direct_tiles_png")
+    parser.add_argument("-mp", "--master_png",
+                        default="background",
+                        choices=["background", "now", "skip"],
+                        help="When to write the full resolution PNG in sources/.  'background' writes it while "
+                             "the zoom stack is made from the image in memory, 'now' writes it first and "
+                             "'skip' doesn't write it at all.  Used by tiled and annotated layouts.",
+                        dest="master_png")
+    parser.add_argument("-pz", "--png_compress_level",
+                        default=6,
+                        type=int,
+                        choices=range(10),
+                        metavar="0-9",
+                        help="zlib level of the full resolution PNG.  It is compressed in bands by --workers "
+                             "threads.  Default 6.",
+                        dest="png_compress_level")
+    parser.add_argument("-tf", "--tile_format",
+                        default="png",
+                        choices=["png", "webp", "jpg"],
+                        help="Deep Zoom tile format.  webp is lossless and smaller than png.  jpg blurs "
+                             "single nucleotides.  See docs/tile_encoding.md for a comparison.",
+                        dest="tile_format")
+    parser.add_argument("-zl", "--compress_level",
+                        default=6,
+                        type=int,
+                        choices=range(10),
+                        metavar="0-9",
+                        help="Tile compression effort: zlib level for png, method for webp.  Default 6.",
+                        dest="compress_level")
+    parser.add_argument("-pt", "--palette_tiles",
+                        action='store_true',
+                        help="Save png tiles with 256 colors or less (all full resolution nucleotide tiles) "
+                             "in palette mode.  Lossless, smaller and faster than plain png tiles.",
+                        dest="palette_tiles")
+    parser.add_argument("-cb", "--composition_bp",
+                        type=int,
+                        default=0,
+                        help="Zoomed out Deep Zoom levels where one pixel covers at least this many "
+                             "nucleotides (e.g. 1000) are computed from sequence composition before "
+                             "drawing, instead of by shrinking the full image.  Only for the default "
+                             "tiled layout.  Default 0 is off.",
+                        dest="composition_bp")
+    parser.add_argument("-lt", "--lazy_tiles",
+                        action='store_true',
+                        help="Don't draw anything up front.  Only the layout is calculated, then the server "
+                             "renders each Deep Zoom tile the first time it is viewed.  Zoomed out tiles come "
+                             "from sequence composition (--composition_bp, 1000 by default).  Good for "
+                             "genomes that are only looked at once.  Only for the default tiled layout.",
+                        dest="lazy_tiles")
+    parser.add_argument("-lm", "--lazy_memory_mb",
+                        type=int, default=256,
+                        help="Megabytes of encoded tiles --lazy_tiles keeps in memory.  Default 256.",
+                        dest="lazy_memory_mb")
+    parser.add_argument("-ld", "--lazy_disk_mb",
+                        type=int, default=4096,
+                        help="Megabytes of tiles --lazy_tiles keeps in GeneratedImages/dzc_output_files.  The "
+                             "least recently viewed are deleted first.  Default 4096.",
+                        dest="lazy_disk_mb")
+    parser.add_argument("-rs", "--resume",
+                        action='store_true',
+                        help="Continue the Deep Zoom tiles of an earlier run with the same output name that "
+                             "was killed before it finished.  Finished rows of tiles are recorded in "
+                             "GeneratedImages/dzc_output_progress.json and aren't encoded again.  The image "
+                             "itself is still drawn again, so the input has to be the same.",
+                        dest="resume")
+    parser.add_argument("-tp", "--tile_pack",
+                        action='store_true',
+                        help="Store the Deep Zoom tiles in a single tiles.pack file instead of thousands of "
+                             "small files.  The FluentDNA server reads tiles out of it.  Existing results can "
+                             "be converted with 'python -m FluentDNA.TilePack results/<name>'.",
+                        dest="tile_pack")
+    parser.add_argument("-pc", "--pack_chunks",
+                        action='store_true',
+                        help="Like --tile_pack, and also pack the chunks/ sequence files.",
+                        dest="pack_chunks")
     parser.add_argument("-nw", "--no_webpage",
                         action='store_true',
                         help="Use if you only want an image.  No webpage or zoomstack will be calculated.  "
@@ -453,6 +623,20 @@ def main():
                         help="Prevents the server from starting after a successful render.  "
                              "Use this with batch commands or HPC jobs.",
                         dest="no_server")
+    parser.add_argument("-ho", "--host",
+                        type=str, default="localhost",
+                        help="Address the server listens on.  Use 0.0.0.0 to make results reachable from "
+                             "other computers.  Default localhost.",
+                        dest="host")
+    parser.add_argument("-po", "--port",
+                        type=int, default=8000,
+                        help="Port the server listens on.  Default 8000.",
+                        dest="port")
+    parser.add_argument("-gz", "--precompress",
+                        action='store_true',
+                        help="Write .gz copies of the chunks/ sequence files and JSON next to them.  The "
+                             "server sends those to browsers that accept gzip.",
+                        dest="precompress")
     parser.add_argument("-q", "--trial_run",
                         action='store_true',
                         help="Only show the first 1 Mbp.  This is a fast run for testing.",
@@ -12,23 +12,28 @@ var nucNumX = 0;
 var nucNumY = 0;
 
 /**
- fasta_sources, each_layout, ContigSpacingJSON, and contigs are a complete set:
+ fasta_sources, each_layout, ContigSpacingJSON, and sequence_indices are a complete set:
  each is a list with one entry per fasta_source file.  Their indices all match and
  can be used in tandem to fetch different piece of information.
 * fasta_sources lists the file names also uses as /chunks/ directories
 * each_layout has one LayoutLevels array per file that describes the coordinate frame and origin
-* ContigSpacingJSON is the individual contig names placed inside that coordinate frame
-* Contigs has a separate object for each file in case some files have duplicate contig names
-   This is dynamically loaded from getSequence() and stores actual sequences by name
+* ContigSpacingJSON is the individual contig names placed inside that coordinate frame, only the
+   first thousand of each file.  contig_positions has all of them once chunks/<file>/contig_positions.bin
+   is loaded, as columns that can be binary searched.
+* sequence_indices holds chunks/<file>/index.json once it is loaded: the block size and the
+   [name, length] of each contig.  Contigs are numbered like ContigSpacingJSON, so duplicate
+   names are no problem.  Sequence comes in blocks of chunks/<file>/<contig>_<block>.txt
  */
-var contigs = fasta_sources.map(function() { return {} });
+var sequence_indices = fasta_sources.map(function() { return null });
+var contig_positions = fasta_sources.map(function() { return null });
+var sequence_blocks = new Map();  // "file:contig:block" -> sequence, least recently used first
+var max_sequence_blocks = 64;  // a few MB of sequence around the places the cursor has been
+var pending_requests = {};  // URLs being fetched
 var visible_seq_obj;
-var theSequenceSplit = []; // used globally by density service
 var theSequence = "";
 var fragmentid = "";
-var sequence_data_loaded = 0;
 var sequence_data_viewer_initialized = false;
-var file_transfer_in_progress = false;
+var last_position_info = {};  // contig under the cursor, for the composition key
 
 function init_all(){
     /** Iterates through each chromosome container and initializes and OpenSeaDragon
@@ -73,10 +78,12 @@ function init(container_id, source_folder) {
                 $("#outfile").prepend("<div class='sequenceFragment'><div style='background-color:#f0f0f0;'>" + fragmentid + "</div>" + theSequence + "</div>");
             }
         }
+        if (event.keyCode == 68 && last_position_info.contig_name) {
+            showComposition(last_position_info);
+        }
     });
 
     $("#SequenceFragmentInstruction").hide();
-    $("#getSequenceButton").hide();
 }
 
 function numberWithCommas(x) {
@@ -89,22 +96,30 @@ function nucleotide_coordinates_to_sequence_index(index_from_xy, source_index){
     var contig_index = "";
     var index_inside_contig = 0;
     var file_coordinates = "";
-    for (var i = 0; i < ContigSpacingJSON[source_index].length; i++) {
-        var contig = ContigSpacingJSON[source_index][i];
-        if (contig.xy_seq_end > index_from_xy) { // we're in range of the right contig
-            contig_index = i;
-            if (contig.xy_title_start > index_from_xy) { //we overshot and haven't reached title
-                break;
-            }
-            if (contig.xy_seq_start <= index_from_xy) {// cursor is in nucleotide body
-                index_inside_contig = index_from_xy - contig.xy_seq_start + 1;
-                file_coordinates = contig.nuc_seq_start + index_inside_contig;
-                contig_name = contig.name;
-                break;
+    var positions = contig_positions[source_index];
+    if (positions === null) {
+        getContigPositions(source_index);
+        positions = embeddedContigPositions(source_index);
+    }
+    var low = 0;
+    var high = positions.names.length;
+    while (low < high) { // first contig that ends after the cursor
+        var middle = (low + high) >>> 1;
+        if (positions.xy_seq_end[middle] > index_from_xy) {
+            high = middle;
+        } else {
+            low = middle + 1;
+        }
+    }
+    if (low < positions.names.length) { // we're in range of the right contig
+        contig_index = low;
+        if (positions.xy_title_start[low] <= index_from_xy) { //otherwise we overshot and haven't reached title
+            contig_name = positions.names[low];
+            if (positions.xy_seq_start[low] <= index_from_xy) {// cursor is in nucleotide body
+                index_inside_contig = index_from_xy - positions.xy_seq_start[low] + 1;
+                file_coordinates = positions.nuc_seq_start[low] + index_inside_contig;
             } else {// cursor is in label
                 cursor_in_a_title = true;
-                contig_name = contig.name;
-                break;
             }
         }
     }
@@ -112,7 +127,49 @@ function nucleotide_coordinates_to_sequence_index(index_from_xy, source_index){
         index_inside_contig: index_inside_contig,
         file_coordinates: file_coordinates,
         contig_index: contig_index,
-        fasta_index: source_index};//so we can getSequence() the right file
+        fasta_index: source_index};//so we can visibleSequence() the right file
+}
+
+/** The contigs in ContigSpacingJSON in the same columns as contig_positions, for use until it loads */
+function embeddedContigPositions(source_index) {
+    var contigs = ContigSpacingJSON[source_index];
+    var positions = {names: contigs.map(function (contig) { return contig.name; })};
+    for (let column of ["xy_title_start", "xy_seq_start", "xy_seq_end", "nuc_seq_start"]) {
+        positions[column] = contigs.map(function (contig) { return contig[column]; });
+    }
+    return positions;
+}
+
+function getContigPositions(source_index) {
+    var url = "chunks/" + fasta_sources[source_index] + "/contig_positions.bin";
+    if (!pending_requests[url]) {
+        pending_requests[url] = true;  // not cleared, a missing file isn't asked for again
+        var request = new XMLHttpRequest();
+        request.open("GET", url);
+        request.responseType = "arraybuffer";
+        request.onload = function () {
+            if (request.status == 200) {
+                contig_positions[source_index] = readContigPositions(request.response);
+            }
+        };
+        request.send();
+    }
+}
+
+/** Columns of contig_positions.bin, see write_contig_positions() in TileLayout.py.
+ * Typed arrays are in the byte order of the machine, which is little-endian in every browser.*/
+function readContigPositions(buffer) {
+    var header_length = new DataView(buffer).getUint32(8, true);
+    var header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 12, header_length)));
+    var Column = header.dtype == "f8" ? Float64Array : Uint32Array;
+    var offset = Math.ceil((12 + header_length) / 8) * 8;
+    var positions = {};
+    for (let column of header.columns) {
+        positions[column] = new Column(buffer, offset, header.count);
+        offset += header.count * Column.BYTES_PER_ELEMENT;
+    }
+    positions.names = new TextDecoder().decode(new Uint8Array(buffer, offset)).split("\n");
+    return positions;
 }
 
 /** Mouse cursor logic for the Ideogram peano layout needs to account for fractal
@@ -223,6 +280,9 @@ function showNucleotideNumber(event, viewer) {
     }
 
 
+    if (information_to_show || cursor_in_a_title) {
+        last_position_info = position_info;
+    }
     if(cursor_in_a_title){
         document.getElementById("Nucleotide").innerHTML = position_info.contig_name;
     }else{
@@ -252,8 +312,9 @@ function showNucleotideNumber(event, viewer) {
                 start = Nucleotide - 1;
                 stop = Nucleotide;
             }
-            if(contigs[position_info.fasta_index].hasOwnProperty(position_info.contig_name)){
-                theSequence = contigs[position_info.fasta_index][position_info.contig_name].substring(start, stop);
+            var fragment = visibleSequence(position_info, start, stop);
+            if(fragment !== null){
+                theSequence = fragment;
                 //theSequence = theSequence.replace(/\s+/g, '')
                 fragmentid = position_info.contig_name + ": (" +
                   numberWithCommas(start + 1) + " - " + numberWithCommas(stop) + ")";
@@ -263,8 +324,6 @@ function showNucleotideNumber(event, viewer) {
                 visible_seq_obj.setSelection(remainder, remainder);
 
                 $('#SequenceFragmentInstruction').show();
-            }else{
-                getSequence(position_info.fasta_index, position_info.contig_index)
             }
         }
         else {
@@ -292,67 +351,88 @@ function addLoadEvent(func) {
     }
 }
 
-function loading_function()
-{
-    var xhr = new window.XMLHttpRequest();
-    //Download progress
-    xhr.addEventListener("load", function (evt) {
-        $("#status").html("Sequence data loaded.  Display of sequence fragments activated.");
-        sequence_data_loaded = 1;
-    }, false);
-    xhr.addEventListener("progress", function (evt) {
-        if (evt.lengthComputable) {
-            var percentComplete = (evt.loaded / evt.total) * 100;
-            //Do something with download progress
-            if (percentComplete < 100) {
-                $("#status").html("<img src='img/loading.gif' /> Loading sequence data.  " +
-                  "Hover your mouse over the sequence you wish to see: " +
-                  parseFloat(percentComplete).toFixed(2) + "% complete");
-            }
-        }
-        else {
-            $("#status").html("<img src='img/loading.gif' />Loading sequence data  ... [ " +
-              parseFloat(evt.loaded / 1048576).toFixed(2) + " MB loaded ]");
-        }
-    }, false);
-    return xhr;
-}
-
-function get_all_sequences() {
-    var fasta_path = fasta_sources[0];
-    for(let [index, contig] of ContigSpacingJSON.entries()){
-        getSequence(0, index); // dispatch one request for each contig
+/** Sequence between start and stop of the contig under the cursor, or null while blocks of it
+ * are requested.  Only the blocks the cursor is over are downloaded, not the whole contig.*/
+function visibleSequence(position_info, start, stop) {
+    var index = sequence_indices[position_info.fasta_index];
+    if (index === null) {
+        getSequenceIndex(position_info.fasta_index);
+        return null;
     }
+    stop = Math.min(stop, index.contigs[position_info.contig_index][1]);
+    start = Math.min(start, stop);
+    var first_block = Math.floor(start / index.block);
+    var pieces = [];
+    for (var b = first_block; b * index.block < stop; b++) {
+        pieces.push(getSequenceBlock(position_info.fasta_index, position_info.contig_index, b));
+    }
+    if (pieces.indexOf(null) != -1) {
+        return null;
+    }
+    var offset = first_block * index.block;
+    return pieces.join("").substring(start - offset, stop - offset);
 }
 
-function getSequence(fasta_index, contig_index) {
-    var fasta_path = "chunks/" + fasta_sources[fasta_index] + "/" + contig_index + ".fa";
-    if(!file_transfer_in_progress){
-        file_transfer_in_progress = true;
-        $.ajax({xhr: loading_function,
-            type: "GET",
-            url: fasta_path,
-            contentType: "text/html",
-            success: function (sequence_received) {
-                file_transfer_in_progress = false;
-                read_contigs(sequence_received, fasta_index);
-            },
-            error: processInitSequenceError
+function fetchOnce(url, dataType, success) {
+    if (!pending_requests[url]) {
+        pending_requests[url] = true;
+        $.ajax({type: "GET",
+            url: url,
+            dataType: dataType,
+            success: success,
+            error: processInitSequenceError,
+            complete: function () { delete pending_requests[url]; }
         });
     }
 }
 
-function read_contigs(sequence_received, fasta_index) {
-    //read_contigs equiv in javascript
-    theSequenceSplit = sequence_received.split(/\r?\n(?=>)/);// begin line, caret  ">");
-    for (let contig_s of theSequenceSplit) {
-        var lines = contig_s.split(/\r?\n/);
-        var title = lines[0].slice(1)
-        var seq = lines.slice(1).join('');
-        contigs[fasta_index][title] = seq;
+function getSequenceIndex(fasta_index) {
+    fetchOnce("chunks/" + fasta_sources[fasta_index] + "/index.json", "json", function (index) {
+        sequence_indices[fasta_index] = index;
+    });
+}
+
+function getSequenceBlock(fasta_index, contig_index, block_index) {
+    var key = fasta_index + ":" + contig_index + ":" + block_index;
+    if (sequence_blocks.has(key)) {
+        var block = sequence_blocks.get(key);
+        sequence_blocks.delete(key);  // move to the most recently used end
+        sequence_blocks.set(key, block);
+        return block;
     }
-    return contigs
+    $("#status").html("<img src='img/loading.gif' /> Loading sequence data.");
+    fetchOnce("chunks/" + fasta_sources[fasta_index] + "/" + contig_index + "_" + block_index + ".txt", "text",
+      function (block) {
+        sequence_blocks.set(key, block);
+        if (sequence_blocks.size > max_sequence_blocks) {
+            sequence_blocks.delete(sequence_blocks.keys().next().value);
+        }
+        $("#status").html("Sequence data loaded.  Display of sequence fragments activated.");
+    });
+    return null;
 }
+
+/** Adds the nucleotide composition of a whole contig from api/composition to the Result Log */
+function showComposition(position_info) {
+    $.ajax({type: "GET",
+        url: "api/composition",
+        data: {source: fasta_sources[position_info.fasta_index], index: position_info.contig_index},
+        dataType: "json",
+        success: function (counts) {
+            var total = Math.max(1, counts.length);
+            var cells = [counts.A, counts.C, counts.T, counts.G, counts.N,
+                         counts.G + counts.C, counts.A + counts.T].map(function (count) {
+                return "<td>" + (count / total).toFixed(3) + "</td>";
+            });
+            $("#outfile").prepend("<table class='densityTable'><tr><th colspan='7'>" + counts.contig + ": (" +
+              numberWithCommas(counts.start + 1) + " - " + numberWithCommas(counts.end) + ")</th></tr>" +
+              "<tr><td>A</td><td>C</td><td>T</td><td>G</td><td>N</td><td>G+C</td><td>A+T</td></tr>" +
+              "<tr>" + cells.join("") + "</tr></table>");
+        },
+        error: processError
+    });
+}
+
 function init_sequence_view() {
     visible_seq_obj = new Biojs.Sequence({
         sequence: "",
@@ -369,17 +449,17 @@ function init_sequence_view() {
 
 
 function processInitSequenceError() {
-    file_transfer_in_progress = false;
+    $("#status").html("Sequence data could not be loaded.");
 };
 
 function outputTable() {
     if (each_layout.length){
        $('#outputContainer').append('<table id="output" style="border: 1px solid #000000;"><tr><th id="FileUnderCursor">Nucleotide Number</th><td id="Nucleotide">-</td></tr></table>    '+
-      '<div id="getSequenceButton"><br /><a onclick="get_all_sequences()"> Fetch Sequence </a></div>' +
       '<div id="base"></div><div id="SequenceFragmentFASTA" style="height:200px;">' +
         '<div id="SeqDisplayTarget"></div>' +
         '<div id="SequenceFragmentInstruction" style="display: block;margin-top: -25px;">' +
-          'Press "x" key using keyboard to copy this fragment to Result Log</div>' +
+          'Press "x" key using keyboard to copy this fragment to Result Log, ' +
+          '"d" for the nucleotide composition of the whole contig</div>' +
         '<div id="status_box">' +
           '<span style="font-weight: bolder;color: darkgrey;font-family: sans-serif;">Status: </span>' +
           '<div id="status"></div>' +
@@ -407,5 +487,4 @@ function processError() {
 addLoadEvent(outputTable); // Builds HTML
 addLoadEvent(init_all);
 addLoadEvent(init_sequence_view);  // could be dependent on a button press
-// addLoadEvent(get_all_sequences);
 
@@ -0,0 +1,80 @@
+"""Compares Deep Zoom tile encoding options (see deepzoom.encode_tile) on existing FluentDNA images.
+Every tile of the full resolution level and the next two levels is encoded in memory with each
+option and a markdown table of milliseconds and bytes per tile is printed.
+
+Usage:  python -m FluentDNA.scripts.tile_benchmark results/<name>/sources/<name>.png [more images]
+The results for the example genomes are in docs/tile_encoding.md"""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import os
+import sys
+from io import BytesIO
+from timeit import default_timer
+
+import numpy as np
+from PIL import Image
+
+from FluentDNA.deepzoom import DZIDescriptor, encode_tile, reduce_by_half
+
+# label, tile_format, compress_level, palette_tiles
+OPTIONS = [('png zlib 1', 'png', 1, False),
+           ('png zlib 6 (default)', 'png', 6, False),
+           ('png zlib 9', 'png', 9, False),
+           ('palette png zlib 1', 'png', 1, True),
+           ('palette png zlib 6', 'png', 6, True),
+           ('palette png zlib 9', 'png', 9, True),
+           ('lossless webp method 0', 'webp', 0, False),
+           ('lossless webp method 4', 'webp', 6, False),
+           ('lossless webp method 6', 'webp', 9, False),
+           ('jpg quality 95 (lossy)', 'jpg', 6, False)]
+
+
+def level_tiles(pixels, levels=3, tile_size=256):
+    """Tiles of the top levels of the pyramid, cut the same way as ImageCreator"""
+    height, width = pixels.shape[:2]
+    descriptor = DZIDescriptor(width, height, tile_size, 1, 'png')
+    tiles = []
+    for level in reversed(range(descriptor.num_levels)[-levels:]):
+        columns, rows = descriptor.get_num_tiles(level)
+        for column in range(columns):
+            for row in range(rows):
+                x1, y1, x2, y2 = descriptor.get_tile_bounds(level, column, row)
+                tiles.append(Image.fromarray(pixels[y1:y2, x1:x2]))
+        pixels = reduce_by_half(pixels, 2 ** (descriptor.num_levels - 1 - level), width, height)
+    return tiles
+
+
+def benchmark(tiles):
+    rows = []
+    for label, tile_format, compress_level, palette_tiles in OPTIONS:
+        total_bytes = 0
+        start = default_timer()
+        for tile in tiles:
+            encoded = BytesIO()
+            encode_tile(tile, encoded, tile_format, 0.95, compress_level, palette_tiles)
+            total_bytes += encoded.tell()
+        elapsed = default_timer() - start
+        rows.append((label, elapsed * 1000 / len(tiles), total_bytes / len(tiles)))
+    return rows
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    for image_path in sys.argv[1:]:
+        pixels = np.asarray(Image.open(image_path).convert('RGB'))
+        tiles = level_tiles(pixels)
+        print("\n%s  %ix%i, %i tiles from the top 3 levels\n" % (os.path.basename(image_path),
+                                                                pixels.shape[1], pixels.shape[0], len(tiles)))
+        rows = benchmark(tiles)
+        baseline = rows[1][2]
+        print("| Encoding | ms per tile | bytes per tile | size vs. default |")
+        print("|---|---:|---:|---:|")
+        for label, milliseconds, size in rows:
+            print("| %s | %.2f | %i | %i%% |" % (label, milliseconds, size, size / baseline * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,35 @@
+import io
+import gzip
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from functools import partial
+from http.client import HTTPConnection
+
+import numpy as np
+
+from DNASkittleUtils.Contigs import Contig, read_contigs
+from DNASkittleUtils.DDVUtils import rev_comp
+from PIL import Image
 
 from FluentDNA.AnnotatedTrackLayout import AnnotatedTrackLayout
+from FluentDNA.Annotations import squish_fasta
+from FluentDNA.Canvas import MemmapCanvas, PngWriter, PngReader
+from FluentDNA.CompositionCounts import CountsWriter, CompositionCounts, composition_counts_path
+from FluentDNA.CompositionPyramid import block_sums
+from FluentDNA.deepzoom import reduce_in_bands, reduce_by_half, PyramidWriter, ImageCreator, TileSaver, \
+    encode_tile
+from FluentDNA.FastaIndex import read_contigs_indexed, IndexedFasta
+from FluentDNA.Layouts import level_layout_factory
+from FluentDNA.PackedSequence import as_packed, sequence_positions, SequenceBuffer
+from FluentDNA.ResultsServer import ResultsServer, ResultsRequestHandler
+from FluentDNA.TileLayout import TileLayout, write_contigs_to_chunks_dir, write_contig_positions
+from FluentDNA.TileServer import TileRenderer, TileCache
+from FluentDNA.TilePack import TilePack, pack_results
 
 class AnnotationTrackTest(unittest.TestCase):
     """The majority of testing is done in end_to_end_tests.py because visualization have
@@ -16,5 +44,595 @@ class AnnotationTrackTest(unittest.TestCase):
         self.assertEqual(True, True)
 
 
+class FastaIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_fasta(self, name, content):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_matches_read_contigs(self):
+        fa = self.write_fasta('crlf.fa', b'>a one\r\nACGTa\r\nAC\r\n>b\r\nTTTT\r\nGG')
+        expected, indexed = read_contigs(fa), read_contigs_indexed(fa)
+        self.assertEqual([c.name for c in expected], [c.name for c in indexed])
+        self.assertEqual([c.seq for c in expected], [c.seq[:] for c in indexed])
+        self.assertTrue(os.path.exists(fa + '.fai'))
+
+    def test_slicing(self):
+        fa = self.write_fasta('lines.fa', b'>chr1\nACGTA\nCCGGT\nac\n')
+        seq = IndexedFasta(fa).find('chr1')
+        self.assertEqual(len(seq), 12)
+        self.assertEqual(seq[3:8], 'TACCG')
+        self.assertEqual(seq[-1], 'C')
+        self.assertEqual(seq[::-1], 'CATGGCCATGCA')
+        self.assertEqual(seq[10:100], 'AC')
+
+    def test_find_matches_full_header(self):
+        fa = self.write_fasta('names.fa', b'>chr1 extra\nAAAA\n>Chr1 \nCCCC\n>chr2\nGG\n')
+        self.assertEqual(IndexedFasta(fa).find('chr1')[:], 'CCCC')  # same record as pluck_contig()
+        self.assertEqual(IndexedFasta(fa).find('CHR1 extra')[:], 'AAAA')
+        self.assertRaises(IOError, IndexedFasta(fa).find, 'chr')
+
+    def test_uneven_lines_fall_back(self):
+        fa = self.write_fasta('uneven.fa', b'>a\nACG\nACGT\n')
+        self.assertEqual(read_contigs_indexed(fa)[0].seq, 'ACGACGT')
+
+    def test_uneven_lines_streaming(self):
+        fa = self.write_fasta('uneven.fa', b'>a\nACG\nACGT\n>b second\nTT\nG\nCC\n')
+        contigs = read_contigs_indexed(fa, streaming=True)
+        self.assertEqual([c.name for c in contigs], ['a', 'b second'])
+        self.assertEqual([len(c.seq) for c in contigs], [7, 5])
+        self.assertEqual(contigs[1].seq[:], 'TTGCC')
+        self.assertEqual(contigs[1].seq[2:4], 'GC')
+
+    def test_composition_counts(self):
+        rng = np.random.RandomState(3)
+        seqs = [''.join(rng.choice(list('ACGTNacgtnRY'), size=n)) for n in (3, 7, 100, 250)]
+        fa = self.write_fasta('counts.fa', b''.join(b'>c\n' + s.encode() + b'\n' for s in seqs))
+        writer = CountsWriter(os.path.join(self.folder, 'counts.bin'), fa, block=16)
+        self.assertEqual(len(list(writer.counted(read_contigs(fa)))), 4)  # repeated names
+        writer.close()
+        counts = CompositionCounts(os.path.join(self.folder, 'counts.bin'))
+        for index, seq in enumerate(seqs):
+            for start, end in [(0, None), (3, 5), (15, 33), (16, 32), (40, 1000), (1000, 2000)]:
+                part = seq[start:end].upper()
+                expected = dict((base, part.count(base)) for base in 'ACGTN')
+                expected['other'] = part.count('R') + part.count('Y')
+                expected['length'] = len(part)
+                self.assertEqual(counts.counts(index, start, end), expected)
+                self.assertEqual(counts.sequence(index, start, end).upper(), part)
+        self.assertEqual(counts.contig_index('c'), 0)  # repeated names find the first
+        self.assertRaises(KeyError, counts.contig_index, '1')  # a name, not a contig number
+        counts.close()
+
+    def test_sequence_chunks(self):
+        contigs = [Contig('a', 'ACGTN' * 7), Contig('b', 'GG'), Contig('a', 'T' * 10)]
+        write_contigs_to_chunks_dir(self.folder, 'x.fa', contigs, block=10)
+        chunks = os.path.join(self.folder, 'chunks', 'x.fa')
+        with open(os.path.join(chunks, 'index.json')) as f:
+            self.assertEqual(json.load(f), {'block': 10, 'contigs': [['a', 35], ['b', 2], ['a', 10]]})
+        for i, contig in enumerate(contigs):
+            blocks = []
+            for b in range(-(-len(contig.seq) // 10)):
+                with open(os.path.join(chunks, '%i_%i.txt' % (i, b))) as f:
+                    blocks.append(f.read())
+            self.assertEqual(''.join(blocks), contig.seq)
+        self.assertEqual(len(os.listdir(chunks)), 4 + 1 + 1 + 1)
+
+
+class PackedSequenceTest(unittest.TestCase):
+    def test_reverse_complement_view(self):
+        seq = as_packed('AACGTNNGGT')
+        rc = seq.reverse_complement()
+        self.assertEqual(rc[:], rev_comp('AACGTNNGGT'))
+        self.assertEqual(rc[2:6], rev_comp('AACGTNNGGT')[2:6])
+        self.assertEqual(rc[0], 'A')
+        self.assertTrue(np.shares_memory(rc.codes, seq.codes))  # a view, not a copy
+
+    def test_two_bit_round_trip(self):
+        text = 'NNNNACGTACGTTG--NNNNACGTRYACNNN'
+        two_bit = as_packed(text).pack_2bit()
+        self.assertEqual(two_bit[:], text)
+        for start, end in [(0, 3), (3, 17), (13, 30), (30, 31), (5, 5)]:
+            self.assertEqual(two_bit[start:end], text[start:end])
+        self.assertEqual(two_bit[-1], 'N')
+
+    def test_matches(self):
+        self.assertEqual(list(as_packed('ACGTN').matches('ACCT')), [True, True, False, True])
+
+    def test_sequence_positions_skip_headers(self):
+        buffer = SequenceBuffer('ACG\n>header one\nTT\n;comment\nG')
+        self.assertEqual(''.join(buffer[int(i)] for i in sequence_positions(buffer)), 'ACGTTG')
+
+    def test_squish_fasta(self):
+        text = 'ACGTACGTAC' * 7
+        squished = squish_fasta([Contig('a', text)], 4, 10)[0].seq
+        self.assertEqual(squished[:], ''.join(text[i] for i in range(len(text)) if i % 10 in (0, 2, 4, 6)))
+
+
+class LayoutFrameTest(unittest.TestCase):
+    def setUp(self):
+        self.frames = [TileLayout().levels,
+                       level_layout_factory([10, 100, 100, 10, 3, 999], [0, 0, 0, 3, 18, 108], (5, 7))]
+
+    def test_positions_on_screen(self):
+        for frame in self.frames:
+            progress = np.random.RandomState(0).randint(0, frame[-1].chunk_size * 2, 5000)
+            xs, ys = frame.positions_on_screen(progress)
+            for p, x, y in zip(progress, xs, ys):
+                self.assertEqual(tuple(frame.position_on_screen(int(p))), (x, y))
+
+    def test_progress_at_round_trip(self):
+        for frame in self.frames:
+            progress = np.arange(0, frame[-1].chunk_size * 2, 7)
+            xs, ys = frame.positions_on_screen(progress)
+            self.assertTrue(np.array_equal(frame.progress_at_points(xs, ys), progress))
+            self.assertEqual(frame.progress_at(xs[100], ys[100]), progress[100])
+        frame = self.frames[0]
+        self.assertIsNone(frame.progress_at(frame.origin[0] + frame.base_width, frame.origin[1]))  # column padding
+        self.assertIsNone(frame.progress_at(0, 0))  # border
+
+    def test_contig_resolver(self):
+        layout = TileLayout()
+        layout.contigs = [Contig('c%i' % i, 'A' * length) for i, length in enumerate([5000, 120000, 30, 999999])]
+        layout.calc_all_padding()
+        spacing = layout.contig_spacing()
+        for i, entry in enumerate(layout.contig_struct()):
+            self.assertEqual(spacing.resolve(entry['xy_seq_start'] + 3), (i, entry['name'], 3, False))
+            self.assertTrue(spacing.resolve(entry['xy_title_start']).in_title)
+            self.assertIsNone(spacing.resolve(entry['xy_seq_end']))  # tail padding
+        progress = np.arange(0, spacing.seq_ends[-1] + 5000, 13)
+        index, inside, in_title = spacing.resolve_all(progress)
+        for p, i, offset, title in zip(progress[::97], index[::97], inside[::97], in_title[::97]):
+            expected = spacing.resolve(int(p))
+            self.assertEqual(i, -1 if expected is None else expected.contig_index)
+            if expected is not None:
+                self.assertEqual((offset, title), (expected.index_inside_contig, expected.in_title))
+        x, y = layout.position_on_screen(layout.contig_struct()[1]['xy_seq_start'] + 250)
+        self.assertEqual(layout.sequence_at(x, y), (1, 'c1', 250, False))
+
+    def test_contig_positions_file(self):
+        layout = TileLayout()
+        layout.contigs = [Contig('c%i' % i, 'A' * (i * 37 % 500 + 1)) for i in range(2500)]
+        layout.calc_all_padding()
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'contig_positions.bin')
+            write_contig_positions(path, layout.contig_struct())
+            with open(path, 'rb') as f:
+                data = f.read()
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(data[:8], b'FDNAPOS1')
+        header_length = int(np.frombuffer(data[8:12], '<u4')[0])
+        header = json.loads(data[12: 12 + header_length].decode('utf-8'))
+        self.assertEqual(header['count'], 2500)
+        offset = -(-(12 + header_length) // 8) * 8
+        size = 2500 * np.dtype(header['dtype']).itemsize
+        columns = dict((name, np.frombuffer(data, '<' + header['dtype'], 2500, offset + i * size))
+                       for i, name in enumerate(header['columns']))
+        spacing = layout.contig_spacing()
+        self.assertTrue(np.array_equal(columns['xy_title_start'], spacing.title_starts))
+        self.assertTrue(np.array_equal(columns['xy_seq_start'], spacing.seq_starts))
+        self.assertTrue(np.array_equal(columns['xy_seq_end'], spacing.seq_ends))
+        names = data[offset + len(header['columns']) * size:].decode('utf-8').split('\n')
+        self.assertEqual(names, spacing.names)
+
+
+class RasterizerTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def mixed_layout(self, random_bases=False, **options):
+        """Blank canvas for four contigs with lengths chosen to end mid line and mid column"""
+        fa = os.path.join(self.folder, 'mixed.fa')
+        with open(fa, 'w') as f:
+            for i, length in enumerate([150001, 37, 23456, 100]):
+                if random_bases:
+                    seq = ''.join(np.random.RandomState(i).choice(list('ACGTN'), length))
+                else:
+                    seq = ('ACGTNX-.acgt' * length)[:length]
+                f.write('>contig%i\n%s\n' % (i, seq))
+        layout = TileLayout(**options)
+        layout.image_length = layout.read_contigs_and_calc_padding(fa)
+        layout.prepare_image(layout.image_length)
+        return layout
+
+    def test_matches_reference_draw(self):
+        layout = self.mixed_layout()
+        layout.draw_nucleotides(verbose=False)
+        vectorized = np.asarray(layout.image).copy()
+        layout.prepare_image(layout.image_length)
+        layout.draw_nucleotides_reference(verbose=False)
+        self.assertTrue(np.array_equal(vectorized, np.asarray(layout.image)))
+        layout.contigs[1].seq = str(layout.contigs[1].seq)  # not memory-mapped, sent to workers as codes
+        layout.workers, layout.canvas_path = 2, os.path.join(self.folder, 'canvas.npy')
+        layout.prepare_image(layout.image_length)
+        layout.draw_nucleotides(verbose=False)
+        self.assertTrue(np.array_equal(vectorized, np.asarray(layout.image.crop((0, 0) + layout.image.size))))
+        layout.image.close()
+        layout.workers, layout.canvas_path = 1, None
+        layout.use_titles = False  # straight to tiles, the top level is the same image
+        layout.draw_tiles(os.path.join(self.folder, 'tiles.xml'), os.path.join(self.folder, 'tiles.png'),
+                          band_height=50)
+        self.assertTrue(np.array_equal(vectorized, np.asarray(Image.open(os.path.join(self.folder, 'tiles.png')))))
+        layout.indexed_canvas = True  # one byte per pixel, same colors
+        layout.prepare_image(layout.image_length)
+        layout.draw_nucleotides(verbose=False)
+        self.assertEqual(layout.image.mode, 'P')
+        self.assertTrue(np.array_equal(vectorized, np.asarray(layout.image.convert('RGB'))))
+        layout.draw_titles()  # blended title colors get palette entries of their own
+        self.assertEqual(layout.image.mode, 'P')
+        titled = np.asarray(layout.image.convert('RGB'))
+        layout.indexed_canvas = False
+        layout.prepare_image(layout.image_length)
+        layout.draw_nucleotides(verbose=False)
+        layout.draw_titles()
+        self.assertTrue(np.array_equal(titled, np.asarray(layout.image)))
+
+    def test_custom_thick_layout_matches_reference_draw(self):
+        layout = self.mixed_layout(custom_layout="([2,3,5,7,11,13,17,999], [0,0,0,0,0,0,1,6])")
+        start = time.time()
+        layout.draw_nucleotides(verbose=False)
+        vectorized_time = time.time() - start
+        vectorized = np.asarray(layout.image).copy()
+        layout.prepare_image(layout.image_length)
+        start = time.time()
+        layout.draw_nucleotides_reference(verbose=False)
+        reference_time = time.time() - start
+        self.assertTrue(np.array_equal(vectorized, np.asarray(layout.image)))
+        self.assertLess(vectorized_time, reference_time)
+
+    def test_binary_file_uses_spectrum(self):
+        path = os.path.join(self.folder, 'binary.fa')
+        with open(path, 'wb') as f:
+            f.write(b'>a\nACGT\xff\xfe\x80ACGT\nNNNN\n')
+        layout = TileLayout()
+        layout.image_length = layout.read_contigs_and_calc_padding(path)
+        self.assertTrue(layout.using_spectrum)
+        layout.prepare_image(layout.image_length)
+        layout.draw_nucleotides(verbose=False)
+        vectorized = np.asarray(layout.image).copy()
+        self.assertIn(tuple(layout.palette[0xff]), set(map(tuple, vectorized.reshape(-1, 3))))
+        layout.prepare_image(layout.image_length)
+        layout.draw_nucleotides_reference(verbose=False)
+        self.assertTrue(np.array_equal(vectorized, np.asarray(layout.image)))
+
+    def test_composition_levels_are_box_averages(self):
+        layout = self.mixed_layout(random_bases=True)
+        layout.draw_nucleotides(verbose=False)
+        layout.draw_titles()
+        full = np.asarray(layout.image)
+        layout.composition_bp = 16
+        layout.draw_composition_levels(os.path.join(self.folder, 'dzc.xml'))
+        self.assertEqual(layout.composition_levels, 9)
+        height, width = full.shape[:2]
+        for level in range(layout.composition_levels):
+            factor = 4 * 2 ** (layout.composition_levels - 1 - level)  # 16 pixels in the largest
+            sums = block_sums(full, 0, 0, factor)[0]
+            area = np.outer(np.minimum(factor, height - np.arange(sums.shape[0]) * factor),
+                            np.minimum(factor, width - np.arange(sums.shape[1]) * factor))[:, :, None]
+            tile = np.asarray(Image.open(os.path.join(self.folder, 'dzc_files', str(level), '0_0.png')))
+            expected = (sums * 2 + area) // (area * 2)
+            self.assertTrue(np.array_equal(tile[:256, :256], expected[:256, :256]))
+
+    def test_lazy_tiles_match_full_image(self):
+        layout = self.mixed_layout()
+        layout.draw_nucleotides(verbose=False)
+        layout.draw_titles()
+        pixels = np.asarray(layout.image)
+        renderer = TileRenderer(layout)
+        descriptor = renderer.descriptor
+        for level in reversed(range(descriptor.num_levels - 3, descriptor.num_levels)):
+            columns, rows = descriptor.get_num_tiles(level)
+            for column in range(columns):
+                for row in range(rows):
+                    x1, y1, x2, y2 = descriptor.get_tile_bounds(level, column, row)
+                    self.assertTrue(np.array_equal(np.asarray(renderer.render_tile(level, column, row)),
+                                                   pixels[y1:y2, x1:x2]))
+            pixels = reduce_by_half(pixels, 2 ** (descriptor.num_levels - 1 - level), *layout.image.size)
+        cache = TileCache(renderer, os.path.join(self.folder, 'dzc.xml'), memory_bytes=1)
+        level = descriptor.num_levels - 1
+        first = cache.get(level, 1, 0)
+        x1, y1, x2, y2 = descriptor.get_tile_bounds(level, 1, 0)
+        self.assertEqual(Image.open(io.BytesIO(first)).size, (x2 - x1, y2 - y1))
+        cache.get(level, 0, 0)  # pushes the first tile out of memory, it is read from disk
+        self.assertEqual((cache.get(level, 1, 0), cache.rendered), (first, 2))
+        self.assertIsNone(cache.get(level, 999, 0))
+
+
+class CanvasTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_behaves_like_pil_image(self):
+        noise = Image.fromarray(np.random.RandomState(0).randint(0, 256, (300, 200, 3)).astype(np.uint8))
+        overlay = Image.new('RGBA', (50, 40), (10, 20, 30, 128))
+        expected = Image.new('RGB', (200, 300), (255, 255, 255))
+        canvas = MemmapCanvas(os.path.join(self.folder, 'canvas.npy'), (200, 300), 'RGB', (255, 255, 255))
+        for image in (expected, canvas):
+            image.paste(noise.crop((0, 0, 120, 90)), (-20, 250))  # hangs off the corner
+            image.paste(overlay, (100, 100), overlay)
+        self.assertTrue(np.array_equal(np.asarray(canvas.crop((0, 0, 200, 300))), np.asarray(expected)))
+        self.assertTrue(np.array_equal(np.asarray(canvas.crop((190, 290, 210, 310))),
+                                       np.asarray(expected.crop((190, 290, 210, 310)))))
+        png = os.path.join(self.folder, 'canvas.png')
+        canvas.save(png)
+        self.assertTrue(np.array_equal(np.asarray(Image.open(png)), np.asarray(expected)))
+        half = reduce_by_half(np.asarray(expected))
+        for memory_limit in (0, 1 << 30):  # scratch canvas and in memory
+            banded = reduce_in_bands(canvas, os.path.join(self.folder, 'half.npy'),
+                                     band_height=16, memory_limit=memory_limit)
+            self.assertTrue(np.array_equal(np.asarray(banded.crop((0, 0, 100, 150))), half))
+        for workers in (1, 3):  # pieces compressed in parallel make one valid zlib stream
+            png = PngWriter(os.path.join(self.folder, 'bands.png'), 200, 300, 'RGB', workers=workers, piece_size=5000)
+            for top, bottom in canvas.bands(band_height=70):
+                png.write_rows(canvas.array[top: bottom])
+            png.close()
+            self.assertTrue(np.array_equal(np.asarray(Image.open(os.path.join(self.folder, 'bands.png'))),
+                                           np.asarray(expected)))
+        os.remove(os.path.join(self.folder, 'bands.png'))
+        canvas = canvas.convert('RGBA')
+        self.assertEqual((canvas.mode, canvas.size), ('RGBA', (200, 300)))
+        rgba = MemmapCanvas(os.path.join(self.folder, 'rgba.npy'), (4, 4), 'RGBA', (255, 255, 255))
+        self.assertEqual(rgba.load()[3, 3], Image.new('RGBA', (4, 4), (255, 255, 255)).getpixel((3, 3)))
+        rgba.close(delete=True)
+        canvas.close(delete=True)
+        self.assertEqual(sorted(os.listdir(self.folder)), ['canvas.png', 'half.npy', 'half.npy.json'])
+
+
+class PyramidWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_streamed_rows_match_whole_image(self):
+        image = full = np.random.RandomState(1).randint(0, 256, (203, 131, 3)).astype(np.uint8)
+        pyramid = PyramidWriter(131, 203, os.path.join(self.folder, 'dzc.xml'), tile_size=16)
+        for top in range(0, 203, 37):  # rows arrive in chunks that don't line up with tiles
+            pyramid.add_rows(image[top: top + 37])
+        pyramid.close()
+        descriptor = pyramid.descriptor
+        for level in reversed(range(descriptor.num_levels)):
+            columns, rows = descriptor.get_num_tiles(level)
+            self.assertEqual(len(os.listdir(os.path.join(self.folder, 'dzc_files', str(level)))), columns * rows)
+            for column in range(columns):
+                for row in range(rows):
+                    x1, y1, x2, y2 = descriptor.get_tile_bounds(level, column, row)
+                    tile = Image.open(os.path.join(self.folder, 'dzc_files', str(level), '%i_%i.png' % (column, row)))
+                    self.assertTrue(np.array_equal(np.asarray(tile), image[y1:y2, x1:x2]))
+            factor = 2 ** (descriptor.num_levels - 1 - level)
+            sums = block_sums(full, 0, 0, factor)[0]
+            area = np.outer(np.minimum(factor, 203 - np.arange(sums.shape[0]) * factor),
+                            np.minimum(factor, 131 - np.arange(sums.shape[1]) * factor))[:, :, None]
+            # same averages as CompositionPyramid up to rounding at each level, at the edges too
+            self.assertLessEqual(np.abs(image.astype(int) - (sums * 2 + area) // (area * 2)).max(), 2)
+            image = reduce_by_half(image, factor, 131, 203)
+
+    def test_parallel_tiles_match_serial(self):
+        image = np.random.RandomState(2).randint(0, 256, (203, 131, 3)).astype(np.uint8)
+        Image.fromarray(image).save(os.path.join(self.folder, 'source.png'))
+        for name, workers, source in [('w1', 1, os.path.join(self.folder, 'source.png')),
+                                      ('w2', 2, os.path.join(self.folder, 'source.png')),
+                                      ('array', 1, image)]:  # in memory, no PNG
+            ImageCreator(tile_size=16, tile_format='png', workers=workers).create(
+                source, os.path.join(self.folder, name + '.xml'))
+        for name in ('w2', 'array'):
+            self.assertEqual(open(os.path.join(self.folder, 'w1.xml')).read(),
+                             open(os.path.join(self.folder, name + '.xml')).read())
+        for level in os.listdir(os.path.join(self.folder, 'w1_files')):
+            tiles = sorted(os.listdir(os.path.join(self.folder, 'w1_files', level)))
+            for name in ('w2', 'array'):
+                self.assertEqual(tiles, sorted(os.listdir(os.path.join(self.folder, name + '_files', level))))
+            for tile in tiles:
+                serial, parallel, array = [np.asarray(Image.open(os.path.join(self.folder, name, level, tile)))
+                                           for name in ('w1_files', 'w2_files', 'array_files')]
+                self.assertTrue(np.array_equal(serial, parallel))
+                self.assertTrue(np.array_equal(serial, array))
+        self.assertFalse([f for f in os.listdir(self.folder) if f.endswith('.npy')])  # scratch levels are gone
+
+    def test_png_reader_bands_match_full_decode(self):
+        pixels = np.random.RandomState(3).randint(0, 256, (203, 131, 4)).astype(np.uint8)
+        pixels[50:90] = 255  # runs of identical rows pick different filters
+        images = [Image.fromarray(pixels, 'RGBA'), Image.fromarray(pixels[:, :, :3]).quantize(40)]
+        for index, image in enumerate(images):
+            path = os.path.join(self.folder, '%i.png' % index)
+            image.save(path)
+            reader = PngReader.open(path)
+            self.assertEqual(reader.mode, image.mode)
+            decoded = np.asarray(Image.open(path)).reshape(203, 131, -1)
+            streamed = np.concatenate([band for top, band in reader.bands(band_height=37)])
+            self.assertTrue(np.array_equal(decoded, streamed))
+        Image.fromarray(pixels[:, :, 0]).convert('1').save(os.path.join(self.folder, 'bits.png'))
+        self.assertIsNone(PngReader.open(os.path.join(self.folder, 'bits.png')))  # 1 bit isn't streamed
+
+    def test_resume_skips_finished_rows(self):
+        image = np.random.RandomState(4).randint(0, 256, (203, 131, 3)).astype(np.uint8)
+        path = os.path.join(self.folder, 'source.png')
+        Image.fromarray(image).save(path)
+        ImageCreator(tile_size=16, tile_format='png').create(path, os.path.join(self.folder, 'full.xml'))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'full_progress.json')))
+
+        saved = []
+        original_save = TileSaver.save
+        def interrupted_save(saver, tile, tile_path):
+            if len(saved) == 40:
+                raise KeyboardInterrupt()
+            saved.append(tile_path)
+            original_save(saver, tile, tile_path)
+        TileSaver.save = interrupted_save
+        try:
+            self.assertRaises(KeyboardInterrupt, ImageCreator(tile_size=16, tile_format='png').create,
+                              path, os.path.join(self.folder, 'dzc.xml'))
+        finally:
+            TileSaver.save = original_save
+        self.assertTrue(os.path.exists(os.path.join(self.folder, 'dzc_progress.json')))
+        os.remove(saved[0])  # a finished row with a missing tile is done again
+
+        written = []
+        def counted_save(saver, tile, tile_path):
+            written.append(tile_path)
+            original_save(saver, tile, tile_path)
+        TileSaver.save = counted_save
+        try:
+            ImageCreator(tile_size=16, tile_format='png', resume=True).create(
+                path, os.path.join(self.folder, 'dzc.xml'))
+        finally:
+            TileSaver.save = original_save
+        self.assertIn(saved[0], written)
+        self.assertNotIn(saved[-9], written)  # finished rows are 9 tiles wide
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'dzc_progress.json')))
+        for level in os.listdir(os.path.join(self.folder, 'full_files')):
+            tiles = sorted(os.listdir(os.path.join(self.folder, 'full_files', level)))
+            self.assertEqual(tiles, sorted(os.listdir(os.path.join(self.folder, 'dzc_files', level))))
+            for tile in tiles:
+                full, resumed = [np.asarray(Image.open(os.path.join(self.folder, name, level, tile)))
+                                 for name in ('full_files', 'dzc_files')]
+                self.assertTrue(np.array_equal(full, resumed))
+
+    def test_solid_tiles_are_linked(self):
+        saver = TileSaver('png', 0.95)
+        white, busy = Image.new('RGB', (16, 16), (255, 255, 255)), Image.new('RGB', (16, 16), (255, 255, 255))
+        busy.putpixel((15, 15), (0, 0, 0))
+        for name, tile in [('a', white), ('b', busy), ('c', white), ('d', busy), ('e', white.crop((0, 0, 8, 16)))]:
+            saver.save(tile, os.path.join(self.folder, name + '.png'))
+        inode = {name: os.stat(os.path.join(self.folder, name + '.png')).st_ino for name in 'abcde'}
+        self.assertEqual(inode['a'], inode['c'])
+        self.assertEqual(len(set(inode.values())), 4)  # busy tiles and other sizes are encoded
+        self.assertEqual(saver.linked, 1)
+        saver.save(busy, os.path.join(self.folder, 'c.png'))  # replacing a link leaves the original alone
+        self.assertEqual(np.asarray(Image.open(os.path.join(self.folder, 'a.png'))).min(), 255)
+
+    def test_lossless_tile_options(self):
+        colors = np.random.RandomState(3).randint(0, 256, (30, 3)).astype(np.uint8)
+        tile = Image.fromarray(colors[np.random.RandomState(4).randint(0, 30, (40, 50))])
+        for tile_format, palette_tiles in [('png', True), ('webp', False)]:
+            encoded = io.BytesIO()
+            encode_tile(tile, encoded, tile_format, 0.95, 6, palette_tiles)
+            decoded = Image.open(encoded)
+            self.assertEqual(decoded.mode, 'P' if palette_tiles else 'RGB')
+            self.assertTrue(np.array_equal(np.asarray(decoded.convert('RGB')), np.asarray(tile)))
+
+    def test_rgba_tile_as_jpg(self):
+        tile = Image.new('RGBA', (32, 32), (0, 0, 0, 0))  # annotation layouts have transparent areas
+        tile.paste((200, 30, 30, 255), (0, 0, 16, 32))
+        encoded = io.BytesIO()
+        encode_tile(tile, encoded, 'jpg', 0.95)
+        decoded = np.asarray(Image.open(encoded)).astype(int)
+        self.assertTrue(np.abs(decoded[:, 20:] - 255).max() < 8)  # transparent is white
+        self.assertTrue(np.abs(decoded[4:28, 2:12] - (200, 30, 30)).max() < 16)
+
+
+class TilePackTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_pack_round_trip(self):
+        level_dir = os.path.join(self.folder, 'GeneratedImages', 'dzc_output_files', '0')
+        os.makedirs(level_dir)
+        os.makedirs(os.path.join(self.folder, 'chunks', 'seq.fa'))
+        contents = {'GeneratedImages/dzc_output_files/0/0_0.png': b'first tile',
+                    'GeneratedImages/dzc_output_files/0/1_0.png': b'',
+                    'chunks/seq.fa/0.fa': b'ACGT'}
+        for name, data in contents.items():
+            with open(os.path.join(self.folder, *name.split('/')), 'wb') as f:
+                f.write(data)
+        os.link(os.path.join(level_dir, '0_0.png'), os.path.join(level_dir, '0_1.png'))
+        contents['GeneratedImages/dzc_output_files/0/0_1.png'] = b'first tile'
+        pack = TilePack(pack_results(self.folder, include_chunks=True))
+        self.assertEqual({name: pack.read(name) for name in pack.entries}, contents)
+        self.assertEqual(pack.entries['GeneratedImages/dzc_output_files/0/0_0.png'],
+                         pack.entries['GeneratedImages/dzc_output_files/0/0_1.png'])  # linked tiles stored once
+        pack.close()
+        self.assertEqual(sorted(os.listdir(self.folder)), ['GeneratedImages', 'tiles.pack'])
+
+
+class ResultsServerTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.server = ResultsServer(('localhost', 0), partial(ResultsRequestHandler, directory=self.folder))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def test_ranges_validators_and_gzip(self):
+        sequence = b'ACGT' * 1000
+        with open(os.path.join(self.folder, '0.fa'), 'wb') as f:
+            f.write(sequence)
+        with gzip.open(os.path.join(self.folder, '0.fa.gz'), 'wb') as f:
+            f.write(sequence)
+        connection = HTTPConnection('localhost', self.server.server_address[1])  # one keep-alive connection
+
+        def get(headers):
+            connection.request('GET', '/0.fa', headers=headers)
+            response = connection.getresponse()
+            return response, response.read()
+
+        response, body = get({'Range': 'bytes=4-11'})
+        self.assertEqual((response.status, body), (206, b'ACGTACGT'))
+        self.assertEqual(response.getheader('Content-Range'), 'bytes 4-11/4000')
+        self.assertEqual(get({'Range': 'bytes=-3'})[1], b'CGT')
+        self.assertEqual(get({'Range': 'bytes=4000-'})[0].status, 416)
+        etag = response.getheader('ETag')
+        self.assertEqual(get({'If-None-Match': etag})[0].status, 304)
+        response, body = get({'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(body), sequence)
+        self.assertNotEqual(response.getheader('ETag'), etag)
+        for refused in ['gzip;q=0', 'x-gzip-foo', 'br, *;q=0', '*, gzip; q=0.0']:
+            self.assertEqual(get({'Accept-Encoding': refused})[1], sequence)
+        self.assertEqual(get({'Accept-Encoding': 'br;q=1.0, gzip;q=0.5'})[0].getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(get({})[1], sequence)
+        connection.close()
+
+    def test_api_after_packing_chunks(self):
+        os.makedirs(os.path.join(self.folder, 'sources'))
+        fasta = os.path.join(self.folder, 'sources', 'seq.fa')
+        with open(fasta, 'w') as f:
+            f.write('>1\nACGTTTGGNN\n>0\nCCCC\n')  # Ensembl style names
+        writer = CountsWriter(composition_counts_path(self.folder, 'seq.fa'), fasta, block=4)
+        write_contigs_to_chunks_dir(self.folder, 'seq.fa', writer.counted(read_contigs(fasta)))
+        writer.close()
+        pack_results(self.folder, include_chunks=True)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'chunks')))
+        connection = HTTPConnection('localhost', self.server.server_address[1])
+        connection.request('GET', '/api/composition?source=seq.fa&contig=1&start=1&end=9')
+        response = connection.getresponse()
+        self.assertEqual(response.status, 200)
+        counts = json.loads(response.read().decode('utf-8'))
+        self.assertEqual((counts['C'], counts['G'], counts['T'], counts['N']), (1, 3, 3, 1))
+        connection.request('GET', '/api/sequence?source=seq.fa&contig=0')
+        self.assertEqual(connection.getresponse().read(), b'CCCC')
+        connection.request('GET', '/api/sequence?source=seq.fa&index=0&end=4')
+        self.assertEqual(connection.getresponse().read(), b'ACGT')
+        connection.request('GET', '/api/sequence?source=seq.fa&contig=2')
+        response = connection.getresponse()
+        self.assertEqual(response.status, 404)
+        response.read()
+        connection.request('GET', '/chunks/seq.fa/0_0.txt')  # still served from the pack
+        self.assertEqual(connection.getresponse().read(), b'ACGTTTGGNN')
+        connection.close()
+
+
 if __name__ == '__main__':
     unittest.main()